@@ -19,10 +19,14 @@ from __future__ import absolute_import, division, print_function, \
     with_statement
 
 import os
+import time
 import socket
 import struct
 import re
+import errno
+import random
 import logging
+import collections
 
 if __name__ == '__main__':
     import sys
@@ -75,8 +79,48 @@ QTYPE_A = 1
 QTYPE_AAAA = 28
 QTYPE_CNAME = 5
 QTYPE_NS = 2
+QTYPE_SOA = 6
+QTYPE_OPT = 41
 QCLASS_IN = 1
 
+RCODE_NOERROR = 0
+RCODE_FORMERR = 1
+RCODE_NXDOMAIN = 3
+
+# rfc6891, the UDP payload size sent in the OPT record. answers that do not
+# fit are truncated by the server and asked again over TCP
+DNS_UDP_PAYLOAD_SIZE = 1232
+# TCP connections to the nameservers are closed after this long unused
+DNS_TCP_IDLE_TIMEOUT = 30
+# queries go out through this many UDP sockets of each address family, each
+# with its own source port picked at random by the kernel, so that answers
+# are harder to spoof and the load spreads over more ports
+DNS_SOCKETS_PER_FAMILY = 4
+
+# answers are cached for their TTL, clamped to this range
+DNS_MIN_TTL = 10
+DNS_MAX_TTL = 3600
+# names without an address are cached for the SOA minimum, or this long if
+# the server sent no SOA record
+DNS_NEGATIVE_TTL = 30
+DNS_MAX_NEGATIVE_TTL = 300
+# a query is sent again after DNS_TIMEOUT seconds, doubled on every retry
+DNS_TIMEOUT = 1.0
+DNS_MAX_RETRIES = 3
+# more queries wait until one of these finishes
+DNS_MAX_INFLIGHT = 128
+# once one type has an address, the other type is waited for this long
+DNS_RESOLUTION_DELAY = 0.05
+# smoothed RTT of a server that has not answered yet, and the most a
+# server that does not answer is penalized to
+DNS_INITIAL_RTT = 0.1
+DNS_MAX_RTT = 10.0
+
+# the cache is written to dns_cache_file at most this often, so that a
+# restarted server does not have to resolve every hostname again
+DNS_CACHE_SAVE_INTERVAL = 60
+DNS_CACHE_MAGIC = b'SSRDNS01'
+
 def detect_ipv6_supprot():
     if 'has_ipv6' in dir(socket):
         try:
@@ -105,44 +149,70 @@ def build_address(address):
     return b''.join(results)
 
 
-def build_request(address, qtype):
-    request_id = os.urandom(2)
-    header = struct.pack('!BBHHHH', 1, 0, 1, 0, 0, 0)
+def build_request(address, qtype, request_id=None, edns=False):
+    if request_id is None:
+        request_id = os.urandom(2)
+    else:
+        request_id = struct.pack('!H', request_id)
+    header = struct.pack('!BBHHHH', 1, 0, 1, 0, 0, 1 if edns else 0)
     addr = build_address(address)
     qtype_qclass = struct.pack('!HH', qtype, QCLASS_IN)
+    if edns:
+        # OPT pseudo record, root name, class is the payload size
+        opt = b'\0' + struct.pack('!HHIH', QTYPE_OPT, DNS_UDP_PAYLOAD_SIZE,
+                                  0, 0)
+        return request_id + header + addr + qtype_qclass + opt
     return request_id + header + addr + qtype_qclass
 
 
-def parse_ip(addrtype, data, length, offset):
-    if addrtype == QTYPE_A:
-        return socket.inet_ntop(socket.AF_INET, data[offset:offset + length])
-    elif addrtype == QTYPE_AAAA:
-        return socket.inet_ntop(socket.AF_INET6, data[offset:offset + length])
-    elif addrtype in [QTYPE_CNAME, QTYPE_NS]:
-        return parse_name(data, offset)[1]
-    else:
-        return data[offset:offset + length]
+HEADER_STRUCT = struct.Struct('!HBBHHHH')
+QUESTION_STRUCT = struct.Struct('!HH')
+RECORD_STRUCT = struct.Struct('!HHiH')
+UINT32_STRUCT = struct.Struct('!I')
+# a name may not point back more often than this, so a loop of compression
+# pointers can not hang the parser
+MAX_NAME_POINTERS = 64
 
 
-def parse_name(data, offset):
+def skip_name(buf, offset):
+    # returns the offset after the name, without reading its labels. buf
+    # is a bytearray, indexing it gives ints on python 2 and 3
+    while True:
+        l = buf[offset]
+        if l == 0:
+            return offset + 1
+        if l & 0xC0 == 0xC0:
+            # pointer is the end
+            return offset + 2
+        offset += 1 + l
+
+
+def parse_name(data, offset, buf=None):
+    # returns (length of the name at offset, name), compression pointers are
+    # followed in a loop
+    if buf is None:
+        buf = bytearray(data)
     p = offset
+    end = None
     labels = []
-    l = common.ord(data[p])
-    while l > 0:
-        if (l & (128 + 64)) == (128 + 64):
-            # pointer
-            pointer = struct.unpack('!H', data[p:p + 2])[0]
-            pointer &= 0x3FFF
-            r = parse_name(data, pointer)
-            labels.append(r[1])
-            p += 2
-            # pointer is the end
-            return p - offset, b'.'.join(labels)
-        else:
-            labels.append(data[p + 1:p + 1 + l])
-            p += 1 + l
-        l = common.ord(data[p])
-    return p - offset + 1, b'.'.join(labels)
+    pointers = 0
+    while True:
+        l = buf[p]
+        if l == 0:
+            if end is None:
+                end = p + 1
+            break
+        if l & 0xC0 == 0xC0:
+            pointers += 1
+            if pointers > MAX_NAME_POINTERS:
+                raise Exception('too many compression pointers')
+            if end is None:
+                end = p + 2
+            p = ((l & 0x3F) << 8) | buf[p + 1]
+            continue
+        labels.append(data[p + 1:p + 1 + l])
+        p += 1 + l
+    return end - offset, b'.'.join(labels)
 
 
 # rfc1035
@@ -167,82 +237,92 @@ def parse_name(data, offset):
 #    /                     RDATA                     /
 #    /                                               /
 #    +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
-def parse_record(data, offset, question=False):
-    nlen, name = parse_name(data, offset)
-    if not question:
-        record_type, record_class, record_ttl, record_rdlength = struct.unpack(
-            '!HHiH', data[offset + nlen:offset + nlen + 10]
-        )
-        ip = parse_ip(record_type, data, record_rdlength, offset + nlen + 10)
-        return nlen + 10 + record_rdlength, \
-            (name, ip, record_type, record_class, record_ttl)
-    else:
-        record_type, record_class = struct.unpack(
-            '!HH', data[offset + nlen:offset + nlen + 4]
-        )
-        return nlen + 4, (name, None, record_type, record_class, None, None)
-
-
-def parse_header(data):
-    if len(data) >= 12:
-        header = struct.unpack('!HBBHHHH', data[:12])
-        res_id = header[0]
-        res_qr = header[1] & 128
-        res_tc = header[1] & 2
-        res_ra = header[2] & 128
-        res_rcode = header[2] & 15
-        # assert res_tc == 0
-        # assert res_rcode in [0, 3]
-        res_qdcount = header[3]
-        res_ancount = header[4]
-        res_nscount = header[5]
-        res_arcount = header[6]
-        return (res_id, res_qr, res_tc, res_ra, res_rcode, res_qdcount,
-                res_ancount, res_nscount, res_arcount)
-    return None
-
-
 def parse_response(data):
+    # only what the resolver uses is read: the question, the addresses and
+    # TTLs of the answers and, if there is no address, the SOA for the
+    # negative TTL. other records are skipped without reading their names
     try:
         if len(data) >= 12:
-            header = parse_header(data)
-            if not header:
-                return None
-            res_id, res_qr, res_tc, res_ra, res_rcode, res_qdcount, \
-                res_ancount, res_nscount, res_arcount = header
-
-            qds = []
-            ans = []
+            res_id, res_flags, res_flags2, res_qdcount, res_ancount, \
+                res_nscount, res_arcount = HEADER_STRUCT.unpack_from(data)
+            res_rcode = res_flags2 & 15
+            buf = bytearray(data)
+            response = DNSResponse()
+            response.id = res_id
+            response.rcode = res_rcode
             offset = 12
             for i in range(0, res_qdcount):
-                l, r = parse_record(data, offset, True)
-                offset += l
-                if r:
-                    qds.append(r)
+                nlen, name = parse_name(data, offset, buf)
+                qtype, qclass = QUESTION_STRUCT.unpack_from(data,
+                                                            offset + nlen)
+                offset += nlen + 4
+                if i == 0:
+                    response.hostname = name
+                response.questions.append((None, qtype, qclass))
+            if res_flags & 2:
+                # the records may be cut anywhere, it is asked again over TCP
+                response.truncated = True
+                return response
+            has_addr = False
+            answers = response.answers
             for i in range(0, res_ancount):
-                l, r = parse_record(data, offset)
-                offset += l
-                if r:
-                    ans.append(r)
+                offset = skip_name(buf, offset)
+                rtype, rclass, ttl, rdlength = \
+                    RECORD_STRUCT.unpack_from(data, offset)
+                offset += 10
+                if offset + rdlength > len(data):
+                    raise Exception('record out of range')
+                addr = None
+                if rtype == QTYPE_A and rdlength == 4:
+                    addr = socket.inet_ntop(socket.AF_INET,
+                                            data[offset:offset + 4])
+                    has_addr = True
+                elif rtype == QTYPE_AAAA and rdlength == 16:
+                    addr = socket.inet_ntop(socket.AF_INET6,
+                                            data[offset:offset + 16])
+                    has_addr = True
+                answers.append((addr, rtype, rclass, max(ttl, 0)))
+                offset += rdlength
+            if has_addr:
+                return response
             for i in range(0, res_nscount):
-                l, r = parse_record(data, offset)
-                offset += l
-            for i in range(0, res_arcount):
-                l, r = parse_record(data, offset)
-                offset += l
-            response = DNSResponse()
-            if qds:
-                response.hostname = qds[0][0]
-            for an in qds:
-                response.questions.append((an[1], an[2], an[3]))
-            for an in ans:
-                response.answers.append((an[1], an[2], an[3]))
+                offset = skip_name(buf, offset)
+                rtype, rclass, ttl, rdlength = \
+                    RECORD_STRUCT.unpack_from(data, offset)
+                offset += 10
+                # rfc2308, the SOA of a negative answer tells how long to
+                # cache it, MINIMUM is the last field of its rdata
+                if rtype == QTYPE_SOA and rdlength >= 20:
+                    minimum = UINT32_STRUCT.unpack_from(
+                        data, offset + rdlength - 4)[0]
+                    response.negative_ttl = max(min(ttl, minimum), 0)
+                    break
+                offset += rdlength
             return response
     except Exception as e:
         shell.print_exception(e)
         return None
 
 
+def ip_family(ip):
+    # ip is an address the resolver already checked, either IPv4 or IPv6
+    if ':' in common.to_str(ip):
+        return socket.AF_INET6
+    return socket.AF_INET
+
+
+def normalize_server(server):
+    # a nameserver from resolv.conf in the form recvfrom returns it, so that
+    # the answers can be matched with it, or None if it is not an IP.
+    # a link-local IPv6 one keeps its %interface
+    server = common.to_str(server)
+    address, sep, scope = server.partition('%')
+    af = common.is_ip(address)
+    if not af or sep and af != socket.AF_INET6:
+        return None
+    return socket.inet_ntop(af, socket.inet_pton(af, address)) + sep + scope
+
+
 def is_valid_hostname(hostname):
     if len(hostname) > 255:
         return False
@@ -251,33 +331,246 @@ def is_valid_hostname(hostname):
     return all(VALID_HOSTNAME.match(x) for x in hostname.split(b'.'))
 
 
+# dns_cache_file, a header of DNS_CACHE_MAGIC followed by records of
+#   expire(I) hostname_len(B) hostname count(B) [family(B) packed ip] * count
+# where family is 4 or 6. a count of 0 is a hostname without an address
+
+def load_cache_file(path):
+    # returns {hostname: (addrs, expire)} of the entries that did not expire
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data:
+        return {}
+    if data[:len(DNS_CACHE_MAGIC)] != DNS_CACHE_MAGIC:
+        raise Exception('not a dns cache file')
+    now = time.time()
+    entries = {}
+    offset = len(DNS_CACHE_MAGIC)
+    while offset < len(data):
+        expire, hostname_len = struct.unpack_from('!IB', data, offset)
+        offset += 5
+        hostname = data[offset:offset + hostname_len]
+        offset += hostname_len
+        count = common.ord(data[offset])
+        offset += 1
+        addrs = []
+        for i in range(count):
+            if common.ord(data[offset]) == 6:
+                af, size = socket.AF_INET6, 16
+            else:
+                af, size = socket.AF_INET, 4
+            ip = socket.inet_ntop(af, data[offset + 1:offset + 1 + size])
+            offset += 1 + size
+            addrs.append((af, ip))
+        if offset > len(data):
+            raise Exception('dns cache file truncated')
+        if expire > now:
+            entries[hostname] = (addrs, expire)
+    return entries
+
+
+def save_cache_file(path, entries):
+    # entries is {hostname: (addrs, expire)}, the file is replaced at once
+    # so that a reader never sees half of it
+    results = [DNS_CACHE_MAGIC]
+    for hostname, (addrs, expire) in entries.items():
+        if len(hostname) > 255:
+            continue
+        addrs = addrs[:255]
+        results.append(struct.pack('!IB', int(expire), len(hostname)))
+        results.append(hostname)
+        results.append(common.chr(len(addrs)))
+        for af, ip in addrs:
+            if af == socket.AF_INET6:
+                results.append(common.chr(6))
+            else:
+                results.append(common.chr(4))
+            results.append(socket.inet_pton(af, common.to_str(ip)))
+    tmp_path = '%s.%d' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(b''.join(results))
+    os.rename(tmp_path, path)
+
+
+def lock_cache_file(path):
+    # an exclusive lock on path.lock, held until the returned file is
+    # closed, or None where there is no fcntl
+    try:
+        import fcntl
+    except ImportError:
+        return None
+    f = open(path + '.lock', 'ab')
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    except:
+        f.close()
+        raise
+    return f
+
+
 class DNSResponse(object):
     def __init__(self):
+        self.id = None
+        self.rcode = None
         self.hostname = None
         self.questions = []  # each: (addr, type, class)
-        self.answers = []  # each: (addr, type, class)
+        # each: (addr, type, class, ttl), addr is None unless A or AAAA
+        self.answers = []
+        self.negative_ttl = None
+        self.truncated = False
 
     def __str__(self):
         return '%s: %s' % (self.hostname, str(self.answers))
 
 
-STATUS_IPV4 = 0
-STATUS_IPV6 = 1
+class DNSQuery(object):
+    # the A and AAAA queries in flight for a hostname, they are sent together
+    # to one server at a time and sent again, to the next server, when the
+    # timer fires
+
+    def __init__(self, hostname):
+        self.hostname = hostname
+        # qtype: request id, for the types that are not answered yet
+        self.pending = {}
+        # the types that were truncated over UDP and are asked over TCP
+        self.tcp = set()
+        self.addrs = []  # (address family, ip) of the answers so far
+        self.ttl = DNS_MAX_TTL
+        self.negative_ttl = None
+        self.server = None
+        self.sent_time = 0
+        self.retries = 0
+        self.timer = None
+        # set once the first address arrived, the query then only waits a
+        # short time for the other type
+        self.delayed = False
+
+
+def sort_addrs(addrs):
+    # rfc8305, the preferred family first and then alternating, so that a
+    # connection attempt to the other family is never far behind
+    if IPV6_CONNECTION_SUPPORT:
+        preferred = socket.AF_INET6
+    else:
+        preferred = socket.AF_INET
+    first = []
+    second = []
+    for addr in addrs:
+        if addr in first or addr in second:
+            continue
+        if addr[0] == preferred:
+            first.append(addr)
+        else:
+            second.append(addr)
+    result = []
+    for i in range(max(len(first), len(second))):
+        if i < len(first):
+            result.append(first[i])
+        if i < len(second):
+            result.append(second[i])
+    return result
+
+
+class DNSTCPConnection(object):
+    # a TCP connection to a nameserver, kept for later queries. requests are
+    # sent one after another without waiting for the answers, which come
+    # back in any order and are matched by their id like the UDP ones
+    #
+    # rfc1035 4.2.2, every message is prefixed with its length
+
+    def __init__(self, server, port=53):
+        self.server = server
+        self.sock = socket.socket(ip_family(server), socket.SOCK_STREAM,
+                                  socket.SOL_TCP)
+        self.sock.setblocking(False)
+        self.connected = False
+        self.last_activity = time.time()
+        self._send_queue = common.WriteQueue()
+        self._recv_buf = b''
+        try:
+            self.sock.connect((server, port))
+        except (OSError, IOError) as e:
+            if eventloop.errno_from_exception(e) not in \
+                    (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                self.sock.close()
+                raise
+
+    def send(self, req):
+        self._send_queue.append(struct.pack('!H', len(req)))
+        self._send_queue.append(req)
+        self.last_activity = time.time()
+        if self.connected:
+            self.flush()
+
+    def flush(self):
+        # returns True when everything is sent
+        try:
+            self._send_queue.send(self.sock)
+        except (OSError, IOError) as e:
+            if eventloop.errno_from_exception(e) not in \
+                    (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        return not self._send_queue
+
+    def on_writable(self):
+        if not self.connected:
+            error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                raise socket.error(error, os.strerror(error))
+            self.connected = True
+        return self.flush()
+
+    def on_readable(self):
+        # returns the complete messages, raises once the server closed it
+        data = self.sock.recv(65536)
+        if not data:
+            raise socket.error(errno.ECONNRESET, 'closed by the nameserver')
+        self.last_activity = time.time()
+        buf = self._recv_buf + data
+        messages = []
+        offset = 0
+        while len(buf) - offset >= 2:
+            length = struct.unpack('!H', buf[offset:offset + 2])[0]
+            if len(buf) - offset - 2 < length:
+                break
+            messages.append(buf[offset + 2:offset + 2 + length])
+            offset += 2 + length
+        self._recv_buf = buf[offset:]
+        return messages
+
+    def close(self):
+        self.sock.close()
 
 
 class DNSResolver(object):
 
-    def __init__(self):
+    def __init__(self, cache_file=None, shared_cache=None):
         self._loop = None
         self._hosts = {}
-        self._hostname_status = {}
         self._hostname_to_cb = {}
         self._cb_to_hostname = {}
-        self._cache = lru_cache.LRUCache(timeout=300)
-        self._sock = None
+        # hostname: (ip, expire time), ip is None for a negative answer
+        self._cache = lru_cache.LRUCache(timeout=DNS_MAX_TTL)
+        self._queries = {}  # hostname: DNSQuery
+        self._waiting = collections.deque()
+        self._server_rtt = {}  # server: smoothed RTT
+        self._tcp_conns = {}  # server: DNSTCPConnection
+        # servers that answered FORMERR to EDNS, they are asked without it
+        self._no_edns = set()
+        self._socks = {}  # UDP socket: address family
+        self._family_socks = {}  # address family: [UDP socket]
         self._servers = None
+        self._cache_file = cache_file
+        # a shared_dns.SharedDNSCache, so that a hostname one worker resolved
+        # is not resolved again by the others
+        self._shared_cache = shared_cache
+        self._cache_dirty = False
+        self._cache_saved = time.time()
+        self._closed = False
         self._parse_resolv()
         self._parse_hosts()
+        if cache_file:
+            self._load_cache()
         # TODO monitor hosts change and reload hosts
         # TODO parse /etc/gai.conf and follow its rules
 
@@ -292,10 +585,8 @@ class DNSResolver(object):
                         if line.startswith(b'nameserver'):
                             parts = line.split()
                             if len(parts) >= 2:
-                                server = parts[1]
-                                if common.is_ip(server) == socket.AF_INET:
-                                    if type(server) != str:
-                                        server = server.decode('utf8')
+                                server = normalize_server(parts[1])
+                                if server:
                                     self._servers.append(server)
         except IOError:
             pass
@@ -321,92 +612,338 @@ class DNSResolver(object):
         except IOError:
             self._hosts['localhost'] = '127.0.0.1'
 
+    def _load_cache(self):
+        # done before the workers are forked, so all of them start with the
+        # entries of the last run
+        try:
+            entries = load_cache_file(self._cache_file)
+        except (OSError, IOError):
+            return
+        except Exception as e:
+            logging.warn('ignore dns cache file %s: %s' %
+                         (self._cache_file, e))
+            return
+        for hostname, entry in entries.items():
+            self._cache[hostname] = entry
+        logging.info('loaded %d dns cache entries' % len(entries))
+
+    def save_cache(self):
+        # the workers share one file, every worker adds its entries to the
+        # ones the others saved. the file is read and replaced under a lock,
+        # or two workers saving at once would drop the entries of one
+        now = time.time()
+        lock = None
+        try:
+            lock = lock_cache_file(self._cache_file)
+            try:
+                entries = load_cache_file(self._cache_file)
+            except Exception:
+                entries = {}
+            for hostname in self._cache:
+                entry = self._cache.peek(hostname)
+                if entry[1] > now and (hostname not in entries or
+                                       entries[hostname][1] < entry[1]):
+                    entries[hostname] = entry
+            save_cache_file(self._cache_file, entries)
+        except (OSError, IOError) as e:
+            logging.warn('save dns cache file %s: %s' % (self._cache_file, e))
+        finally:
+            if lock:
+                lock.close()
+        self._cache_dirty = False
+        self._cache_saved = now
+
     def add_to_loop(self, loop):
         if self._loop:
             raise Exception('already add to loop')
         self._loop = loop
-        # TODO when dns server is IPv6
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
-                                   socket.SOL_UDP)
-        self._sock.setblocking(False)
-        loop.add(self._sock, eventloop.POLL_IN, self)
+        for af in set(ip_family(server) for server in self._servers):
+            try:
+                self._get_sock(af)
+            except (OSError, IOError) as e:
+                # e.g. an IPv6 nameserver on a host without IPv6, the
+                # queries sent to it are lost and go to the others
+                logging.warn('create dns socket: %s' % e)
         loop.add_periodic(self.handle_periodic)
 
-    def _call_callback(self, hostname, ip, error=None):
-        callbacks = self._hostname_to_cb.get(hostname, [])
+    def _create_sock(self, af):
+        sock = socket.socket(af, socket.SOCK_DGRAM, socket.SOL_UDP)
+        sock.setblocking(False)
+        self._loop.add(sock, eventloop.POLL_IN, self)
+        self._socks[sock] = af
+        self._family_socks.setdefault(af, []).append(sock)
+        return sock
+
+    def _close_sock(self, sock):
+        af = self._socks.pop(sock)
+        self._family_socks[af].remove(sock)
+        self._loop.remove(sock)
+        sock.close()
+
+    def _get_sock(self, af):
+        # a random socket of the family, created the first time it is used
+        socks = self._family_socks.get(af, None)
+        if not socks:
+            for i in range(DNS_SOCKETS_PER_FAMILY):
+                self._create_sock(af)
+            socks = self._family_socks[af]
+        return random.choice(socks)
+
+    def _call_callback(self, hostname, addrs, error=None):
+        # addrs is a list of (address family, ip), empty if the hostname has
+        # no address
+        callbacks = self._hostname_to_cb.pop(hostname, [])
         for callback in callbacks:
             if callback in self._cb_to_hostname:
                 del self._cb_to_hostname[callback]
-            if ip or error:
-                callback((hostname, ip), error)
+            if addrs:
+                callback((hostname, addrs[0][1], addrs[0][0], addrs), error)
+            elif error:
+                callback((hostname, None, None, []), error)
             else:
-                callback((hostname, None),
+                callback((hostname, None, None, []),
                          Exception('unknown hostname %s' % hostname))
-        if hostname in self._hostname_to_cb:
-            del self._hostname_to_cb[hostname]
-        if hostname in self._hostname_status:
-            del self._hostname_status[hostname]
 
-    def _handle_data(self, data):
-        response = parse_response(data)
-        if response and response.hostname:
-            hostname = response.hostname
-            ip = None
-            for answer in response.answers:
-                if answer[1] in (QTYPE_A, QTYPE_AAAA) and \
-                        answer[2] == QCLASS_IN:
-                    ip = answer[0]
+    def _pick_server(self, query):
+        # the server with the lowest smoothed RTT, a query that is sent
+        # again goes to another server if there is one
+        servers = self._servers
+        if query.server is not None and len(servers) > 1:
+            servers = [s for s in servers if s != query.server]
+        return min(servers,
+                   key=lambda s: self._server_rtt.get(s, DNS_INITIAL_RTT))
+
+    def _update_rtt(self, server, rtt):
+        srtt = self._server_rtt.get(server, None)
+        if srtt is None:
+            self._server_rtt[server] = rtt
+        else:
+            self._server_rtt[server] = srtt * 7 / 8 + rtt / 8
+
+    def _penalize(self, server):
+        srtt = self._server_rtt.get(server, DNS_INITIAL_RTT)
+        self._server_rtt[server] = min(max(srtt, DNS_TIMEOUT) * 2,
+                                       DNS_MAX_RTT)
+
+    def _start_query(self, hostname):
+        if len(self._queries) >= DNS_MAX_INFLIGHT:
+            self._waiting.append(hostname)
+            return
+        query = DNSQuery(hostname)
+        # the ids stay the same when the query is sent again, so a late
+        # answer to an earlier attempt is still accepted
+        for qtype in (QTYPE_AAAA, QTYPE_A):
+            while True:
+                request_id = struct.unpack('!H', os.urandom(2))[0]
+                if request_id not in query.pending.values():
                     break
-            if IPV6_CONNECTION_SUPPORT:
-                if not ip and self._hostname_status.get(hostname, STATUS_IPV4) \
-                        == STATUS_IPV6:
-                    self._hostname_status[hostname] = STATUS_IPV4
-                    self._send_req(hostname, QTYPE_A)
-                else:
-                    if ip:
-                        self._cache[hostname] = ip
-                        self._call_callback(hostname, ip)
-                    elif self._hostname_status.get(hostname, None) == STATUS_IPV4:
-                        for question in response.questions:
-                            if question[1] == QTYPE_A:
-                                self._call_callback(hostname, None)
-                                break
+            query.pending[qtype] = request_id
+        self._queries[hostname] = query
+        self._send_query(query)
+
+    def _send_request(self, query, qtype, server):
+        req = build_request(query.hostname, qtype, query.pending[qtype],
+                            server not in self._no_edns)
+        logging.debug('resolving %s with type %d using server %s',
+                      query.hostname, qtype, server)
+        try:
+            if qtype in query.tcp:
+                self._send_tcp(server, req)
+            else:
+                self._get_sock(ip_family(server)).sendto(req, (server, 53))
+        except (OSError, IOError) as e:
+            # handled like a lost packet, the timer sends it again
+            logging.warn('send dns query to %s: %s' % (server, e))
+
+    def _send_tcp(self, server, req):
+        conn = self._tcp_conns.get(server, None)
+        if conn is None:
+            conn = DNSTCPConnection(server)
+            self._tcp_conns[server] = conn
+            self._loop.add(conn.sock, eventloop.POLL_OUT | eventloop.POLL_ERR,
+                           self)
+        conn.send(req)
+        if conn.connected:
+            self._loop.modify(conn.sock, eventloop.POLL_IN | eventloop.POLL_OUT
+                              | eventloop.POLL_ERR)
+
+    def _close_tcp(self, conn):
+        del self._tcp_conns[conn.server]
+        self._loop.remove(conn.sock)
+        conn.close()
+
+    def _send_query(self, query):
+        query.server = self._pick_server(query)
+        query.sent_time = time.time()
+        for qtype in query.pending:
+            self._send_request(query, qtype, query.server)
+        query.timer = self._loop.call_later(
+            DNS_TIMEOUT * (2 ** query.retries), self._on_timeout, query)
+
+    def _retry(self, query):
+        query.retries += 1
+        if query.retries > DNS_MAX_RETRIES:
+            if query.addrs:
+                self._finish_query(query)
+                return
+            self._finish_query(query, Exception(
+                'resolving %s timed out' % common.to_str(query.hostname)))
+        else:
+            self._send_query(query)
+
+    def _on_timeout(self, query):
+        query.timer = None
+        if self._queries.get(query.hostname) is not query:
+            return
+        if query.delayed:
+            # the other type did not come in time, go with what we have
+            self._finish_query(query)
+            return
+        self._penalize(query.server)
+        self._retry(query)
+
+    def _end_query(self, query):
+        if query.timer:
+            self._loop.cancel(query.timer)
+            query.timer = None
+        del self._queries[query.hostname]
+        while self._waiting and len(self._queries) < DNS_MAX_INFLIGHT:
+            hostname = self._waiting.popleft()
+            # callers may have gone away while the hostname was waiting
+            if hostname in self._hostname_to_cb and \
+                    hostname not in self._queries:
+                self._start_query(hostname)
+
+    def _finish_query(self, query, error=None):
+        self._end_query(query)
+        addrs = sort_addrs(query.addrs)
+        now = time.time()
+        entry = None
+        if addrs:
+            entry = (addrs, now + max(query.ttl, DNS_MIN_TTL))
+        elif not error:
+            ttl = query.negative_ttl
+            if ttl is None:
+                ttl = DNS_NEGATIVE_TTL
+            ttl = min(ttl, DNS_MAX_NEGATIVE_TTL)
+            if ttl > 0:
+                entry = ([], now + ttl)
+        if entry:
+            self._cache[query.hostname] = entry
+            self._cache_dirty = True
+            if self._shared_cache:
+                self._shared_cache.put(query.hostname, entry[0], entry[1])
+        self._call_callback(query.hostname, addrs, error)
+
+    def _handle_data(self, data, server):
+        response = parse_response(data)
+        if not response or not response.hostname:
+            return
+        query = self._queries.get(response.hostname, None)
+        if query is None:
+            return
+        qtype = None
+        for pending_qtype, request_id in query.pending.items():
+            if response.id == request_id:
+                qtype = pending_qtype
+                break
+        if qtype is None:
+            return
+        # an answer to a query that was sent again could belong to either
+        # attempt, so only the first attempt is measured
+        if server == query.server and query.retries == 0 and \
+                qtype not in query.tcp:
+            self._update_rtt(server, time.time() - query.sent_time)
+        if response.truncated:
+            if qtype not in query.tcp:
+                query.tcp.add(qtype)
+                self._send_request(query, qtype, server)
+            return
+        if response.rcode == RCODE_FORMERR and server not in self._no_edns:
+            logging.info('dns server %s does not support EDNS' % server)
+            self._no_edns.add(server)
+            self._send_request(query, qtype, server)
+            return
+        if response.rcode not in (RCODE_NOERROR, RCODE_NXDOMAIN):
+            # SERVFAIL, REFUSED and so on, ask another server
+            if not query.delayed:
+                self._loop.cancel(query.timer)
+                self._penalize(server)
+                self._retry(query)
+            return
+        del query.pending[qtype]
+        for answer in response.answers:
+            if answer[2] != QCLASS_IN:
+                continue
+            # a CNAME chain is only valid as long as all of its records
+            query.ttl = min(query.ttl, answer[3])
+            if answer[1] == QTYPE_A:
+                query.addrs.append((socket.AF_INET, answer[0]))
+            elif answer[1] == QTYPE_AAAA:
+                query.addrs.append((socket.AF_INET6, answer[0]))
+        if response.negative_ttl is not None:
+            if query.negative_ttl is None:
+                query.negative_ttl = response.negative_ttl
             else:
-                if not ip and self._hostname_status.get(hostname, STATUS_IPV6) \
-                        == STATUS_IPV4:
-                    self._hostname_status[hostname] = STATUS_IPV6
-                    self._send_req(hostname, QTYPE_AAAA)
-                else:
-                    if ip:
-                        self._cache[hostname] = ip
-                        self._call_callback(hostname, ip)
-                    elif self._hostname_status.get(hostname, None) == STATUS_IPV6:
-                        for question in response.questions:
-                            if question[1] == QTYPE_AAAA:
-                                self._call_callback(hostname, None)
-                                break
+                query.negative_ttl = min(query.negative_ttl,
+                                         response.negative_ttl)
+        if not query.pending or response.rcode == RCODE_NXDOMAIN and \
+                not query.addrs:
+            self._finish_query(query)
+        elif query.addrs and not query.delayed:
+            query.delayed = True
+            self._loop.cancel(query.timer)
+            query.timer = self._loop.call_later(DNS_RESOLUTION_DELAY,
+                                                self._on_timeout, query)
+
+    def _handle_tcp_event(self, conn, event):
+        try:
+            if event & eventloop.POLL_ERR:
+                raise eventloop.get_sock_error(conn.sock)
+            if event & eventloop.POLL_OUT:
+                if conn.on_writable():
+                    self._loop.modify(conn.sock,
+                                      eventloop.POLL_IN | eventloop.POLL_ERR)
+            if event & (eventloop.POLL_IN | eventloop.POLL_HUP):
+                for data in conn.on_readable():
+                    self._handle_data(data, conn.server)
+        except (OSError, IOError) as e:
+            # the queries on it are sent again when their timers fire
+            logging.warn('dns tcp connection to %s: %s' % (conn.server, e))
+            if self._tcp_conns.get(conn.server) is conn:
+                self._close_tcp(conn)
 
     def handle_event(self, sock, fd, event):
-        if sock != self._sock:
+        if sock not in self._socks:
+            for conn in list(self._tcp_conns.values()):
+                if conn.sock == sock:
+                    self._handle_tcp_event(conn, event)
+                    break
             return
         if event & eventloop.POLL_ERR:
             logging.error('dns socket err')
-            self._loop.remove(self._sock)
-            self._sock.close()
-            # TODO when dns server is IPv6
-            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
-                                       socket.SOL_UDP)
-            self._sock.setblocking(False)
-            self._loop.add(self._sock, eventloop.POLL_IN, self)
+            af = self._socks[sock]
+            self._close_sock(sock)
+            self._create_sock(af)
         else:
-            data, addr = sock.recvfrom(1024)
+            data, addr = sock.recvfrom(DNS_UDP_PAYLOAD_SIZE)
             if addr[0] not in self._servers:
                 logging.warn('received a packet other than our dns')
                 return
-            self._handle_data(data)
+            self._handle_data(data, addr[0])
 
     def handle_periodic(self):
+        if self._closed:
+            self.close()
+            return
         self._cache.sweep()
+        now = time.time()
+        for conn in list(self._tcp_conns.values()):
+            if now - conn.last_activity >= DNS_TCP_IDLE_TIMEOUT:
+                self._close_tcp(conn)
+        if self._cache_file and self._cache_dirty and \
+                time.time() - self._cache_saved >= DNS_CACHE_SAVE_INTERVAL:
+            self.save_cache()
 
     def remove_callback(self, callback):
         hostname = self._cb_to_hostname.get(callback)
@@ -417,69 +954,530 @@ class DNSResolver(object):
                 arr.remove(callback)
                 if not arr:
                     del self._hostname_to_cb[hostname]
-                    if hostname in self._hostname_status:
-                        del self._hostname_status[hostname]
+                    # nobody waits for the answer, stop sending the query
+                    query = self._queries.get(hostname, None)
+                    if query:
+                        self._end_query(query)
 
-    def _send_req(self, hostname, qtype):
-        req = build_request(hostname, qtype)
-        for server in self._servers:
-            logging.debug('resolving %s with type %d using server %s',
-                          hostname, qtype, server)
-            self._sock.sendto(req, (server, 53))
+    def _cache_lookup(self, hostname):
+        # returns the cached addrs, an empty list if the hostname has no
+        # address, or None if it is not cached
+        entry = self._cache.get(hostname, None)
+        if entry is not None and entry[1] <= time.time():
+            del self._cache[hostname]
+            entry = None
+        if entry is None and self._shared_cache:
+            entry = self._shared_cache.get(hostname)
+            if entry is not None:
+                self._cache[hostname] = entry
+        if entry is None:
+            return None
+        return entry[0]
 
     def resolve(self, hostname, callback):
+        # callback(result, error), result is
+        # (hostname, ip, address family, addrs) so that the caller can create
+        # its socket without getaddrinfo. addrs has all the (address family,
+        # ip) of the hostname, the two families interleaved, ip is the first
         if type(hostname) != bytes:
             hostname = hostname.encode('utf8')
+        family = common.is_ip(hostname)
         if not hostname:
             callback(None, Exception('empty hostname'))
-        elif common.is_ip(hostname):
-            callback((hostname, hostname), None)
+            return
+        elif family:
+            callback((hostname, hostname, family, [(family, hostname)]),
+                     None)
+            return
         elif hostname in self._hosts:
             logging.debug('hit hosts: %s', hostname)
             ip = self._hosts[hostname]
-            callback((hostname, ip), None)
-        elif hostname in self._cache:
+            family = ip_family(ip)
+            callback((hostname, ip, family, [(family, ip)]), None)
+            return
+        addrs = self._cache_lookup(hostname)
+        if addrs is not None:
             logging.debug('hit cache: %s', hostname)
-            ip = self._cache[hostname]
-            callback((hostname, ip), None)
+            if addrs:
+                callback((hostname, addrs[0][1], addrs[0][0], addrs), None)
+            else:
+                callback((hostname, None, None, []),
+                         Exception('unknown hostname %s' % hostname))
+        elif not is_valid_hostname(hostname):
+            callback(None, Exception('invalid hostname: %s' % hostname))
         else:
-            if not is_valid_hostname(hostname):
-                callback(None, Exception('invalid hostname: %s' % hostname))
-                return
-            if False:
-                addrs = socket.getaddrinfo(hostname, 0, 0,
-                                       socket.SOCK_DGRAM, socket.SOL_UDP)
-                if addrs:
-                    af, socktype, proto, canonname, sa = addrs[0]
-                    logging.debug('DNS resolve %s %s' % (hostname, sa[0]) )
-                    self._cache[hostname] = sa[0]
-                    callback((hostname, sa[0]), None)
-                    return
+            # later callers wait for the query in flight
             arr = self._hostname_to_cb.get(hostname, None)
+            self._cb_to_hostname[callback] = hostname
             if not arr:
-                if IPV6_CONNECTION_SUPPORT:
-                    self._hostname_status[hostname] = STATUS_IPV6
-                    self._send_req(hostname, QTYPE_AAAA)
-                else:
-                    self._hostname_status[hostname] = STATUS_IPV4
-                    self._send_req(hostname, QTYPE_A)
                 self._hostname_to_cb[hostname] = [callback]
-                self._cb_to_hostname[callback] = hostname
+                self._start_query(hostname)
             else:
                 arr.append(callback)
-                # TODO send again only if waited too long
-                if IPV6_CONNECTION_SUPPORT:
-                    self._send_req(hostname, QTYPE_AAAA)
-                else:
-                    self._send_req(hostname, QTYPE_A)
+
+    def close(self, next_tick=False):
+        # with next_tick it is closed by the next handle_periodic, like the
+        # relays, so a signal handler can ask for it. what was resolved
+        # since the last save is kept for the next run
+        if next_tick and self._loop:
+            self._closed = True
+            return
+        if self._cache_file and self._cache_dirty:
+            self.save_cache()
+        for query in self._queries.values():
+            if query.timer:
+                self._loop.cancel(query.timer)
+                query.timer = None
+        self._queries = {}
+        self._waiting.clear()
+        for conn in list(self._tcp_conns.values()):
+            self._close_tcp(conn)
+        if self._loop:
+            self._loop.remove_periodic(self.handle_periodic)
+            for sock in list(self._socks.keys()):
+                self._close_sock(sock)
+            self._loop = None
+
+
+class ResolveQueue(object):
+    # items, e.g. datagrams, waiting for their hostname to be resolved
+    #
+    # only the first item of a hostname starts a query, the rest are held
+    # until callback(hostname, addr, items, error) is called with all of
+    # them. addr is (address family, ip), None if the hostname could not be
+    # resolved
+
+    def __init__(self, dns_resolver, callback, max_items=64):
+        self._dns_resolver = dns_resolver
+        self._callback = callback
+        self._max_items = max_items
+        self._pending = {}  # hostname: (resolve callback, start time, items)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, hostname, item):
+        pending = self._pending.get(hostname, None)
+        if pending is not None:
+            items = pending[2]
+            if len(items) < self._max_items:
+                items.append(item)
+            else:
+                logging.debug('too many items waiting for %s, drop' %
+                              common.to_str(hostname))
+            return
+
+        def on_resolved(result, error):
+            self._on_resolved(hostname, result, error)
+        self._pending[hostname] = (on_resolved, time.time(), [item])
+        # may call on_resolved before it returns
+        self._dns_resolver.resolve(hostname, on_resolved)
+
+    def _on_resolved(self, hostname, result, error):
+        pending = self._pending.pop(hostname, None)
+        if pending is None:
+            return
+        addr = None
+        if result and result[1] and not error:
+            addr = (result[2], common.to_str(result[1]))
+        self._callback(hostname, addr, pending[2], error)
+
+    def sweep(self, timeout):
+        # drop the items of queries that got no answer in time
+        now = time.time()
+        for hostname, pending in list(self._pending.items()):
+            if now - pending[1] >= timeout:
+                del self._pending[hostname]
+                self._dns_resolver.remove_callback(pending[0])
+                logging.debug('resolving %s timed out, drop %d items' %
+                              (common.to_str(hostname), len(pending[2])))
 
     def close(self):
-        if self._sock:
-            if self._loop:
-                self._loop.remove_periodic(self.handle_periodic)
-                self._loop.remove(self._sock)
-            self._sock.close()
-            self._sock = None
+        for pending in self._pending.values():
+            self._dns_resolver.remove_callback(pending[0])
+        self._pending = {}
+
+
+def test_resolve_queue():
+    dns_resolver = DNSResolver()
+    loop = eventloop.EventLoop()
+    dns_resolver.add_to_loop(loop)
+    # the queries are not answered, answers are passed in by hand
+    dns_resolver._servers = ['127.0.0.1']
+    results = []
+
+    def callback(hostname, addr, items, error):
+        results.append((hostname, addr, items))
+
+    queue = ResolveQueue(dns_resolver, callback, max_items=2)
+    # an IP address is answered before add returns
+    queue.add(b'127.0.0.1', 1)
+    assert results == [(b'127.0.0.1', (socket.AF_INET, '127.0.0.1'), [1])]
+    assert len(queue) == 0
+
+    queue.add(b'example.com', 1)
+    queue.add(b'example.com', 2)
+    queue.add(b'example.com', 3)
+    assert len(queue) == 1
+    dns_resolver._call_callback(b'example.com',
+                                [(socket.AF_INET6, '2001:db8::1')])
+    assert results[-1] == (b'example.com', (socket.AF_INET6, '2001:db8::1'),
+                           [1, 2])
+    assert len(queue) == 0
+
+    queue.add(b'example.org', 1)
+    queue.sweep(0)
+    assert len(queue) == 0
+    assert b'example.org' not in dns_resolver._hostname_to_cb
+    dns_resolver.close()
+
+
+def build_test_response(request_id, hostname, rcode=0, answers=(),
+                        soa_ttl=None):
+    # answers are (qtype, rdata, ttl) of hostname
+    header = struct.pack('!HBBHHHH', request_id, 0x81, 0x80 | rcode, 1,
+                         len(answers), 1 if soa_ttl is not None else 0, 0)
+    results = [header, build_address(hostname),
+               struct.pack('!HH', QTYPE_A, QCLASS_IN)]
+    for qtype, rdata, ttl in answers:
+        results.append(b'\xc0\x0c')
+        results.append(struct.pack('!HHiH', qtype, QCLASS_IN, ttl,
+                                   len(rdata)))
+        results.append(rdata)
+    if soa_ttl is not None:
+        rdata = b'\x00\x00' + struct.pack('!IIIII', 1, 2, 3, 4, soa_ttl)
+        results.append(b'\xc0\x0c')
+        results.append(struct.pack('!HHiH', QTYPE_SOA, QCLASS_IN, 3600,
+                                   len(rdata)))
+        results.append(rdata)
+    return b''.join(results)
+
+
+def test_parse_response():
+    # a CNAME to a name that points into the question, then its address
+    data = build_test_response(1, b'www.example.com')
+    data = data[:6] + b'\x00\x02' + data[8:]
+    data += b'\xc0\x0c' + struct.pack('!HHiH', QTYPE_CNAME, QCLASS_IN, 300, 6)
+    data += b'\x03cdn\xc0\x10'
+    data += b'\x03cdn\xc0\x10' + struct.pack('!HHiH', QTYPE_A, QCLASS_IN, 20, 4)
+    data += b'\x7f\x00\x00\x02'
+    response = parse_response(data)
+    assert response.hostname == b'www.example.com'
+    assert response.answers == [(None, QTYPE_CNAME, QCLASS_IN, 300),
+                                ('127.0.0.2', QTYPE_A, QCLASS_IN, 20)]
+    assert parse_name(data, len(data) - 20) == (6, b'cdn.example.com')
+
+    response = parse_response(build_test_response(
+        2, b'nx.example.com', rcode=RCODE_NXDOMAIN, soa_ttl=20))
+    assert response.rcode == RCODE_NXDOMAIN and response.negative_ttl == 20
+
+    # a pointer to itself is rejected instead of looping
+    data = struct.pack('!HBBHHHH', 3, 0x81, 0x80, 1, 0, 0, 0) + \
+        b'\xc0\x0c' + struct.pack('!HH', QTYPE_A, QCLASS_IN)
+    assert parse_response(data) is None
+    assert parse_response(data[:14]) is None
+
+
+def test_resolver():
+    from shadowsocks import shared_dns
+
+    shared_cache = shared_dns.SharedDNSCache(2, slots=16)
+    dns_resolver = DNSResolver(shared_cache=shared_cache)
+    loop = eventloop.EventLoop()
+    dns_resolver.add_to_loop(loop)
+    # the queries are not answered, answers are passed in by hand
+    dns_resolver._servers = ['127.0.0.1', '127.0.0.2']
+    results = []
+
+    def callback(result, error):
+        results.append((result, error))
+
+    def answer(hostname, qtype, server=None, **kwargs):
+        query = dns_resolver._queries[hostname]
+        dns_resolver._handle_data(build_test_response(
+            query.pending[qtype], hostname, **kwargs), server or query.server)
+
+    # A and AAAA are asked together, the second caller waits for them
+    dns_resolver.resolve(b'example.com', callback)
+    dns_resolver.resolve(b'example.com', callback)
+    assert len(dns_resolver._queries) == 1
+    query = dns_resolver._queries[b'example.com']
+    assert sorted(query.pending.keys()) == [QTYPE_A, QTYPE_AAAA]
+    dns_resolver._handle_data(build_test_response(
+        query.pending[QTYPE_A] ^ 1, b'example.com',
+        answers=[(QTYPE_A, b'\x7f\x00\x00\x02', 60)]), query.server)
+    assert not results
+    answer(b'example.com', QTYPE_A,
+           answers=[(QTYPE_A, b'\x7f\x00\x00\x02', 60),
+                    (QTYPE_A, b'\x7f\x00\x00\x03', 90)])
+    # the other type is waited for a short time
+    assert not results and query.delayed
+    answer(b'example.com', QTYPE_AAAA,
+           answers=[(QTYPE_AAAA, b'\x00' * 15 + b'\x01', 120)])
+    assert len(results) == 2
+    addrs = [(socket.AF_INET, '127.0.0.2'), (socket.AF_INET6, '::1'),
+             (socket.AF_INET, '127.0.0.3')]
+    if IPV6_CONNECTION_SUPPORT:
+        addrs = [addrs[1], addrs[0], addrs[2]]
+    assert results[0] == ((b'example.com', addrs[0][1], addrs[0][0], addrs),
+                          None)
+    assert not dns_resolver._queries
+    assert query.server in dns_resolver._server_rtt
+    expire = dns_resolver._cache[b'example.com'][1]
+    assert 55 < expire - time.time() <= 60
+
+    # answered from the cache until the TTL expires
+    dns_resolver.resolve(b'example.com', callback)
+    assert len(results) == 3 and not dns_resolver._queries
+    dns_resolver._cache[b'example.com'] = (addrs, time.time() - 1)
+    shared_cache.put(b'example.com', addrs, time.time() - 1)
+    dns_resolver.resolve(b'example.com', callback)
+    assert len(results) == 3 and len(dns_resolver._queries) == 1
+    dns_resolver.remove_callback(callback)
+    assert not dns_resolver._queries
+
+    # without the other type in time, the addresses so far are used
+    results = []
+    dns_resolver.resolve(b'v4.example.com', callback)
+    query = dns_resolver._queries[b'v4.example.com']
+    answer(b'v4.example.com', QTYPE_A,
+           answers=[(QTYPE_A, b'\x7f\x00\x00\x02', 60)])
+    loop.cancel(query.timer)
+    dns_resolver._on_timeout(query)
+    assert results[0][0][1:3] == ('127.0.0.2', socket.AF_INET)
+
+    # the other workers get it from the shared cache without a query
+    shared_cache.set_worker(1)
+    other = DNSResolver(shared_cache=shared_cache)
+    other.resolve(b'v4.example.com', callback)
+    assert results[1][0][1:3] == ('127.0.0.2', socket.AF_INET)
+    shared_cache.set_worker(0)
+
+    # NXDOMAIN is cached for the SOA minimum
+    results = []
+    dns_resolver.resolve(b'nx.example.com', callback)
+    answer(b'nx.example.com', QTYPE_AAAA, rcode=RCODE_NXDOMAIN, soa_ttl=20)
+    assert results[0][0] == (b'nx.example.com', None, None, [])
+    assert results[0][1] is not None
+    expire = dns_resolver._cache[b'nx.example.com'][1]
+    assert 15 < expire - time.time() <= 20
+    dns_resolver.resolve(b'nx.example.com', callback)
+    assert len(results) == 2 and results[1][1] is not None
+    assert not dns_resolver._queries
+
+    # SERVFAIL and timeouts move on to the other server
+    results = []
+    dns_resolver.resolve(b'slow.example.com', callback)
+    query = dns_resolver._queries[b'slow.example.com']
+    first_server = query.server
+    answer(b'slow.example.com', QTYPE_A, rcode=2)
+    assert query.retries == 1 and query.server != first_server
+    for i in range(DNS_MAX_RETRIES):
+        loop.cancel(query.timer)
+        dns_resolver._on_timeout(query)
+    assert results[0][0] == (b'slow.example.com', None, None, [])
+    assert b'slow.example.com' not in dns_resolver._cache
+    assert not dns_resolver._queries
+    dns_resolver.close()
+    shared_cache.close()
+
+
+def test_tcp_fallback():
+    import threading
+
+    req = build_request(b'example.com', QTYPE_A, 1, edns=True)
+    assert HEADER_STRUCT.unpack_from(req)[6] == 1
+    assert req[-11:] == b'\0\0\x29\x04\xd0\0\0\0\0\0\0'
+
+    # a nameserver that answers the pipelined requests in reverse order and
+    # splits the answers across reads
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+
+    def serve():
+        conn, addr = listener.accept()
+        reqs = []
+        buf = b''
+        while len(reqs) < 2:
+            buf += conn.recv(4096)
+            while len(buf) >= 2 and \
+                    len(buf) - 2 >= struct.unpack('!H', buf[:2])[0]:
+                length = struct.unpack('!H', buf[:2])[0]
+                reqs.append(buf[2:2 + length])
+                buf = buf[2 + length:]
+        results = []
+        for req in reversed(reqs):
+            request_id = struct.unpack('!H', req[:2])[0]
+            qtype = parse_response(req).questions[0][1]
+            if qtype == QTYPE_A:
+                answer = (QTYPE_A, b'\x7f\x00\x00\x02', 60)
+            else:
+                answer = (QTYPE_AAAA, b'\x00' * 15 + b'\x01', 60)
+            data = build_test_response(request_id, b'big.example.com',
+                                       answers=[answer])
+            results.append(struct.pack('!H', len(data)) + data)
+        data = b''.join(results)
+        conn.sendall(data[:5])
+        time.sleep(0.05)
+        conn.sendall(data[5:])
+        time.sleep(0.5)
+        conn.close()
+    thread = threading.Thread(target=serve)
+    thread.start()
+
+    dns_resolver = DNSResolver()
+    loop = eventloop.EventLoop()
+    dns_resolver.add_to_loop(loop)
+    dns_resolver._servers = ['127.0.0.1']
+    conn = DNSTCPConnection('127.0.0.1', listener.getsockname()[1])
+    dns_resolver._tcp_conns['127.0.0.1'] = conn
+    loop.add(conn.sock, eventloop.POLL_OUT | eventloop.POLL_ERR,
+             dns_resolver)
+    results = []
+
+    def callback(result, error):
+        results.append((result, error))
+        loop.stop()
+
+    dns_resolver.resolve(b'big.example.com', callback)
+    query = dns_resolver._queries[b'big.example.com']
+    for qtype in (QTYPE_A, QTYPE_AAAA):
+        data = bytearray(build_test_response(query.pending[qtype],
+                                             b'big.example.com'))
+        data[2] |= 2
+        dns_resolver._handle_data(bytes(data), '127.0.0.1')
+    assert query.tcp == set([QTYPE_A, QTYPE_AAAA])
+    loop.call_later(5, loop.stop)
+    loop.run()
+    thread.join()
+    listener.close()
+    assert sorted(results[0][0][3]) == [(socket.AF_INET, '127.0.0.2'),
+                                        (socket.AF_INET6, '::1')]
+    dns_resolver.close()
+
+
+
+def test_ipv6_server():
+    import threading
+
+    assert normalize_server(b'8.8.8.8') == '8.8.8.8'
+    assert normalize_server(b'2001:4860:4860:0:0:0:0:8888') == \
+        '2001:4860:4860::8888'
+    assert normalize_server(b'fe80::1%eth0') == 'fe80::1%eth0'
+    assert normalize_server(b'127.0.0.1%eth0') is None
+    assert normalize_server(b'resolver.example.com') is None
+
+    try:
+        nameserver = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        nameserver.bind(('::1', 53))
+    except (OSError, IOError):
+        # no IPv6, or not allowed to bind port 53
+        return
+    nameserver.settimeout(5)
+
+    def serve():
+        for i in range(2):
+            req, addr = nameserver.recvfrom(512)
+            request_id = struct.unpack('!H', req[:2])[0]
+            qtype = parse_response(req).questions[0][1]
+            if qtype == QTYPE_A:
+                answers = [(QTYPE_A, b'\x7f\x00\x00\x02', 60)]
+            else:
+                answers = []
+            nameserver.sendto(build_test_response(
+                request_id, b'v6.example.com', answers=answers), addr)
+    thread = threading.Thread(target=serve)
+    thread.start()
+
+    dns_resolver = DNSResolver()
+    dns_resolver._servers = ['::1']
+    loop = eventloop.EventLoop()
+    dns_resolver.add_to_loop(loop)
+    assert len(dns_resolver._family_socks[socket.AF_INET6]) == \
+        DNS_SOCKETS_PER_FAMILY
+    assert socket.AF_INET not in dns_resolver._family_socks
+    results = []
+
+    def callback(result, error):
+        results.append((result, error))
+        loop.stop()
+
+    dns_resolver.resolve(b'v6.example.com', callback)
+    loop.call_later(5, loop.stop)
+    loop.run()
+    thread.join()
+    nameserver.close()
+    assert results[0][0][3] == [(socket.AF_INET, '127.0.0.2')]
+    dns_resolver.close()
+    assert not dns_resolver._socks
+
+
+def test_cache_file():
+    import tempfile
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        now = time.time()
+        dns_resolver = DNSResolver(path)
+        dns_resolver._cache[b'example.com'] = (
+            [(socket.AF_INET6, '2001:db8::1'), (socket.AF_INET, '127.0.0.2')],
+            now + 60)
+        dns_resolver._cache[b'nx.example.com'] = ([], now + 30)
+        dns_resolver._cache[b'old.example.com'] = (
+            [(socket.AF_INET, '127.0.0.3')], now - 1)
+        dns_resolver.save_cache()
+
+        # another worker adds its entries to the file
+        other = DNSResolver(path)
+        assert other._cache.peek(b'example.com')[0] == \
+            [(socket.AF_INET6, '2001:db8::1'), (socket.AF_INET, '127.0.0.2')]
+        assert other._cache.peek(b'nx.example.com')[0] == []
+        assert b'old.example.com' not in other._cache
+        other._cache[b'example.org'] = ([(socket.AF_INET, '127.0.0.4')],
+                                        now + 60)
+        other.save_cache()
+
+        entries = load_cache_file(path)
+        assert sorted(entries.keys()) == [b'example.com', b'example.org',
+                                          b'nx.example.com']
+        assert int(entries[b'example.com'][1]) == int(now + 60)
+
+        # close() saves what was resolved since the last save
+        other._cache[b'example.net'] = ([(socket.AF_INET, '127.0.0.5')],
+                                        now + 60)
+        other._cache_dirty = True
+        other.close()
+        assert b'example.net' in load_cache_file(path)
+
+        # workers saving at the same time keep the entries of each other
+        pids = []
+        for i in range(4):
+            pid = os.fork()
+            if pid == 0:
+                worker = DNSResolver(path)
+                for j in range(20):
+                    hostname = ('%d-%d.example.com' % (i, j)).encode()
+                    worker._cache[hostname] = (
+                        [(socket.AF_INET, '127.0.0.6')], now + 60)
+                    worker.save_cache()
+                os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        entries = load_cache_file(path)
+        for i in range(4):
+            for j in range(20):
+                assert ('%d-%d.example.com' % (i, j)).encode() in entries
+
+        with open(path, 'wb') as f:
+            f.write(b'garbage')
+        assert len(DNSResolver(path)._cache) == 0
+    finally:
+        os.remove(path)
+        if os.path.exists(path + '.lock'):
+            os.remove(path + '.lock')
 
 
 def test():
@@ -528,5 +1526,11 @@ def test():
 
 
 if __name__ == '__main__':
+    test_parse_response()
+    test_resolver()
+    test_tcp_fallback()
+    test_ipv6_server()
+    test_cache_file()
+    test_resolve_queue()
     test()
 
@@ -18,10 +18,14 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
+import sys
+import errno
 import socket
 import struct
 import logging
 import binascii
+import itertools
+import collections
 
 def compat_ord(s):
     if type(s) == int:
@@ -129,6 +133,96 @@ def patch_socket():
 patch_socket()
 
 
+# python 2 does not export SO_REUSEPORT
+if hasattr(socket, 'SO_REUSEPORT'):
+    SO_REUSEPORT = socket.SO_REUSEPORT
+elif sys.platform.startswith('linux'):
+    SO_REUSEPORT = 15
+else:
+    SO_REUSEPORT = None
+
+
+def set_reuse_port(sock):
+    if SO_REUSEPORT is None:
+        raise socket.error('SO_REUSEPORT is not supported on this platform')
+    sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+
+
+# at most this many buffers are passed to one sendmsg call
+WRITE_QUEUE_IOV_MAX = 64
+
+
+class WriteQueue(object):
+    # data waiting to be sent on a non blocking socket
+    #
+    # the chunks stay as they were appended, a partial send only moves the
+    # offset into the first one, so the backlog is never joined or copied.
+    # with sendmsg several chunks go out in one call
+
+    def __init__(self):
+        self._chunks = collections.deque()
+        self._offset = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, data):
+        if data:
+            self._chunks.append(data)
+            self._size += len(data)
+
+    def pop_all(self):
+        data = b''.join(self._chunks)[self._offset:]
+        self._chunks.clear()
+        self._offset = 0
+        self._size = 0
+        return data
+
+    def _consume(self, sent):
+        self._size -= sent
+        chunks = self._chunks
+        while sent:
+            left = len(chunks[0]) - self._offset
+            if sent < left:
+                self._offset += sent
+                return
+            chunks.popleft()
+            self._offset = 0
+            sent -= left
+
+    def sendto(self, sock, flags, addr):
+        # all the data in one sendto, used to connect with TCP fast open.
+        # only what was sent leaves the queue, if sendto raises, e.g. with
+        # EINPROGRESS, all of it is still queued for when it connects
+        data = b''.join(self._chunks)[self._offset:]
+        sent = sock.sendto(data, flags, addr)
+        self._consume(sent)
+        return sent
+
+    def send(self, sock):
+        # sends until the queue is empty or the socket takes less than it
+        # was given, errors of sock.send are raised to the caller
+        chunks = self._chunks
+        use_sendmsg = hasattr(sock, 'sendmsg')
+        while chunks:
+            head = chunks[0]
+            if self._offset:
+                head = memoryview(head)[self._offset:]
+            if use_sendmsg and len(chunks) > 1:
+                buffers = [head]
+                buffers.extend(itertools.islice(chunks, 1,
+                                                WRITE_QUEUE_IOV_MAX))
+                expected = sum(len(buf) for buf in buffers)
+                sent = sock.sendmsg(buffers)
+            else:
+                expected = len(head)
+                sent = sock.send(head)
+            self._consume(sent)
+            if sent < expected:
+                return
+
+
 ADDRTYPE_IPV4 = 1
 ADDRTYPE_IPV6 = 4
 ADDRTYPE_HOST = 3
@@ -325,8 +419,66 @@ def test_ip_network():
     assert 'www.google.com' not in ip_network
 
 
+def test_write_queue():
+    left, right = socket.socketpair()
+    left.setblocking(False)
+    right.setblocking(False)
+    queue = WriteQueue()
+    queue.append(b'abc')
+    queue.append(b'')
+    queue.append(b'defg')
+    assert len(queue) == 7
+    queue.send(left)
+    assert len(queue) == 0
+    assert right.recv(16) == b'abcdefg'
+
+    # fill the socket buffer, the rest stays queued in order
+    data = [struct.pack('>I', i) * 1024 for i in range(1024)]
+    for chunk in data:
+        queue.append(chunk)
+    try:
+        while len(queue):
+            queue.send(left)
+    except socket.error:
+        pass
+    received = []
+    while True:
+        try:
+            received.append(right.recv(65536))
+        except socket.error:
+            break
+    pending = queue.pop_all()
+    assert len(queue) == 0
+    assert b''.join(received) + pending == b''.join(data)
+    left.close()
+    right.close()
+
+    # a fast open sendto that did not send anything keeps the data queued
+    class FastOpenSocket(object):
+        def __init__(self, error=None, sent=0):
+            self.error = error
+            self.sent = sent
+
+        def sendto(self, data, flags, addr):
+            if self.error:
+                raise socket.error(self.error, 'sendto')
+            return self.sent
+
+    queue.append(b'header')
+    queue.append(b'payload')
+    try:
+        queue.sendto(FastOpenSocket(errno.EINPROGRESS), 0, ('127.0.0.1', 1))
+        assert False
+    except socket.error:
+        pass
+    assert len(queue) == 13
+    queue.sendto(FastOpenSocket(sent=8), 0, ('127.0.0.1', 1))
+    assert queue.pop_all() == b'yload'
+
+
 if __name__ == '__main__':
     test_inet_conv()
     test_parse_header()
     test_pack_header()
     test_ip_network()
+    test_write_queue()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import hmac
+import struct
+import hashlib
+
+# AEAD ciphers, same framing as the shadowsocks AEAD spec
+#
+# every session starts with a random salt, sent in place of the iv, and
+# uses subkey = HKDF-SHA1(key, salt, 'ss-subkey') with a little endian
+# nonce counter that is increased after each seal or open
+#
+# TCP: [encrypted length][length tag][encrypted payload][payload tag]...
+# UDP: [encrypted payload][payload tag], nonce zero
+
+AEAD_TAG_SIZE = 16
+AEAD_NONCE_SIZE = 12
+AEAD_CHUNK_SIZE_MASK = 0x3FFF
+AEAD_SUBKEY_INFO = b'ss-subkey'
+
+
+def hkdf_sha1(key, salt, info, length):
+    # RFC 5869
+    prk = hmac.new(salt, key, hashlib.sha1).digest()
+    okm = []
+    okm_len = 0
+    t = b''
+    i = 1
+    while okm_len < length:
+        t = hmac.new(prk, t + info + struct.pack('B', i),
+                     hashlib.sha1).digest()
+        okm.append(t)
+        okm_len += len(t)
+        i += 1
+    return b''.join(okm)[:length]
+
+
+class AeadCryptoBase(object):
+    # subclasses implement, with one native call for each chunk:
+    #   set_subkey(subkey), the key of a new session
+    #   aead_encrypt(nonce, data), returns ciphertext + tag
+    #   aead_decrypt(nonce, data), data is ciphertext + tag, returns the
+    #       plaintext and raises if the tag does not match
+    # both raise if the native call fails
+
+    def __init__(self, cipher_name, key, iv, op, nonce_size=AEAD_NONCE_SIZE):
+        self._key = key
+        self._op = op
+        self._nonce_size = nonce_size
+        self._nonce_padding = b'\x00' * (nonce_size - 8)
+        self._zero_nonce = b'\x00' * nonce_size
+        self._counter = 0
+        self._recv_buf = b''
+        self._chunk_len = None
+        self.set_subkey(hkdf_sha1(key, iv, AEAD_SUBKEY_INFO, len(key)))
+
+    def _next_nonce(self):
+        nonce = struct.pack('<Q', self._counter) + self._nonce_padding
+        self._counter += 1
+        return nonce
+
+    def reset(self, iv):
+        # start a new session with another salt
+        self._counter = 0
+        self._recv_buf = b''
+        self._chunk_len = None
+        self.set_subkey(hkdf_sha1(self._key, iv, AEAD_SUBKEY_INFO,
+                                  len(self._key)))
+
+    def update(self, data):
+        if self._op:
+            return self._encrypt_chunks(data)
+        return self._decrypt_chunks(data)
+
+    def update_once(self, data):
+        # a whole message, used for UDP
+        if self._op:
+            return self.aead_encrypt(self._zero_nonce, data)
+        if len(data) < AEAD_TAG_SIZE:
+            raise Exception('AEAD message too short')
+        return self.aead_decrypt(self._zero_nonce, data)
+
+    def _encrypt_chunks(self, data):
+        result = []
+        pos = 0
+        data_len = len(data)
+        while pos < data_len:
+            chunk = data[pos:pos + AEAD_CHUNK_SIZE_MASK]
+            pos += AEAD_CHUNK_SIZE_MASK
+            result.append(self.aead_encrypt(self._next_nonce(),
+                                            struct.pack('>H', len(chunk))))
+            result.append(self.aead_encrypt(self._next_nonce(), chunk))
+        return b''.join(result)
+
+    def _decrypt_chunks(self, data):
+        if self._recv_buf:
+            data = self._recv_buf + data
+        result = []
+        pos = 0
+        data_len = len(data)
+        while True:
+            if self._chunk_len is None:
+                if data_len - pos < 2 + AEAD_TAG_SIZE:
+                    break
+                length = self.aead_decrypt(
+                    self._next_nonce(), data[pos:pos + 2 + AEAD_TAG_SIZE])
+                pos += 2 + AEAD_TAG_SIZE
+                self._chunk_len = struct.unpack('>H', length)[0]
+                if self._chunk_len > AEAD_CHUNK_SIZE_MASK:
+                    raise Exception('AEAD chunk size too large')
+            end = pos + self._chunk_len + AEAD_TAG_SIZE
+            if end > data_len:
+                break
+            result.append(self.aead_decrypt(self._next_nonce(),
+                                            data[pos:end]))
+            pos = end
+            self._chunk_len = None
+        self._recv_buf = data[pos:]
+        return b''.join(result)
+
+
+def test_hkdf_sha1():
+    # RFC 5869 test case 4
+    import binascii
+    ikm = binascii.unhexlify(b'0b0b0b0b0b0b0b0b0b0b0b')
+    salt = binascii.unhexlify(b'000102030405060708090a0b0c')
+    info = binascii.unhexlify(b'f0f1f2f3f4f5f6f7f8f9')
+    okm = binascii.unhexlify(b'085a01ea1b10f36933068b56efa5ad81'
+                             b'a4f14b822f5b091568a9cdd4f155fda2'
+                             b'c22e422478d305f3f896')
+    assert hkdf_sha1(ikm, salt, info, 42) == okm
+
+
+def run_aead_cipher(cipher, decipher):
+    from os import urandom
+    import random
+    import time
+
+    # the ciphertext is longer than the plaintext, so util.run_cipher can
+    # not be used. it is also read back in pieces that split the chunks
+    plain = urandom(16384 * 256)
+    results = []
+    pos = 0
+    start = time.time()
+    while pos < len(plain):
+        l = random.randint(100, 32768)
+        results.append(cipher.update(plain[pos:pos + l]))
+        pos += l
+    c = b''.join(results)
+    results = []
+    pos = 0
+    while pos < len(c):
+        l = random.randint(1, 32768)
+        results.append(decipher.update(c[pos:pos + l]))
+        pos += l
+    end = time.time()
+    print('speed: %d bytes/s' % (len(plain) / (end - start)))
+    assert b''.join(results) == plain
+
+    # a modified byte is rejected
+    c = bytearray(cipher.update(b'data'))
+    c[-1] ^= 1
+    try:
+        decipher.update(bytes(c))
+    except Exception:
+        pass
+    else:
+        assert False
+
+
+if __name__ == '__main__':
+    test_hkdf_sha1()
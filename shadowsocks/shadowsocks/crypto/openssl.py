@@ -21,7 +21,7 @@ from ctypes import c_char_p, c_int, c_long, byref,\
     create_string_buffer, c_void_p
 
 from shadowsocks import common
-from shadowsocks.crypto import util
+from shadowsocks.crypto import util, aead
 
 __all__ = ['ciphers']
 
@@ -30,6 +30,10 @@ loaded = False
 
 buf_size = 2048
 
+EVP_CTRL_AEAD_SET_IVLEN = 0x9
+EVP_CTRL_AEAD_GET_TAG = 0x10
+EVP_CTRL_AEAD_SET_TAG = 0x11
+
 
 def load_openssl():
     global loaded, libcrypto, buf
@@ -48,7 +52,14 @@ def load_openssl():
 
     libcrypto.EVP_CipherUpdate.argtypes = (c_void_p, c_void_p, c_void_p,
                                            c_char_p, c_int)
-
+    libcrypto.EVP_CipherFinal_ex.argtypes = (c_void_p, c_void_p, c_void_p)
+    libcrypto.EVP_CIPHER_CTX_ctrl.argtypes = (c_void_p, c_int, c_int,
+                                              c_void_p)
+
+    # EVP_CIPHER_CTX_cleanup is only a macro of EVP_CIPHER_CTX_reset
+    # since OpenSSL 1.1.0
+    if not hasattr(libcrypto, 'EVP_CIPHER_CTX_cleanup'):
+        libcrypto.EVP_CIPHER_CTX_cleanup = libcrypto.EVP_CIPHER_CTX_reset
     libcrypto.EVP_CIPHER_CTX_cleanup.argtypes = (c_void_p,)
     libcrypto.EVP_CIPHER_CTX_free.argtypes = (c_void_p,)
 
@@ -81,17 +92,22 @@ def rand_bytes(length):
         raise Exception('RAND_bytes return error')
     return buf.raw
 
+def get_cipher(cipher_name):
+    if not loaded:
+        load_openssl()
+    cipher_name = common.to_bytes(cipher_name)
+    cipher = libcrypto.EVP_get_cipherbyname(cipher_name)
+    if not cipher:
+        cipher = load_cipher(cipher_name)
+    if not cipher:
+        raise Exception('cipher %s not found in libcrypto' % cipher_name)
+    return cipher
+
 class OpenSSLCrypto(object):
     def __init__(self, cipher_name, key, iv, op):
         self._ctx = None
-        if not loaded:
-            load_openssl()
-        cipher_name = common.to_bytes(cipher_name)
-        cipher = libcrypto.EVP_get_cipherbyname(cipher_name)
-        if not cipher:
-            cipher = load_cipher(cipher_name)
-        if not cipher:
-            raise Exception('cipher %s not found in libcrypto' % cipher_name)
+        cipher = get_cipher(cipher_name)
+        self._key = key
         key_ptr = c_char_p(key)
         iv_ptr = c_char_p(iv)
         self._ctx = libcrypto.EVP_CIPHER_CTX_new()
@@ -103,6 +119,18 @@ class OpenSSLCrypto(object):
             self.clean()
             raise Exception('can not initialize cipher context')
 
+    def reset(self, iv):
+        # start a new message with the same cipher and key, the context and
+        # the key schedule are kept and only the iv is set again
+        key_ptr = None
+        if not iv:
+            # ciphers without iv like rc4 are keyed again instead
+            key_ptr = c_char_p(self._key)
+        r = libcrypto.EVP_CipherInit_ex(self._ctx, None, None,
+                                        key_ptr, c_char_p(iv), c_int(-1))
+        if not r:
+            raise Exception('can not reset cipher context')
+
     def update(self, data):
         global buf_size, buf
         cipher_out_len = c_long(0)
@@ -122,6 +150,79 @@ class OpenSSLCrypto(object):
         if self._ctx:
             libcrypto.EVP_CIPHER_CTX_cleanup(self._ctx)
             libcrypto.EVP_CIPHER_CTX_free(self._ctx)
+            self._ctx = None
+
+
+class OpenSSLAeadCrypto(aead.AeadCryptoBase):
+    def __init__(self, cipher_name, key, iv, op):
+        self._ctx = None
+        cipher = get_cipher(cipher_name)
+        self._ctx = libcrypto.EVP_CIPHER_CTX_new()
+        if not self._ctx:
+            raise Exception('can not create cipher context')
+        r = libcrypto.EVP_CipherInit_ex(self._ctx, cipher, None,
+                                        None, None, c_int(op))
+        if r:
+            r = libcrypto.EVP_CIPHER_CTX_ctrl(self._ctx,
+                                              EVP_CTRL_AEAD_SET_IVLEN,
+                                              aead.AEAD_NONCE_SIZE, None)
+        if not r:
+            self.clean()
+            raise Exception('can not initialize cipher context')
+        self._out_len = c_long(0)
+        self._final_buf = create_string_buffer(aead.AEAD_TAG_SIZE)
+        self._tag_buf = create_string_buffer(aead.AEAD_TAG_SIZE)
+        super(OpenSSLAeadCrypto, self).__init__(cipher_name, key, iv, op)
+
+    def set_subkey(self, subkey):
+        # the key schedule is set up once for each session
+        r = libcrypto.EVP_CipherInit_ex(self._ctx, None, None,
+                                        c_char_p(subkey), None, c_int(-1))
+        if not r:
+            raise Exception('can not initialize cipher context')
+
+    def _update(self, nonce, data):
+        global buf_size, buf
+        l = len(data)
+        if buf_size < l:
+            buf_size = l * 2
+            buf = create_string_buffer(buf_size)
+        libcrypto.EVP_CipherInit_ex(self._ctx, None, None,
+                                    None, c_char_p(nonce), c_int(-1))
+        libcrypto.EVP_CipherUpdate(self._ctx, byref(buf),
+                                   byref(self._out_len), c_char_p(data), l)
+        return buf.raw[:self._out_len.value]
+
+    def aead_encrypt(self, nonce, data):
+        ciphertext = self._update(nonce, data)
+        r = libcrypto.EVP_CipherFinal_ex(self._ctx, self._final_buf,
+                                         byref(self._out_len))
+        if r > 0:
+            r = libcrypto.EVP_CIPHER_CTX_ctrl(self._ctx, EVP_CTRL_AEAD_GET_TAG,
+                                              aead.AEAD_TAG_SIZE, self._tag_buf)
+        if r <= 0:
+            raise Exception('AEAD encrypt error')
+        return ciphertext + self._tag_buf.raw
+
+    def aead_decrypt(self, nonce, data):
+        plaintext = self._update(nonce, data[:-aead.AEAD_TAG_SIZE])
+        libcrypto.EVP_CIPHER_CTX_ctrl(self._ctx, EVP_CTRL_AEAD_SET_TAG,
+                                      aead.AEAD_TAG_SIZE,
+                                      c_char_p(data[-aead.AEAD_TAG_SIZE:]))
+        r = libcrypto.EVP_CipherFinal_ex(self._ctx, self._final_buf,
+                                         byref(self._out_len))
+        if r <= 0:
+            raise Exception('AEAD tag mismatch')
+        return plaintext
+
+    def __del__(self):
+        self.clean()
+
+    def clean(self):
+        if self._ctx:
+            libcrypto.EVP_CIPHER_CTX_cleanup(self._ctx)
+            libcrypto.EVP_CIPHER_CTX_free(self._ctx)
+            self._ctx = None
 
 
 ciphers = {
@@ -150,6 +251,9 @@ ciphers = {
     'rc2-cfb': (16, 8, OpenSSLCrypto),
     'rc4': (16, 0, OpenSSLCrypto),
     'seed-cfb': (16, 16, OpenSSLCrypto),
+    'aes-128-gcm': (16, 16, OpenSSLAeadCrypto),
+    'aes-192-gcm': (24, 24, OpenSSLAeadCrypto),
+    'aes-256-gcm': (32, 32, OpenSSLAeadCrypto),
 }
 
 
@@ -161,6 +265,20 @@ def run_method(method):
     util.run_cipher(cipher, decipher)
 
 
+def run_reset(method, iv_len=16):
+
+    cipher = OpenSSLCrypto(method, b'k' * 32, b'i' * iv_len, 1)
+    decipher = OpenSSLCrypto(method, b'k' * 32, b'i' * iv_len, 0)
+    for iv in (b'a' * iv_len, b'b' * iv_len, b'a' * iv_len):
+        cipher.reset(iv)
+        decipher.reset(iv)
+        fresh = OpenSSLCrypto(method, b'k' * 32, iv, 1)
+        data = b'packet' * 100
+        encrypted = cipher.update(data)
+        assert encrypted == fresh.update(data)
+        assert decipher.update(encrypted) == data
+
+
 def test_aes_128_cfb():
     run_method('aes-128-cfb')
 
@@ -187,7 +305,31 @@ def test_bf_cfb():
 
 def test_rc4():
     run_method('rc4')
+    run_reset('rc4', 0)
+
+
+def test_reset():
+    run_reset('aes-256-cfb')
+    run_reset('aes-128-ctr')
+
+
+def run_aead_method(method, key_len):
+
+    cipher = OpenSSLAeadCrypto(method, b'k' * key_len, b'i' * key_len, 1)
+    decipher = OpenSSLAeadCrypto(method, b'k' * key_len, b'i' * key_len, 0)
+
+    aead.run_aead_cipher(cipher, decipher)
+
+
+def test_aes_128_gcm():
+    run_aead_method('aes-128-gcm', 16)
+
+
+def test_aes_256_gcm():
+    run_aead_method('aes-256-gcm', 32)
 
 
 if __name__ == '__main__':
     test_aes_128_cfb()
+    test_reset()
+    test_aes_256_gcm()
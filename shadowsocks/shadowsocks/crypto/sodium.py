@@ -20,7 +20,7 @@ from __future__ import absolute_import, division, print_function, \
 from ctypes import c_char_p, c_int, c_ulonglong, byref, \
     create_string_buffer, c_void_p
 
-from shadowsocks.crypto import util
+from shadowsocks.crypto import util, aead
 
 __all__ = ['ciphers']
 
@@ -61,6 +61,22 @@ def load_libsodium():
     except:
         pass
 
+    for name in ('crypto_aead_chacha20poly1305_ietf',
+                 'crypto_aead_xchacha20poly1305_ietf'):
+        # xchacha20 needs libsodium 1.0.12
+        if not hasattr(libsodium, name + '_encrypt'):
+            continue
+        encrypt = getattr(libsodium, name + '_encrypt')
+        encrypt.restype = c_int
+        encrypt.argtypes = (c_void_p, c_void_p, c_char_p, c_ulonglong,
+                            c_char_p, c_ulonglong, c_char_p, c_char_p,
+                            c_char_p)
+        decrypt = getattr(libsodium, name + '_decrypt')
+        decrypt.restype = c_int
+        decrypt.argtypes = (c_void_p, c_void_p, c_char_p, c_char_p,
+                            c_ulonglong, c_char_p, c_ulonglong, c_char_p,
+                            c_char_p)
+
     buf = create_string_buffer(buf_size)
     loaded = True
 
@@ -84,6 +100,12 @@ class SodiumCrypto(object):
         # byte counter, not block counter
         self.counter = 0
 
+    def reset(self, iv):
+        # start a new message with the same cipher and key
+        self.iv = iv
+        self.iv_ptr = c_char_p(iv)
+        self.counter = 0
+
     def update(self, data):
         global buf_size, buf
         l = len(data)
@@ -105,10 +127,63 @@ class SodiumCrypto(object):
         return buf.raw[padding:padding + l]
 
 
+class SodiumAeadCrypto(aead.AeadCryptoBase):
+    def __init__(self, cipher_name, key, iv, op):
+        if not loaded:
+            load_libsodium()
+        if cipher_name == 'chacha20-ietf-poly1305':
+            nonce_size = 12
+            name = 'crypto_aead_chacha20poly1305_ietf'
+        elif cipher_name == 'xchacha20-ietf-poly1305':
+            nonce_size = 24
+            name = 'crypto_aead_xchacha20poly1305_ietf'
+        else:
+            raise Exception('Unknown cipher')
+        if not hasattr(libsodium, name + '_encrypt'):
+            raise Exception('%s not found in libsodium' % cipher_name)
+        self._encrypt = getattr(libsodium, name + '_encrypt')
+        self._decrypt = getattr(libsodium, name + '_decrypt')
+        self._out_len = c_ulonglong(0)
+        super(SodiumAeadCrypto, self).__init__(cipher_name, key, iv, op,
+                                               nonce_size)
+
+    def set_subkey(self, subkey):
+        self._subkey = subkey
+        self._subkey_ptr = c_char_p(subkey)
+
+    def _get_buf(self, l):
+        global buf_size, buf
+        if buf_size < l:
+            buf_size = l * 2
+            buf = create_string_buffer(buf_size)
+        return buf
+
+    def aead_encrypt(self, nonce, data):
+        l = len(data)
+        out = self._get_buf(l + aead.AEAD_TAG_SIZE)
+        r = self._encrypt(byref(out), byref(self._out_len), c_char_p(data), l,
+                          None, 0, None, c_char_p(nonce), self._subkey_ptr)
+        if r != 0:
+            raise Exception('AEAD encrypt error')
+        return out.raw[:self._out_len.value]
+
+    def aead_decrypt(self, nonce, data):
+        l = len(data)
+        out = self._get_buf(l)
+        r = self._decrypt(byref(out), byref(self._out_len), None,
+                          c_char_p(data), l, None, 0, c_char_p(nonce),
+                          self._subkey_ptr)
+        if r != 0:
+            raise Exception('AEAD tag mismatch')
+        return out.raw[:self._out_len.value]
+
+
 ciphers = {
     'salsa20': (32, 8, SodiumCrypto),
     'chacha20': (32, 8, SodiumCrypto),
     'chacha20-ietf': (32, 12, SodiumCrypto),
+    'chacha20-ietf-poly1305': (32, 32, SodiumAeadCrypto),
+    'xchacha20-ietf-poly1305': (32, 32, SodiumAeadCrypto),
 }
 
 
@@ -134,7 +209,41 @@ def test_chacha20_ietf():
 
     util.run_cipher(cipher, decipher)
 
+def test_reset():
+
+    cipher = SodiumCrypto('chacha20', b'k' * 32, b'i' * 16, 1)
+    decipher = SodiumCrypto('chacha20', b'k' * 32, b'i' * 16, 0)
+    cipher.update(b'x' * 100)
+    cipher.reset(b'j' * 16)
+    decipher.reset(b'j' * 16)
+    fresh = SodiumCrypto('chacha20', b'k' * 32, b'j' * 16, 1)
+    encrypted = cipher.update(b'packet')
+    assert encrypted == fresh.update(b'packet')
+    assert decipher.update(encrypted) == b'packet'
+
+def test_chacha20_ietf_poly1305():
+
+    cipher = SodiumAeadCrypto('chacha20-ietf-poly1305', b'k' * 32,
+                              b'i' * 32, 1)
+    decipher = SodiumAeadCrypto('chacha20-ietf-poly1305', b'k' * 32,
+                                b'i' * 32, 0)
+
+    aead.run_aead_cipher(cipher, decipher)
+
+
+def test_xchacha20_ietf_poly1305():
+
+    cipher = SodiumAeadCrypto('xchacha20-ietf-poly1305', b'k' * 32,
+                              b'i' * 32, 1)
+    decipher = SodiumAeadCrypto('xchacha20-ietf-poly1305', b'k' * 32,
+                                b'i' * 32, 0)
+
+    aead.run_aead_cipher(cipher, decipher)
+
 if __name__ == '__main__':
+    test_chacha20_ietf_poly1305()
+    test_xchacha20_ietf_poly1305()
+    test_reset()
     test_chacha20_ietf()
     test_chacha20()
     test_salsa20()
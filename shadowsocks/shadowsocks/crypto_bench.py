@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# throughput and latency of every cipher and obfs/protocol plugin
+#
+# usage: python crypto_bench.py [-t SECONDS] [-m METHODS] [-o FILE]
+#                               [-c BASELINE]
+#
+# results are written as JSON lines, one record for every case, so that a
+# later run can be compared with -c
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+import sys
+import json
+import time
+import getopt
+import logging
+import platform
+
+if __name__ == '__main__':
+    import inspect
+    file_path = os.path.dirname(os.path.realpath(inspect.getfile(inspect.currentframe())))
+    sys.path.insert(0, os.path.join(file_path, '../'))
+
+from shadowsocks import encrypt, obfs
+
+TCP_SIZES = (64, 256, 1024, 4096, 16384, 65536)
+UDP_SIZES = (64, 256, 512, 1024, 1400, 8192)
+PLUGIN_SIZES = (64, 1024, 16384)
+
+DEFAULT_SECONDS = 0.2
+# decrypt cases run over data encrypted beforehand, at most this much
+DECRYPT_BUFFER_SIZE = 32 * 1024 * 1024
+REGRESSION_THRESHOLD = 0.9
+
+# ATYP_IPV4 127.0.0.1:80, protocol plugins expect the first data to start
+# with the shadowsocks header
+SS_HEADER = b'\x01\x7f\x00\x00\x01\x00\x50'
+
+
+def measure(func, arg, seconds):
+    # calls func(arg) for about the given time and returns (calls, elapsed)
+    calls = 0
+    batch = 1
+    start = time.time()
+    while True:
+        for i in range(batch):
+            func(arg)
+        calls += batch
+        elapsed = time.time() - start
+        if elapsed >= seconds:
+            return calls, elapsed
+        if batch < 1024:
+            batch *= 2
+
+
+def measure_each(func, args):
+    # calls func once for each arg and returns (calls, elapsed)
+    start = time.time()
+    for arg in args:
+        func(arg)
+    return len(args), time.time() - start
+
+
+def stream_count(calls, size):
+    return max(1, min(calls, DECRYPT_BUFFER_SIZE // size))
+
+
+def make_result(kind, method, path, op, size, calls, elapsed):
+    return {
+        'kind': kind,
+        'method': method,
+        'path': path,
+        'op': op,
+        'size': size,
+        'calls': calls,
+        'seconds': round(elapsed, 6),
+        'mb_per_s': round(size * calls / elapsed / 1000000, 3),
+        'latency_us': round(elapsed / calls * 1000000, 3),
+    }
+
+
+def bench_tcp_cipher(method, size, seconds):
+    data = os.urandom(size)
+    encryptor = encrypt.Encryptor(b'benchmark', method)
+    # the first call sends the iv
+    encryptor.encrypt(data)
+    calls, elapsed = measure(encryptor.encrypt, data, seconds)
+    results = [make_result('cipher', method, 'tcp', 'encrypt', size,
+                           calls, elapsed)]
+
+    encryptor = encrypt.Encryptor(b'benchmark', method)
+    decryptor = encrypt.Encryptor(b'benchmark', method)
+    decryptor.decrypt(encryptor.encrypt(data))
+    chunks = [encryptor.encrypt(data)
+              for i in range(stream_count(calls, size))]
+    calls, elapsed = measure_each(decryptor.decrypt, chunks)
+    results.append(make_result('cipher', method, 'tcp', 'decrypt', size,
+                               calls, elapsed))
+    return results
+
+
+def bench_udp_cipher(method, size, seconds):
+    data = os.urandom(size)
+    key = encrypt.encrypt_key(b'benchmark', method)
+    encryptor = encrypt.UDPEncryptor(key, method)
+    decryptor = encrypt.UDPEncryptor(key, method)
+    ref_iv = [encryptor.new_iv()]
+    calls, elapsed = measure(
+        lambda d: encryptor.encrypt_all_iv(1, d, [encryptor.new_iv()]),
+        data, seconds)
+    results = [make_result('cipher', method, 'udp', 'encrypt', size,
+                           calls, elapsed)]
+    packet = encryptor.encrypt_all_iv(1, data, ref_iv)
+    calls, elapsed = measure(
+        lambda p: decryptor.encrypt_all_iv(0, p, [None]), packet, seconds)
+    results.append(make_result('cipher', method, 'udp', 'decrypt', size,
+                               calls, elapsed))
+    return results
+
+
+def new_plugin(method, iv, recv_iv, key):
+    plugin = obfs.obfs(method)
+    server_info = obfs.server_info(plugin.init_data())
+    server_info.host = '127.0.0.1'
+    server_info.port = 8388
+    server_info.protocol_param = ''
+    server_info.obfs_param = ''
+    server_info.iv = iv
+    server_info.recv_iv = recv_iv
+    server_info.key = key
+    server_info.head_len = 30
+    server_info.tcp_mss = 1440
+    plugin.set_server_info(server_info)
+    return plugin
+
+
+def client_send(client, data):
+    return client.client_encode(client.client_pre_encrypt(data))
+
+
+def server_recv(server, data):
+    # returns (data, data to send back to the client) like TCPRelayHandler
+    data, need_decrypt, send_back = server.server_decode(data)
+    if send_back:
+        send_back = server.server_encode(b'')
+    else:
+        send_back = b''
+    if need_decrypt:
+        data = server.server_post_decrypt(data)
+    return data, send_back
+
+
+def plugin_pair(method):
+    # a client and a server that already finished the handshake
+    client_iv = os.urandom(16)
+    server_iv = os.urandom(16)
+    key = os.urandom(32)
+    client = new_plugin(method, client_iv, server_iv, key)
+    server = new_plugin(method, server_iv, client_iv, key)
+    pending = client_send(client, SS_HEADER + b'x' * 100)
+    for i in range(8):
+        data, send_back = server_recv(server, pending)
+        if data == b'E':
+            raise Exception('%s rejected the handshake' % method)
+        if data:
+            return client, server
+        if not send_back:
+            raise Exception('%s handshake did not finish' % method)
+        data, need_send_back = client.client_decode(send_back)
+        pending = client_send(client, b'')
+    raise Exception('%s handshake did not finish' % method)
+
+
+def bench_plugin(method, size, seconds):
+    data = os.urandom(size)
+    client, server = plugin_pair(method)
+    calls, elapsed = measure(lambda d: client_send(client, d), data, seconds)
+    results = [make_result('plugin', method, 'tcp', 'encode', size,
+                           calls, elapsed)]
+    client, server = plugin_pair(method)
+    chunks = [client_send(client, data)
+              for i in range(stream_count(calls, size))]
+    calls, elapsed = measure_each(lambda c: server_recv(server, c), chunks)
+    results.append(make_result('plugin', method, 'tcp', 'decode', size,
+                               calls, elapsed))
+    return results
+
+
+def run(seconds, methods=None):
+    cases = []
+    for method in sorted(encrypt.method_supported.keys()):
+        for size in TCP_SIZES:
+            cases.append((bench_tcp_cipher, method, size))
+        for size in UDP_SIZES:
+            cases.append((bench_udp_cipher, method, size))
+    for method in sorted(obfs.method_supported.keys()):
+        for size in PLUGIN_SIZES:
+            cases.append((bench_plugin, method, size))
+    failed = set()
+    for bench, method, size in cases:
+        if methods and method not in methods:
+            continue
+        if method in failed:
+            continue
+        try:
+            for result in bench(method, size, seconds):
+                yield result
+        except Exception as e:
+            # e.g. a library that is not installed, report it once
+            failed.add(method)
+            yield {'method': method, 'error': str(e)}
+
+
+def load_results(path):
+    results = {}
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            result = json.loads(line)
+            if 'mb_per_s' in result:
+                results[result_key(result)] = result
+    return results
+
+
+def result_key(result):
+    return (result['kind'], result['method'], result['path'], result['op'],
+            result['size'])
+
+
+def format_result(result, baseline=None):
+    if 'error' in result:
+        return '%-28s error: %s' % (result['method'], result['error'])
+    line = '%-28s %-3s %-7s %6d %10.2f MB/s %10.2f us' % (
+        result['method'], result['path'], result['op'], result['size'],
+        result['mb_per_s'], result['latency_us'])
+    if baseline:
+        old = baseline.get(result_key(result))
+        if old and old['mb_per_s'] > 0:
+            ratio = result['mb_per_s'] / old['mb_per_s']
+            line += ' %+7.1f%%' % ((ratio - 1) * 100)
+            if ratio < REGRESSION_THRESHOLD:
+                line += ' REGRESSION'
+    return line
+
+
+def print_help():
+    print('''usage: crypto_bench.py [OPTION]...
+Measure every cipher and obfs/protocol plugin.
+
+  -h, --help             show this help message and exit
+  -t SECONDS             time for each case, default: %s
+  -m METHOD,METHOD       only run these ciphers or plugins
+  -o FILE                write JSON lines results to FILE
+  -c FILE                compare with the results of an earlier run
+''' % DEFAULT_SECONDS)
+
+
+def main():
+    logging.basicConfig(level=logging.ERROR)
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'ht:m:o:c:', ['help'])
+    except getopt.GetoptError as e:
+        print(e, file=sys.stderr)
+        print_help()
+        sys.exit(2)
+    seconds = DEFAULT_SECONDS
+    methods = None
+    output = None
+    baseline = None
+    for key, value in optlist:
+        if key in ('-h', '--help'):
+            print_help()
+            sys.exit(0)
+        elif key == '-t':
+            seconds = float(value)
+        elif key == '-m':
+            methods = set(value.split(','))
+        elif key == '-o':
+            output = open(value, 'w')
+        elif key == '-c':
+            baseline = load_results(value)
+
+    header = {
+        'benchmark': 'crypto',
+        'time': int(time.time()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seconds': seconds,
+    }
+    if output:
+        output.write(json.dumps(header, sort_keys=True) + '\n')
+    regressions = 0
+    for result in run(seconds, methods):
+        print(format_result(result, baseline))
+        sys.stdout.flush()
+        if output:
+            output.write(json.dumps(result, sort_keys=True) + '\n')
+        if baseline and 'mb_per_s' in result:
+            old = baseline.get(result_key(result))
+            if old and result['mb_per_s'] < \
+                    old['mb_per_s'] * REGRESSION_THRESHOLD:
+                regressions += 1
+    if output:
+        output.close()
+    if regressions:
+        print('%d cases are slower than the baseline' % regressions)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
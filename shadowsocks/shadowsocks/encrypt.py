@@ -158,9 +158,15 @@ def encrypt_all(password, method, op, data):
         iv = data[:iv_len]
         data = data[iv_len:]
     cipher = m(method, key, iv, op)
-    result.append(cipher.update(data))
+    result.append(update_once(cipher, data))
     return b''.join(result)
 
+def update_once(cipher, data):
+    # AEAD ciphers seal a whole message instead of framing it as a stream
+    if hasattr(cipher, 'update_once'):
+        return cipher.update_once(data)
+    return cipher.update(data)
+
 def encrypt_key(password, method):
     method = method.lower()
     (key_len, iv_len, m) = method_supported[method]
@@ -192,10 +198,60 @@ def encrypt_all_iv(key, method, op, data, ref_iv):
         data = data[iv_len:]
         ref_iv[0] = iv
     cipher = m(method, key, iv, op)
-    result.append(cipher.update(data))
+    result.append(update_once(cipher, data))
     return b''.join(result)
 
 
+class UDPEncryptor(object):
+    # encrypt_all_iv for a fixed key and method, used for every datagram of
+    # a UDP relay. the method is looked up once and the cipher contexts are
+    # kept, every datagram only sets a new iv on them
+    def __init__(self, key, method):
+        self.key = key
+        self.method = method.lower()
+        (self._key_len, self._iv_len, self._m) = \
+            method_supported[self.method]
+        # rc4-md5 derives the key from the iv, so its ciphers are created
+        # for every datagram
+        self._reusable = hasattr(self._m, 'reset')
+        self._aead = hasattr(self._m, 'update_once')
+        self._ciphers = [None, None]
+
+    def _get_cipher(self, op, iv):
+        cipher = self._ciphers[op]
+        if cipher is not None:
+            cipher.reset(iv)
+            return cipher
+        cipher = self._m(self.method, self.key, iv, op)
+        if self._reusable:
+            self._ciphers[op] = cipher
+        return cipher
+
+    def new_iv(self):
+        return random_string(self._iv_len)
+
+    def encrypt_all_iv(self, op, data, ref_iv):
+        if op:
+            iv = ref_iv[0]
+            cipher = self._get_cipher(op, iv)
+            if self._aead:
+                return iv + cipher.update_once(data)
+            return iv + cipher.update(data)
+        if len(data) < self._iv_len:
+            return b''
+        iv = data[:self._iv_len]
+        ref_iv[0] = iv
+        cipher = self._get_cipher(op, iv)
+        if self._aead:
+            return cipher.update_once(data[self._iv_len:])
+        return cipher.update(data[self._iv_len:])
+
+    def encrypt_all(self, op, data):
+        if op:
+            return self.encrypt_all_iv(op, data, [self.new_iv()])
+        return self.encrypt_all_iv(op, data, [None])
+
+
 CIPHERS_TO_TEST = [
     'aes-128-cfb',
     'aes-256-cfb',
@@ -203,6 +259,8 @@ CIPHERS_TO_TEST = [
     'salsa20',
     'chacha20',
     'table',
+    'aes-256-gcm',
+    'chacha20-ietf-poly1305',
 ]
 
 
@@ -228,6 +286,26 @@ def test_encrypt_all():
         assert plain == plain2
 
 
+def test_udp_encryptor():
+    from os import urandom
+    for method in CIPHERS_TO_TEST:
+        logging.warn(method)
+        key = encrypt_key(b'key', method)
+        encryptor = UDPEncryptor(key, method)
+        decryptor = UDPEncryptor(key, method)
+        for i in range(3):
+            plain = urandom(1000 + i)
+            ref_iv = [encryptor.new_iv()]
+            cipher = encryptor.encrypt_all_iv(1, plain, ref_iv)
+            assert cipher == encrypt_all_iv(key, method, 1, plain, ref_iv)
+            recv_iv = [None]
+            assert decryptor.encrypt_all_iv(0, cipher, recv_iv) == plain
+            assert recv_iv == ref_iv
+            cipher = encryptor.encrypt_all(1, plain)
+            assert encrypt_all(b'key', method, 0, cipher) == plain
+
+
 if __name__ == '__main__':
     test_encrypt_all()
     test_encryptor()
+    test_udp_encryptor()
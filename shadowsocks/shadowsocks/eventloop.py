@@ -25,10 +25,18 @@ import os
 import time
 import socket
 import select
+import heapq
+import itertools
 import errno
 import logging
 from collections import defaultdict
 
+if __name__ == '__main__':
+    import sys
+    import inspect
+    file_path = os.path.dirname(os.path.realpath(inspect.getfile(inspect.currentframe())))
+    sys.path.insert(0, os.path.join(file_path, '../'))
+
 from shadowsocks import shell
 
 
@@ -52,9 +60,13 @@ EVENT_NAMES = {
     POLL_NVAL: 'POLL_NVAL',
 }
 
-# we check timeouts every TIMEOUT_PRECISION seconds
+# we call periodic callbacks every TIMEOUT_PRECISION seconds
 TIMEOUT_PRECISION = 10
 
+# we rebuild the timer heap when more than TIMERS_CLEAN_SIZE timers and more
+# than half of the heap are cancelled
+TIMERS_CLEAN_SIZE = 512
+
 
 class KqueueLoop(object):
 
@@ -142,6 +154,19 @@ class SelectLoop(object):
         pass
 
 
+class Timer(object):
+    # a callback scheduled by EventLoop.call_later
+    # callback is set to None once the timer fired or was cancelled
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+
+    def active(self):
+        return self.callback is not None
+
+
 class EventLoop(object):
     def __init__(self):
         if hasattr(select, 'epoll'):
@@ -159,6 +184,9 @@ class EventLoop(object):
         self._fdmap = {}  # (f, handler)
         self._last_time = time.time()
         self._periodic_callbacks = []
+        self._timers = []  # heap of (deadline, seq, timer)
+        self._timer_seq = itertools.count()
+        self._cancelled_timers = 0
         self._stopping = False
         logging.debug('using event model: %s', model)
 
@@ -186,6 +214,53 @@ class EventLoop(object):
         fd = f.fileno()
         self._impl.modify(fd, mode)
 
+    def call_later(self, delay, callback, *args):
+        # O(log n), returns a Timer which can be passed to cancel()
+        timer = Timer(time.time() + delay, callback, args)
+        heapq.heappush(self._timers,
+                       (timer.deadline, next(self._timer_seq), timer))
+        return timer
+
+    def cancel(self, timer):
+        # O(1), the entry stays in the heap until it is popped or the heap
+        # gets rebuilt, but it no longer references the callback
+        if timer.callback is None:
+            return
+        timer.callback = None
+        timer.args = None
+        self._cancelled_timers += 1
+        if self._cancelled_timers > TIMERS_CLEAN_SIZE and \
+                self._cancelled_timers > len(self._timers) >> 1:
+            # in place, _run_timers may be walking the same list
+            self._timers[:] = [t for t in self._timers if t[2].callback]
+            heapq.heapify(self._timers)
+            self._cancelled_timers = 0
+
+    def _poll_timeout(self):
+        timers = self._timers
+        while timers and timers[0][2].callback is None:
+            heapq.heappop(timers)
+            self._cancelled_timers -= 1
+        if not timers:
+            return TIMEOUT_PRECISION
+        timeout = timers[0][0] - time.time()
+        return max(0, min(timeout, TIMEOUT_PRECISION))
+
+    def _run_timers(self, now):
+        timers = self._timers
+        while timers and timers[0][0] <= now:
+            timer = heapq.heappop(timers)[2]
+            callback, args = timer.callback, timer.args
+            if callback is None:
+                self._cancelled_timers -= 1
+                continue
+            timer.callback = None
+            timer.args = None
+            try:
+                callback(*args)
+            except (OSError, IOError) as e:
+                shell.print_exception(e)
+
     def stop(self):
         self._stopping = True
 
@@ -194,7 +269,7 @@ class EventLoop(object):
         while not self._stopping:
             asap = False
             try:
-                events = self.poll(TIMEOUT_PRECISION)
+                events = self.poll(self._poll_timeout())
             except (OSError, IOError) as e:
                 if errno_from_exception(e) in (errno.EPIPE, errno.EINTR):
                     # EPIPE: Happens when the client closes the connection
@@ -217,6 +292,7 @@ class EventLoop(object):
                     except (OSError, IOError) as e:
                         shell.print_exception(e)
             now = time.time()
+            self._run_timers(now)
             if asap or now - self._last_time >= TIMEOUT_PRECISION:
                 for callback in self._periodic_callbacks:
                     callback()
@@ -249,3 +325,44 @@ def errno_from_exception(e):
 def get_sock_error(sock):
     error_number = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
     return socket.error(error_number, os.strerror(error_number))
+
+
+def test_call_later():
+    loop = EventLoop()
+    fired = []
+
+    loop.call_later(0.2, fired.append, 'b')
+    loop.call_later(0.1, fired.append, 'a')
+    timer = loop.call_later(0.15, fired.append, 'cancelled')
+    loop.cancel(timer)
+    assert not timer.active()
+    loop.call_later(0.3, loop.stop)
+    loop.run()
+    assert fired == ['a', 'b']
+    assert not loop._timers
+
+    for i in range(TIMERS_CLEAN_SIZE * 4):
+        loop.cancel(loop.call_later(100, fired.append, i))
+    assert len(loop._timers) <= TIMERS_CLEAN_SIZE * 2
+
+    # a callback that cancels enough timers to rebuild the heap
+    loop = EventLoop()
+    far = [loop.call_later(100, fired.append, i)
+           for i in range(TIMERS_CLEAN_SIZE * 2)]
+
+    def cancel_far():
+        for timer in far:
+            loop.cancel(timer)
+
+    loop.call_later(0, cancel_far)
+    loop.call_later(0, fired.append, 'after')
+    loop._run_timers(time.time() + 1)
+    loop._poll_timeout()
+    assert fired[-1] == 'after'
+    assert loop._cancelled_timers >= 0
+    assert loop._cancelled_timers == \
+        len([t for t in loop._timers if t[2].callback is None])
+
+
+if __name__ == '__main__':
+    test_call_later()
@@ -80,6 +80,10 @@ class LRUCache(collections.MutableMapping):
     def __len__(self):
         return len(self._store)
 
+    def peek(self, key, default=None):
+        # O(1), unlike get it does not count as a use of the key
+        return self._store.get(key, default)
+
     def first(self):
         if len(self._keys_to_last_time) > 0:
             for key in self._keys_to_last_time:
@@ -33,6 +33,7 @@ import hashlib
 
 import shadowsocks
 from shadowsocks import common, lru_cache
+from shadowsocks.lru_cache import OrderedDict
 from shadowsocks.obfsplugin import plain
 from shadowsocks.common import to_bytes, to_str, ord, chr
 
@@ -59,6 +60,58 @@ def match_begin(str1, str2):
             return True
     return False
 
+def pack_frames(buf, unit_len, rnd_datas, out=None):
+    # the data frames of auth_sha1 and auth_sha1_v2 for buf, cut in pieces
+    # of at most unit_len bytes, after the frames already in out.
+    # rnd_datas(sizes) returns the random data put before every piece, so
+    # that the random bytes of all of them are drawn at once
+    if out is None:
+        out = []
+    if not buf:
+        return b''.join(out)
+    count = (len(buf) - 1) // unit_len
+    sizes = [unit_len] * count
+    sizes.append(len(buf) - unit_len * count)
+    offset = 0
+    for rnd_data, size in zip(rnd_datas(sizes), sizes):
+        data = struct.pack('>H', len(rnd_data) + size + 6) + rnd_data + buf[offset:offset + size]
+        offset += size
+        out.append(data)
+        out.append(struct.pack('<I', zlib.adler32(data) & 0xFFFFFFFF))
+    return b''.join(out)
+
+HMAC_TRANS_5C = bytes(bytearray((x ^ 0x5C) for x in range(256)))
+HMAC_TRANS_36 = bytes(bytearray((x ^ 0x36) for x in range(256)))
+
+class auth_key(object):
+    # what only depends on the key of a port, shared by its connections
+    # through server_info.data: the crc32 that starts the first frame and
+    # the key half of the HMAC-SHA1 pads. the HMAC key is iv + key, the
+    # iv half of the pads is still done for every connection
+    def __init__(self, key, salt=b''):
+        self.key = key
+        self.crc = struct.pack('<I', binascii.crc32(salt + key) & 0xFFFFFFFF)
+        self.iv_len = -1
+        self.ipad = None
+        self.opad = None
+
+    def hmac_sha1(self, iv, data):
+        # hmac.new(iv + key, data, hashlib.sha1).digest()
+        if len(iv) != self.iv_len:
+            self.iv_len = len(iv)
+            if len(iv) + len(self.key) <= 64:
+                key = self.key + b'\x00' * (64 - len(iv) - len(self.key))
+                self.ipad = key.translate(HMAC_TRANS_36)
+                self.opad = key.translate(HMAC_TRANS_5C)
+            else:
+                # longer keys are hashed first
+                self.ipad = None
+        if self.ipad is None:
+            return hmac.new(iv + self.key, data, hashlib.sha1).digest()
+        inner = hashlib.sha1(iv.translate(HMAC_TRANS_36) + self.ipad)
+        inner.update(data)
+        return hashlib.sha1(iv.translate(HMAC_TRANS_5C) + self.opad + inner.digest()).digest()
+
 class obfs_verify_data(object):
     def __init__(self):
         pass
@@ -132,59 +185,92 @@ class client_queue(object):
         return True
 
 class obfs_auth_data(object):
+    # the clients are also kept by their last update, the active ones and
+    # the inactive ones that can give their place to a new client, so that
+    # counting the active clients and finding a place never walks all of
+    # them. a client leaves the active ones, the oldest first, when it is
+    # found inactive at the next insert
     def __init__(self):
         self.client_id = {}
+        self.active = OrderedDict()
+        self.inactive = OrderedDict()
         self.startup_time = int(time.time() - 30) & 0xFFFFFFFF
         self.local_client_id = b''
         self.connection_id = 0
+        self.auth_key = None
         self.set_max_client(16) # max active client count
 
     def update(self, client_id, connection_id):
         if client_id in self.client_id:
             self.client_id[client_id].update()
+            self.touch(client_id)
 
     def set_max_client(self, max_client):
         self.max_client = max_client
         self.max_buffer = max(self.max_client * 2, 256)
 
+    def touch(self, client_id):
+        # client_id was just updated, it is the newest active client
+        if client_id in self.active:
+            del self.active[client_id]
+        elif client_id in self.inactive:
+            del self.inactive[client_id]
+        self.active[client_id] = self.client_id[client_id]
+
+    def expire(self):
+        # moves the clients that are no longer active to the inactive ones,
+        # disabled clients can not give their place and are left out
+        active = self.active
+        while active:
+            for c_id in active:
+                break
+            client = active[c_id]
+            if client.is_active():
+                break
+            del active[c_id]
+            if client.enable:
+                self.inactive[c_id] = client
+
+    def insert_client(self, client_id, connection_id):
+        if client_id not in self.client_id:
+            self.client_id[client_id] = client_queue(connection_id)
+        else:
+            self.client_id[client_id].re_enable(connection_id)
+        self.touch(client_id)
+        return self.client_id[client_id].insert(connection_id)
+
+    def get_auth_key(self, key, salt=b''):
+        if self.auth_key is None or self.auth_key.key != key:
+            self.auth_key = auth_key(key, salt)
+        return self.auth_key
+
     def insert(self, client_id, connection_id):
         if client_id not in self.client_id or not self.client_id[client_id].enable:
-            active = 0
-            for c_id in self.client_id:
-                if self.client_id[c_id].is_active():
-                    active += 1
-            if active >= self.max_client:
+            self.expire()
+            if len(self.active) >= self.max_client:
                 logging.warn('auth_simple: max active clients exceeded')
                 return False
 
             if len(self.client_id) < self.max_client:
-                if client_id not in self.client_id:
-                    self.client_id[client_id] = client_queue(connection_id)
+                return self.insert_client(client_id, connection_id)
+            if self.inactive:
+                # the client that was inactive for the longest time
+                c_id, client = self.inactive.popitem(last=False)
+                if len(self.client_id) >= self.max_buffer:
+                    del self.client_id[c_id]
                 else:
-                    self.client_id[client_id].re_enable(connection_id)
-                return self.client_id[client_id].insert(connection_id)
-            keys = self.client_id.keys()
-            random.shuffle(keys)
-            for c_id in keys:
-                if not self.client_id[c_id].is_active() and self.client_id[c_id].enable:
-                    if len(self.client_id) >= self.max_buffer:
-                        del self.client_id[c_id]
-                    else:
-                        self.client_id[c_id].enable = False
-                    if client_id not in self.client_id:
-                        self.client_id[client_id] = client_queue(connection_id)
-                    else:
-                        self.client_id[client_id].re_enable(connection_id)
-                    return self.client_id[client_id].insert(connection_id)
+                    client.enable = False
+                return self.insert_client(client_id, connection_id)
             logging.warn('auth_simple: no inactive client [assert]')
             return False
         else:
+            self.touch(client_id)
             return self.client_id[client_id].insert(connection_id)
 
 class auth_simple(verify_base):
     def __init__(self, method):
         super(auth_simple, self).__init__(method)
-        self.recv_buf = b''
+        self.recv_buf = plain.frame_buffer()
         self.unit_len = 8100
         self.decrypt_packet_num = 0
         self.raw_trans = False
@@ -229,111 +315,111 @@ class auth_simple(verify_base):
                 struct.pack('<I', self.server_info.data.connection_id)])
 
     def client_pre_encrypt(self, buf):
-        ret = b''
+        ret = []
         if not self.has_sent_header:
             head_size = self.get_head_size(buf, 30)
             datalen = min(len(buf), random.randint(0, 31) + head_size)
-            ret += self.pack_data(self.auth_data() + buf[:datalen])
+            ret.append(self.pack_data(self.auth_data() + buf[:datalen]))
             buf = buf[datalen:]
             self.has_sent_header = True
-        while len(buf) > self.unit_len:
-            ret += self.pack_data(buf[:self.unit_len])
-            buf = buf[self.unit_len:]
-        ret += self.pack_data(buf)
-        return ret
+        return plain.pack_units(self.pack_data, buf, self.unit_len, ret)
 
     def client_post_decrypt(self, buf):
         if self.raw_trans:
             return buf
-        self.recv_buf += buf
-        out_buf = b''
-        while len(self.recv_buf) > 2:
-            length = struct.unpack('>H', self.recv_buf[:2])[0]
+        buf = self.recv_buf.feed(buf)
+        pos = 0
+        out_buf = []
+        while len(buf) - pos > 2:
+            length = struct.unpack_from('>H', buf, pos)[0]
             if length >= 8192 or length < 7:
                 self.raw_trans = True
-                self.recv_buf = b''
+                self.recv_buf.clear()
                 raise Exception('client_post_decrypt data error')
-            if length > len(self.recv_buf):
+            if length > len(buf) - pos:
                 break
+            frame = buf[pos:pos + length]
+            pos += length
 
-            if (binascii.crc32(self.recv_buf[:length]) & 0xffffffff) != 0xffffffff:
+            if (binascii.crc32(frame[:length]) & 0xffffffff) != 0xffffffff:
                 self.raw_trans = True
-                self.recv_buf = b''
+                self.recv_buf.clear()
                 raise Exception('client_post_decrypt data uncorrect CRC32')
 
-            pos = common.ord(self.recv_buf[2]) + 2
-            out_buf += self.recv_buf[pos:length - 4]
-            self.recv_buf = self.recv_buf[length:]
+            start = common.ord(frame[2]) + 2
+            out_buf.append(frame[start:length - 4])
 
+        self.recv_buf.consume(pos)
+        out_buf = b''.join(out_buf)
         if out_buf:
             self.decrypt_packet_num += 1
         return out_buf
 
     def server_pre_encrypt(self, buf):
-        ret = b''
-        while len(buf) > self.unit_len:
-            ret += self.pack_data(buf[:self.unit_len])
-            buf = buf[self.unit_len:]
-        ret += self.pack_data(buf)
-        return ret
+        return plain.pack_units(self.pack_data, buf, self.unit_len)
 
     def server_post_decrypt(self, buf):
         if self.raw_trans:
             return buf
-        self.recv_buf += buf
-        out_buf = b''
-        while len(self.recv_buf) > 2:
-            length = struct.unpack('>H', self.recv_buf[:2])[0]
+        buf = self.recv_buf.feed(buf)
+        pos = 0
+        out_buf = []
+        while len(buf) - pos > 2:
+            length = struct.unpack_from('>H', buf, pos)[0]
             if length >= 8192 or length < 7:
                 self.raw_trans = True
-                self.recv_buf = b''
+                self.recv_buf.clear()
                 if self.decrypt_packet_num == 0:
                     logging.info('auth_simple: over size')
                     return b'E'
                 else:
                     raise Exception('server_post_decrype data error')
-            if length > len(self.recv_buf):
+            if length > len(buf) - pos:
                 break
+            frame = buf[pos:pos + length]
+            pos += length
 
-            if (binascii.crc32(self.recv_buf[:length]) & 0xffffffff) != 0xffffffff:
-                logging.info('auth_simple: crc32 error, data %s' % (binascii.hexlify(self.recv_buf[:length]),))
+            if (binascii.crc32(frame[:length]) & 0xffffffff) != 0xffffffff:
+                logging.info('auth_simple: crc32 error, data %s' % (binascii.hexlify(frame[:length]),))
                 self.raw_trans = True
-                self.recv_buf = b''
+                self.recv_buf.clear()
                 if self.decrypt_packet_num == 0:
                     return b'E'
                 else:
                     raise Exception('server_post_decrype data uncorrect CRC32')
 
-            pos = common.ord(self.recv_buf[2]) + 2
-            out_buf += self.recv_buf[pos:length - 4]
+            start = common.ord(frame[2]) + 2
+            data = frame[start:length - 4]
             if not self.has_recv_header:
-                if len(out_buf) < 12:
+                if len(data) < 12:
                     self.raw_trans = True
-                    self.recv_buf = b''
+                    self.recv_buf.clear()
                     logging.info('auth_simple: too short')
                     return b'E'
-                utc_time = struct.unpack('<I', out_buf[:4])[0]
-                client_id = struct.unpack('<I', out_buf[4:8])[0]
-                connection_id = struct.unpack('<I', out_buf[8:12])[0]
+                utc_time = struct.unpack('<I', data[:4])[0]
+                client_id = struct.unpack('<I', data[4:8])[0]
+                connection_id = struct.unpack('<I', data[8:12])[0]
                 time_dif = common.int32((int(time.time()) & 0xffffffff) - utc_time)
                 if time_dif < -self.max_time_dif or time_dif > self.max_time_dif \
                         or common.int32(utc_time - self.server_info.data.startup_time) < 0:
                     self.raw_trans = True
-                    self.recv_buf = b''
-                    logging.info('auth_simple: wrong timestamp, time_dif %d, data %s' % (time_dif, binascii.hexlify(out_buf),))
+                    self.recv_buf.clear()
+                    logging.info('auth_simple: wrong timestamp, time_dif %d, data %s' % (time_dif, binascii.hexlify(data),))
                     return b'E'
                 elif self.server_info.data.insert(client_id, connection_id):
                     self.has_recv_header = True
-                    out_buf = out_buf[12:]
+                    data = data[12:]
                     self.client_id = client_id
                     self.connection_id = connection_id
                 else:
                     self.raw_trans = True
-                    self.recv_buf = b''
-                    logging.info('auth_simple: auth fail, data %s' % (binascii.hexlify(out_buf),))
+                    self.recv_buf.clear()
+                    logging.info('auth_simple: auth fail, data %s' % (binascii.hexlify(data),))
                     return b'E'
-            self.recv_buf = self.recv_buf[length:]
+            out_buf.append(data)
 
+        self.recv_buf.consume(pos)
+        out_buf = b''.join(out_buf)
         if out_buf:
             self.server_info.data.update(self.client_id, self.connection_id)
             self.decrypt_packet_num += 1
@@ -342,7 +428,7 @@ class auth_simple(verify_base):
 class auth_sha1(verify_base):
     def __init__(self, method):
         super(auth_sha1, self).__init__(method)
-        self.recv_buf = b''
+        self.recv_buf = plain.frame_buffer()
         self.unit_len = 8100
         self.decrypt_packet_num = 0
         self.raw_trans = False
@@ -363,15 +449,20 @@ class auth_sha1(verify_base):
             max_client = 64
         self.server_info.data.set_max_client(max_client)
 
-    def pack_data(self, buf):
-        if len(buf) == 0:
-            return b''
-        rnd_data = os.urandom(common.ord(os.urandom(1)[0]) % 16)
-        data = common.chr(len(rnd_data) + 1) + rnd_data + buf
-        data = struct.pack('>H', len(data) + 6) + data
-        adler32 = zlib.adler32(data) & 0xFFFFFFFF
-        data += struct.pack('<I', adler32)
-        return data
+    def rnd_datas(self, sizes):
+        # 0 to 15 random bytes for every piece, one os.urandom call draws
+        # the lengths and another one the bytes of all the pieces
+        if len(sizes) == 1:
+            rnd_data = os.urandom(common.ord(os.urandom(1)[0]) % 16)
+            return [common.chr(len(rnd_data) + 1) + rnd_data]
+        rnd_lens = [common.ord(c) % 16 for c in os.urandom(len(sizes))]
+        rnd = os.urandom(sum(rnd_lens))
+        pos = 0
+        datas = []
+        for rnd_len in rnd_lens:
+            datas.append(common.chr(rnd_len + 1) + rnd[pos:pos + rnd_len])
+            pos += rnd_len
+        return datas
 
     def pack_auth_data(self, buf):
         if len(buf) == 0:
@@ -379,9 +470,9 @@ class auth_sha1(verify_base):
         rnd_data = os.urandom(common.ord(os.urandom(1)[0]) % 128)
         data = common.chr(len(rnd_data) + 1) + rnd_data + buf
         data = struct.pack('>H', len(data) + 16) + data
-        crc = binascii.crc32(self.server_info.key) & 0xFFFFFFFF
-        data = struct.pack('<I', crc) + data
-        data += hmac.new(self.server_info.iv + self.server_info.key, data, hashlib.sha1).digest()[:10]
+        key = self.server_info.data.get_auth_key(self.server_info.key)
+        data = key.crc + data
+        data += key.hmac_sha1(self.server_info.iv, data)[:10]
         return data
 
     def auth_data(self):
@@ -398,42 +489,42 @@ class auth_sha1(verify_base):
                 struct.pack('<I', self.server_info.data.connection_id)])
 
     def client_pre_encrypt(self, buf):
-        ret = b''
+        ret = []
         if not self.has_sent_header:
             head_size = self.get_head_size(buf, 30)
             datalen = min(len(buf), random.randint(0, 31) + head_size)
-            ret += self.pack_auth_data(self.auth_data() + buf[:datalen])
+            ret.append(self.pack_auth_data(self.auth_data() + buf[:datalen]))
             buf = buf[datalen:]
             self.has_sent_header = True
-        while len(buf) > self.unit_len:
-            ret += self.pack_data(buf[:self.unit_len])
-            buf = buf[self.unit_len:]
-        ret += self.pack_data(buf)
-        return ret
+        return pack_frames(buf, self.unit_len, self.rnd_datas, ret)
 
     def client_post_decrypt(self, buf):
         if self.raw_trans:
             return buf
-        self.recv_buf += buf
-        out_buf = b''
-        while len(self.recv_buf) > 2:
-            length = struct.unpack('>H', self.recv_buf[:2])[0]
+        buf = self.recv_buf.feed(buf)
+        pos = 0
+        out_buf = []
+        while len(buf) - pos > 2:
+            length = struct.unpack_from('>H', buf, pos)[0]
             if length >= 8192 or length < 7:
                 self.raw_trans = True
-                self.recv_buf = b''
+                self.recv_buf.clear()
                 raise Exception('client_post_decrypt data error')
-            if length > len(self.recv_buf):
+            if length > len(buf) - pos:
                 break
+            frame = buf[pos:pos + length]
+            pos += length
 
-            if struct.pack('<I', zlib.adler32(self.recv_buf[:length - 4]) & 0xFFFFFFFF) != self.recv_buf[length - 4:length]:
+            if struct.pack('<I', zlib.adler32(frame[:length - 4]) & 0xFFFFFFFF) != frame[length - 4:length]:
                 self.raw_trans = True
-                self.recv_buf = b''
+                self.recv_buf.clear()
                 raise Exception('client_post_decrypt data uncorrect checksum')
 
-            pos = common.ord(self.recv_buf[2]) + 2
-            out_buf += self.recv_buf[pos:length - 4]
-            self.recv_buf = self.recv_buf[length:]
+            start = common.ord(frame[2]) + 2
+            out_buf.append(frame[start:length - 4])
 
+        self.recv_buf.consume(pos)
+        out_buf = b''.join(out_buf)
         if out_buf:
             self.decrypt_packet_num += 1
         return out_buf
@@ -441,40 +532,36 @@ class auth_sha1(verify_base):
     def server_pre_encrypt(self, buf):
         if self.raw_trans:
             return buf
-        ret = b''
-        while len(buf) > self.unit_len:
-            ret += self.pack_data(buf[:self.unit_len])
-            buf = buf[self.unit_len:]
-        ret += self.pack_data(buf)
-        return ret
+        return pack_frames(buf, self.unit_len, self.rnd_datas)
 
     def server_post_decrypt(self, buf):
         if self.raw_trans:
             return buf
-        self.recv_buf += buf
-        out_buf = b''
+        buf = self.recv_buf.feed(buf)
+        pos = 0
+        out_buf = []
         if not self.has_recv_header:
-            if len(self.recv_buf) < 4:
+            if len(buf) < 4:
                 return b''
-            crc = struct.pack('<I', binascii.crc32(self.server_info.key) & 0xFFFFFFFF)
-            if crc != self.recv_buf[:4]:
+            key = self.server_info.data.get_auth_key(self.server_info.key)
+            if key.crc != buf[:4]:
                 if self.method == 'auth_sha1':
                     return b'E'
                 else:
                     self.raw_trans = True
-                    return self.recv_buf
-            length = struct.unpack('>H', self.recv_buf[4:6])[0]
-            if length > len(self.recv_buf):
+                    return buf
+            length = struct.unpack('>H', buf[4:6])[0]
+            if length > len(buf):
                 return b''
-            sha1data = hmac.new(self.server_info.recv_iv + self.server_info.key, self.recv_buf[:length - 10], hashlib.sha1).digest()[:10]
-            if sha1data != self.recv_buf[length - 10:length]:
+            sha1data = key.hmac_sha1(self.server_info.recv_iv, buf[:length - 10])[:10]
+            if sha1data != buf[length - 10:length]:
                 logging.error('auth_sha1 data uncorrect auth HMAC-SHA1')
                 return b'E'
-            pos = common.ord(self.recv_buf[6]) + 6
-            out_buf = self.recv_buf[pos:length - 10]
+            start = common.ord(buf[6]) + 6
+            out_buf = buf[start:length - 10]
             if len(out_buf) < 12:
                 self.raw_trans = True
-                self.recv_buf = b''
+                self.recv_buf.clear()
                 logging.info('auth_sha1: too short')
                 return b'E'
             utc_time = struct.unpack('<I', out_buf[:4])[0]
@@ -484,48 +571,51 @@ class auth_sha1(verify_base):
             if time_dif < -self.max_time_dif or time_dif > self.max_time_dif \
                     or common.int32(utc_time - self.server_info.data.startup_time) < -self.max_time_dif / 2:
                 self.raw_trans = True
-                self.recv_buf = b''
+                self.recv_buf.clear()
                 logging.info('auth_sha1: wrong timestamp, time_dif %d, data %s' % (time_dif, binascii.hexlify(out_buf),))
                 return b'E'
             elif self.server_info.data.insert(client_id, connection_id):
                 self.has_recv_header = True
-                out_buf = out_buf[12:]
+                out_buf = [out_buf[12:]]
                 self.client_id = client_id
                 self.connection_id = connection_id
             else:
                 self.raw_trans = True
-                self.recv_buf = b''
+                self.recv_buf.clear()
                 logging.info('auth_sha1: auth fail, data %s' % (binascii.hexlify(out_buf),))
                 return b'E'
-            self.recv_buf = self.recv_buf[length:]
+            pos = length
             self.has_recv_header = True
 
-        while len(self.recv_buf) > 2:
-            length = struct.unpack('>H', self.recv_buf[:2])[0]
+        while len(buf) - pos > 2:
+            length = struct.unpack_from('>H', buf, pos)[0]
             if length >= 8192 or length < 7:
                 self.raw_trans = True
-                self.recv_buf = b''
+                self.recv_buf.clear()
                 if self.decrypt_packet_num == 0:
                     logging.info('auth_sha1: over size')
                     return b'E'
                 else:
                     raise Exception('server_post_decrype data error')
-            if length > len(self.recv_buf):
+            if length > len(buf) - pos:
                 break
+            frame = buf[pos:pos + length]
+            pos += length
 
-            if struct.pack('<I', zlib.adler32(self.recv_buf[:length - 4]) & 0xFFFFFFFF) != self.recv_buf[length - 4:length]:
-                logging.info('auth_sha1: checksum error, data %s' % (binascii.hexlify(self.recv_buf[:length]),))
+            if struct.pack('<I', zlib.adler32(frame[:length - 4]) & 0xFFFFFFFF) != frame[length - 4:length]:
+                logging.info('auth_sha1: checksum error, data %s' % (binascii.hexlify(frame[:length]),))
                 self.raw_trans = True
-                self.recv_buf = b''
+                self.recv_buf.clear()
                 if self.decrypt_packet_num == 0:
                     return b'E'
                 else:
                     raise Exception('server_post_decrype data uncorrect checksum')
 
-            pos = common.ord(self.recv_buf[2]) + 2
-            out_buf += self.recv_buf[pos:length - 4]
-            self.recv_buf = self.recv_buf[length:]
+            start = common.ord(frame[2]) + 2
+            out_buf.append(frame[start:length - 4])
 
+        self.recv_buf.consume(pos)
+        out_buf = b''.join(out_buf)
         if out_buf:
             self.server_info.data.update(self.client_id, self.connection_id)
             self.decrypt_packet_num += 1
@@ -536,6 +626,7 @@ class obfs_auth_v2_data(object):
         self.client_id = lru_cache.LRUCache()
         self.local_client_id = b''
         self.connection_id = 0
+        self.auth_key = None
         self.set_max_client(64) # max active client count
 
     def update(self, client_id, connection_id):
@@ -546,6 +637,11 @@ class obfs_auth_v2_data(object):
         self.max_client = max_client
         self.max_buffer = max(self.max_client * 2, 1024)
 
+    def get_auth_key(self, key, salt=b''):
+        if self.auth_key is None or self.auth_key.key != key:
+            self.auth_key = auth_key(key, salt)
+        return self.auth_key
+
     def insert(self, client_id, connection_id):
         if self.client_id.get(client_id, None) is None or not self.client_id[client_id].enable:
             if self.client_id.first() is None or len(self.client_id) < self.max_client:
@@ -573,7 +669,7 @@ class obfs_auth_v2_data(object):
 class auth_sha1_v2(verify_base):
     def __init__(self, method):
         super(auth_sha1_v2, self).__init__(method)
-        self.recv_buf = b''
+        self.recv_buf = plain.frame_buffer()
         self.unit_len = 8100
         self.decrypt_packet_num = 0
         self.raw_trans = False
@@ -605,23 +701,38 @@ class auth_sha1_v2(verify_base):
         rnd_data = os.urandom(struct.unpack('>H', os.urandom(2))[0] % 1024)
         return common.chr(255) + struct.pack('>H', len(rnd_data) + 3) + rnd_data
 
-    def pack_data(self, buf):
-        if len(buf) == 0:
-            return b''
-        data = self.rnd_data(len(buf)) + buf
-        data = struct.pack('>H', len(data) + 6) + data
-        adler32 = zlib.adler32(data) & 0xFFFFFFFF
-        data += struct.pack('<I', adler32)
-        return data
+    def rnd_datas(self, sizes):
+        # rnd_data of every size, one os.urandom call draws the lengths and
+        # another one the bytes of all the pieces
+        if len(sizes) == 1:
+            return [self.rnd_data(sizes[0])]
+        if sizes[-1] > 1300:
+            # only the last piece can be shorter than unit_len
+            return [b'\x01'] * len(sizes)
+        rnd_lens = struct.unpack('>%dH' % len(sizes), os.urandom(2 * len(sizes)))
+        rnd_lens = [0 if size > 1300 else (rnd_len % 128 if size > 400 else rnd_len % 1024)
+                    for size, rnd_len in zip(sizes, rnd_lens)]
+        rnd = os.urandom(sum(rnd_lens))
+        pos = 0
+        datas = []
+        for size, rnd_len in zip(sizes, rnd_lens):
+            if size > 1300:
+                datas.append(b'\x01')
+            elif size > 400:
+                datas.append(common.chr(rnd_len + 1) + rnd[pos:pos + rnd_len])
+            else:
+                datas.append(common.chr(255) + struct.pack('>H', rnd_len + 3) + rnd[pos:pos + rnd_len])
+            pos += rnd_len
+        return datas
 
     def pack_auth_data(self, buf):
         if len(buf) == 0:
             return b''
         data = self.rnd_data(len(buf)) + buf
         data = struct.pack('>H', len(data) + 16) + data
-        crc = binascii.crc32(self.salt + self.server_info.key) & 0xFFFFFFFF
-        data = struct.pack('<I', crc) + data
-        data += hmac.new(self.server_info.iv + self.server_info.key, data, hashlib.sha1).digest()[:10]
+        key = self.server_info.data.get_auth_key(self.server_info.key, self.salt)
+        data = key.crc + data
+        data += key.hmac_sha1(self.server_info.iv, data)[:10]
         return data
 
     def auth_data(self):
@@ -636,46 +747,46 @@ class auth_sha1_v2(verify_base):
                 struct.pack('<I', self.server_info.data.connection_id)])
 
     def client_pre_encrypt(self, buf):
-        ret = b''
+        ret = []
         if not self.has_sent_header:
             head_size = self.get_head_size(buf, 30)
             datalen = min(len(buf), random.randint(0, 31) + head_size)
-            ret += self.pack_auth_data(self.auth_data() + buf[:datalen])
+            ret.append(self.pack_auth_data(self.auth_data() + buf[:datalen]))
             buf = buf[datalen:]
             self.has_sent_header = True
-        while len(buf) > self.unit_len:
-            ret += self.pack_data(buf[:self.unit_len])
-            buf = buf[self.unit_len:]
-        ret += self.pack_data(buf)
-        return ret
+        return pack_frames(buf, self.unit_len, self.rnd_datas, ret)
 
     def client_post_decrypt(self, buf):
         if self.raw_trans:
             return buf
-        self.recv_buf += buf
-        out_buf = b''
-        while len(self.recv_buf) > 2:
-            length = struct.unpack('>H', self.recv_buf[:2])[0]
+        buf = self.recv_buf.feed(buf)
+        pos = 0
+        out_buf = []
+        while len(buf) - pos > 2:
+            length = struct.unpack_from('>H', buf, pos)[0]
             if length >= 8192 or length < 7:
                 self.raw_trans = True
-                self.recv_buf = b''
+                self.recv_buf.clear()
                 raise Exception('client_post_decrypt data error')
-            if length > len(self.recv_buf):
+            if length > len(buf) - pos:
                 break
+            frame = buf[pos:pos + length]
+            pos += length
 
-            if struct.pack('<I', zlib.adler32(self.recv_buf[:length - 4]) & 0xFFFFFFFF) != self.recv_buf[length - 4:length]:
+            if struct.pack('<I', zlib.adler32(frame[:length - 4]) & 0xFFFFFFFF) != frame[length - 4:length]:
                 self.raw_trans = True
-                self.recv_buf = b''
+                self.recv_buf.clear()
                 raise Exception('client_post_decrypt data uncorrect checksum')
 
-            pos = common.ord(self.recv_buf[2])
-            if pos < 255:
-                pos += 2
+            start = common.ord(frame[2])
+            if start < 255:
+                start += 2
             else:
-                pos = struct.unpack('>H', self.recv_buf[3:5])[0] + 2
-            out_buf += self.recv_buf[pos:length - 4]
-            self.recv_buf = self.recv_buf[length:]
+                start = struct.unpack('>H', frame[3:5])[0] + 2
+            out_buf.append(frame[start:length - 4])
 
+        self.recv_buf.consume(pos)
+        out_buf = b''.join(out_buf)
         if out_buf:
             self.decrypt_packet_num += 1
         return out_buf
@@ -683,91 +794,90 @@ class auth_sha1_v2(verify_base):
     def server_pre_encrypt(self, buf):
         if self.raw_trans:
             return buf
-        ret = b''
-        while len(buf) > self.unit_len:
-            ret += self.pack_data(buf[:self.unit_len])
-            buf = buf[self.unit_len:]
-        ret += self.pack_data(buf)
-        return ret
+        return pack_frames(buf, self.unit_len, self.rnd_datas)
 
     def server_post_decrypt(self, buf):
         if self.raw_trans:
             return buf
-        self.recv_buf += buf
-        out_buf = b''
+        buf = self.recv_buf.feed(buf)
+        pos = 0
+        out_buf = []
         if not self.has_recv_header:
-            if len(self.recv_buf) < 4:
+            if len(buf) < 4:
                 return b''
-            crc = struct.pack('<I', binascii.crc32(self.salt + self.server_info.key) & 0xFFFFFFFF)
-            if crc != self.recv_buf[:4]:
+            key = self.server_info.data.get_auth_key(self.server_info.key, self.salt)
+            if key.crc != buf[:4]:
                 if self.method == 'auth_sha1_v2':
                     return b'E'
                 else:
                     self.raw_trans = True
-                    return self.recv_buf
-            length = struct.unpack('>H', self.recv_buf[4:6])[0]
-            if length > len(self.recv_buf):
+                    return buf
+            length = struct.unpack('>H', buf[4:6])[0]
+            if length > len(buf):
                 return b''
-            sha1data = hmac.new(self.server_info.recv_iv + self.server_info.key, self.recv_buf[:length - 10], hashlib.sha1).digest()[:10]
-            if sha1data != self.recv_buf[length - 10:length]:
+            sha1data = key.hmac_sha1(self.server_info.recv_iv, buf[:length - 10])[:10]
+            if sha1data != buf[length - 10:length]:
                 logging.error('auth_sha1_v2 data uncorrect auth HMAC-SHA1')
                 return b'E'
-            pos = common.ord(self.recv_buf[6])
-            if pos < 255:
-                pos += 6
+            start = common.ord(buf[6])
+            if start < 255:
+                start += 6
             else:
-                pos = struct.unpack('>H', self.recv_buf[7:9])[0] + 6
-            out_buf = self.recv_buf[pos:length - 10]
+                start = struct.unpack('>H', buf[7:9])[0] + 6
+            out_buf = buf[start:length - 10]
             if len(out_buf) < 8:
                 self.raw_trans = True
-                self.recv_buf = b''
+                self.recv_buf.clear()
                 logging.info('auth_sha1_v2: too short')
                 return b'E'
             client_id = struct.unpack('<Q', out_buf[:8])[0]
             connection_id = struct.unpack('<I', out_buf[8:12])[0]
             if self.server_info.data.insert(client_id, connection_id):
                 self.has_recv_header = True
-                out_buf = out_buf[12:]
+                out_buf = [out_buf[12:]]
                 self.client_id = client_id
                 self.connection_id = connection_id
             else:
                 self.raw_trans = True
-                self.recv_buf = b''
+                self.recv_buf.clear()
                 logging.info('auth_sha1_v2: auth fail, data %s' % (binascii.hexlify(out_buf),))
                 return b'E'
-            self.recv_buf = self.recv_buf[length:]
+            pos = length
             self.has_recv_header = True
 
-        while len(self.recv_buf) > 2:
-            length = struct.unpack('>H', self.recv_buf[:2])[0]
+        while len(buf) - pos > 2:
+            length = struct.unpack_from('>H', buf, pos)[0]
             if length >= 8192 or length < 7:
                 self.raw_trans = True
-                self.recv_buf = b''
+                self.recv_buf.clear()
                 if self.decrypt_packet_num == 0:
                     logging.info('auth_sha1_v2: over size')
                     return b'E'
                 else:
                     raise Exception('server_post_decrype data error')
-            if length > len(self.recv_buf):
+            if length > len(buf) - pos:
                 break
+            frame = buf[pos:pos + length]
+            pos += length
 
-            if struct.pack('<I', zlib.adler32(self.recv_buf[:length - 4]) & 0xFFFFFFFF) != self.recv_buf[length - 4:length]:
-                logging.info('auth_sha1: checksum error, data %s' % (binascii.hexlify(self.recv_buf[:length]),))
+            if struct.pack('<I', zlib.adler32(frame[:length - 4]) & 0xFFFFFFFF) != frame[length - 4:length]:
+                logging.info('auth_sha1: checksum error, data %s' % (binascii.hexlify(frame[:length]),))
                 self.raw_trans = True
-                self.recv_buf = b''
+                self.recv_buf.clear()
                 if self.decrypt_packet_num == 0:
                     return b'E'
                 else:
                     raise Exception('server_post_decrype data uncorrect checksum')
 
-            pos = common.ord(self.recv_buf[2])
-            if pos < 255:
-                pos += 2
+            start = common.ord(frame[2])
+            if start < 255:
+                start += 2
             else:
-                pos = struct.unpack('>H', self.recv_buf[3:5])[0] + 2
-            out_buf += self.recv_buf[pos:length - 4]
-            self.recv_buf = self.recv_buf[length:]
+                start = struct.unpack('>H', frame[3:5])[0] + 2
+            out_buf.append(frame[start:length - 4])
 
+        self.recv_buf.consume(pos)
+        out_buf = b''.join(out_buf)
         if out_buf:
             self.server_info.data.update(self.client_id, self.connection_id)
             self.decrypt_packet_num += 1
@@ -62,7 +62,7 @@ class http_simple(plain.plain):
         self.has_recv_header = False
         self.host = None
         self.port = 0
-        self.recv_buffer = b''
+        self.recv_buffer = plain.frame_buffer()
         self.user_agent = [b"Mozilla/5.0 (Windows NT 6.3; WOW64; rv:40.0) Gecko/20100101 Firefox/40.0",
             b"Mozilla/5.0 (Windows NT 6.3; WOW64; rv:40.0) Gecko/20100101 Firefox/44.0",
             b"Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2228.0 Safari/537.36",
@@ -152,8 +152,7 @@ class http_simple(plain.plain):
         if self.has_recv_header:
             return (buf, True, False)
 
-        self.recv_buffer += buf
-        buf = self.recv_buffer
+        buf = self.recv_buffer.feed(buf)
         if len(buf) > 10:
             if match_begin(buf, b'GET /') or match_begin(buf, b'POST /'):
                 if len(buf) > 65536:
@@ -221,8 +220,7 @@ class http_post(http_simple):
         if self.has_recv_header:
             return (buf, True, False)
 
-        self.recv_buffer += buf
-        buf = self.recv_buffer
+        buf = self.recv_buffer.feed(buf)
         if len(buf) > 10:
             if match_begin(buf, b'GET ') or match_begin(buf, b'POST '):
                 if len(buf) > 65536:
@@ -52,7 +52,7 @@ class mysql_simple(plain.plain):
     def __init__(self, method):
         self.method = method
         self.raw_trans = False
-        self.recv_buffer = b''
+        self.recv_buffer = plain.frame_buffer()
         self.send_pack_num = 0
         self.recv_pack_num = 0
 
@@ -61,17 +61,19 @@ class mysql_simple(plain.plain):
         return data
 
     def client_decode(self, buf):
-        self.recv_buffer += buf
-        ret = b''
-        while len(self.recv_buffer) > 4:
-            size = struct.unpack('<I', self.recv_buffer[:4])[0]
+        buf = self.recv_buffer.feed(buf)
+        pos = 0
+        ret = []
+        while len(buf) - pos > 4:
+            size = struct.unpack_from('<I', buf, pos)[0]
             size &= 0xffffff
-            if size + 4 >= len(self.recv_buffer):
+            if size + 4 >= len(buf) - pos:
                 break
-            ret += self.recv_buffer[4:size + 4]
+            ret.append(buf[pos + 4:pos + size + 4])
             self.recv_pack_num += 1
-            self.recv_buffer = self.recv_buffer[size + 4:]
-        return (ret, False)
+            pos += size + 4
+        self.recv_buffer.consume(pos)
+        return (b''.join(ret), False)
 
     def server_encode(self, buf):
         if self.raw_trans:
@@ -90,20 +92,22 @@ class mysql_simple(plain.plain):
         if self.raw_trans:
             return (buf, True, False)
 
-        self.recv_buffer += buf
-        ret = b''
-        while len(self.recv_buffer) > 4:
-            size = struct.unpack('<I', self.recv_buffer[:4])[0]
+        buf = self.recv_buffer.feed(buf)
+        pos = 0
+        ret = []
+        while len(buf) - pos > 4:
+            size = struct.unpack_from('<I', buf, pos)[0]
             if self.recv_pack_num == 0 and size > 0xffff:
                 return self.decode_error_return(buf)
             size &= 0xffffff
-            if size + 4 >= len(self.recv_buffer):
+            if size + 4 >= len(buf) - pos:
                 break
-            ret += self.recv_buffer[4:size + 4]
+            ret.append(buf[pos + 4:pos + size + 4])
             self.recv_pack_num += 1
             self.send_pack_num = 0
-            self.recv_buffer = self.recv_buffer[size + 4:]
+            pos += size + 4
+        self.recv_buffer.consume(pos)
         # (buffer_to_recv, is_need_decrypt, is_need_to_encode_and_send_back)
-        return (ret, False, True)
+        return (b''.join(ret), False, True)
 
 
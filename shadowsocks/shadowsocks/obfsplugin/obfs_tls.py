@@ -33,7 +33,6 @@ import string
 from shadowsocks import common
 from shadowsocks.obfsplugin import plain
 from shadowsocks.common import to_bytes, to_str, ord
-from shadowsocks import lru_cache
 
 def create_tls_obfs(method):
     return tls_simple(method)
@@ -59,6 +58,33 @@ def match_begin(str1, str2):
             return True
     return False
 
+# the most application data put in one record by the server
+TLS_RECORD_SIZE = 8192
+
+if bytes != str:
+    # bytes.join takes memoryview slices, so the data of a record is
+    # only copied by the join
+    record_view = memoryview
+else:
+    def record_view(buf):
+        return buf
+
+def pack_records(head, buf):
+    # application data records of at most TLS_RECORD_SIZE bytes for buf,
+    # head is the record type and version. the record headers and the
+    # pieces of buf are joined once
+    if len(buf) <= TLS_RECORD_SIZE:
+        if not buf:
+            return b''
+        return b''.join([head, struct.pack('>H', len(buf)), buf])
+    view = record_view(buf)
+    ret = []
+    for i in range(0, len(buf), TLS_RECORD_SIZE):
+        data = view[i:i + TLS_RECORD_SIZE]
+        ret.append(head + struct.pack('>H', len(data)))
+        ret.append(data)
+    return b''.join(ret)
+
 class tls_simple(plain.plain):
     def __init__(self, method):
         self.method = method
@@ -131,9 +157,38 @@ class obfs_client_data(object):
         self.client_id = cid
         self.auth_code = {}
 
+class replay_filter(object):
+    # the handshake ids seen in the last timeout seconds
+    #
+    # the ids are kept in sets, one for every timeout / (BUCKETS - 1)
+    # seconds. a lookup and an insert are O(1) whatever the handshake rate,
+    # and old ids go away a whole set at a time instead of being swept one
+    # by one. an id is remembered for timeout to timeout + timeout /
+    # (BUCKETS - 1) seconds
+
+    BUCKETS = 6
+
+    def __init__(self, timeout):
+        self.interval = float(timeout) / (self.BUCKETS - 1)
+        self.epochs = [-1] * self.BUCKETS
+        self.buckets = [set() for i in range(self.BUCKETS)]
+
+    def add(self, key):
+        # remembers key, returns False if it was already seen
+        epoch = int(time.time() / self.interval)
+        for i in range(self.BUCKETS):
+            if self.epochs[i] > epoch - self.BUCKETS and key in self.buckets[i]:
+                return False
+        i = epoch % self.BUCKETS
+        if self.epochs[i] != epoch:
+            self.epochs[i] = epoch
+            self.buckets[i] = set()
+        self.buckets[i].add(key)
+        return True
+
 class obfs_auth_data(object):
     def __init__(self):
-        self.client_data = lru_cache.LRUCache(60 * 5)
+        self.client_data = replay_filter(60 * 5)
         self.client_id = os.urandom(32)
         self.startup_time = int(time.time() - 60 * 30) & 0xFFFFFFFF
 
@@ -266,11 +321,9 @@ class tls_auth(plain.plain):
         if sha1 != verifyid[22:]:
             logging.info("tls_auth wrong sha1")
             return self.decode_error_return(ogn_buf)
-        if self.server_info.data.client_data.get(verifyid[:22]):
+        if not self.server_info.data.client_data.add(verifyid[:22]):
             logging.info("replay attack detect, id = %s" % (binascii.hexlify(verifyid)))
             return self.decode_error_return(ogn_buf)
-        self.server_info.data.client_data.sweep()
-        self.server_info.data.client_data[verifyid[:22]] = sessionid
         # (buffer_to_recv, is_need_decrypt, is_need_to_encode_and_send_back)
         return (b'', False, True)
 
@@ -279,7 +332,7 @@ class tls_ticket_auth(plain.plain):
         self.method = method
         self.handshake_status = 0
         self.send_buffer = b''
-        self.recv_buffer = b''
+        self.recv_buffer = plain.frame_buffer()
         self.client_id = b''
         self.max_time_dif = 60 * 60 # time dif (second) setting
         self.tls_version = b'\x03\x03'
@@ -335,24 +388,31 @@ class tls_ticket_auth(plain.plain):
             return ret
         return b''
 
+    def decode_records(self, buf):
+        # the data of all the complete application data records, read in
+        # place by offset and joined once
+        ret = []
+        buf = self.recv_buffer.feed(buf)
+        view = record_view(buf)
+        pos = 0
+        while len(buf) - pos > 5:
+            if ord(buf[pos]) != 0x17:
+                logging.info("data = %s" % (binascii.hexlify(buf[pos:])))
+                raise Exception('server_decode appdata error')
+            size = struct.unpack_from('>H', buf, pos + 3)[0]
+            if len(buf) - pos < size + 5:
+                break
+            ret.append(view[pos + 5:pos + size + 5])
+            pos += size + 5
+        self.recv_buffer.consume(pos)
+        return b''.join(ret)
+
     def client_decode(self, buf):
         if self.handshake_status == -1:
             return (buf, False)
 
         if self.handshake_status == 8:
-            ret = b''
-            self.recv_buffer += buf
-            while len(self.recv_buffer) > 5:
-                if ord(self.recv_buffer[0]) != 0x17:
-                    logging.info("data = %s" % (binascii.hexlify(self.recv_buffer)))
-                    raise Exception('server_decode appdata error')
-                size = struct.unpack('>H', self.recv_buffer[3:5])[0]
-                if len(self.recv_buffer) < size + 5:
-                    break
-                buf = self.recv_buffer[5:size+5]
-                ret += buf
-                self.recv_buffer = self.recv_buffer[size+5:]
-            return (ret, False)
+            return (self.decode_records(buf), False)
 
         if len(buf) < 11 + 32 + 1 + 32:
             raise Exception('client_decode data error')
@@ -365,13 +425,7 @@ class tls_ticket_auth(plain.plain):
         if self.handshake_status == -1:
             return buf
         if self.handshake_status == 8:
-            ret = b''
-            while len(buf) > 8192:
-                ret += b"\x17" + self.tls_version + struct.pack('>H', 8192) + buf[:8192]
-                buf = buf[8192:]
-            if len(buf) > 0:
-                ret += b"\x17" + self.tls_version + struct.pack('>H', len(buf)) + buf
-            return ret
+            return pack_records(b"\x17" + self.tls_version, buf)
         self.handshake_status = 3
         data = self.tls_version + self.pack_auth_data(self.client_id) + b"\x20" + self.client_id + binascii.unhexlify(b"c02f000005ff01000100")
         data = b"\x02\x00" + struct.pack('>H', len(data)) + data #server hello
@@ -392,18 +446,7 @@ class tls_ticket_auth(plain.plain):
             return (buf, True, False)
 
         if self.handshake_status == 8:
-            ret = b''
-            self.recv_buffer += buf
-            while len(self.recv_buffer) > 5:
-                if ord(self.recv_buffer[0]) != 0x17:
-                    logging.info("data = %s" % (binascii.hexlify(self.recv_buffer)))
-                    raise Exception('server_decode appdata error')
-                size = struct.unpack('>H', self.recv_buffer[3:5])[0]
-                if len(self.recv_buffer) < size + 5:
-                    break
-                ret += self.recv_buffer[5:size+5]
-                self.recv_buffer = self.recv_buffer[size+5:]
-            return (ret, True, False)
+            return (self.decode_records(buf), True, False)
 
         if self.handshake_status == 3:
             verify = buf
@@ -419,7 +462,7 @@ class tls_ticket_auth(plain.plain):
                 raise Exception('server_decode data error')
             if len(buf) < 37:
                 raise Exception('server_decode data error')
-            self.recv_buffer = buf[37:]
+            self.recv_buffer.feed(buf[37:])
             self.handshake_status = 8
             return self.server_decode(b'')
 
@@ -464,11 +507,9 @@ class tls_ticket_auth(plain.plain):
         if sha1 != verifyid[22:]:
             logging.info("tls_auth wrong sha1")
             return self.decode_error_return(ogn_buf)
-        if self.server_info.data.client_data.get(verifyid[:22]):
+        if not self.server_info.data.client_data.add(verifyid[:22]):
             logging.info("replay attack detect, id = %s" % (binascii.hexlify(verifyid)))
             return self.decode_error_return(ogn_buf)
-        self.server_info.data.client_data.sweep()
-        self.server_info.data.client_data[verifyid[:22]] = sessionid
         # (buffer_to_recv, is_need_decrypt, is_need_to_encode_and_send_back)
         return (b'', False, True)
 
@@ -32,6 +32,43 @@ obfs_map = {
         'origin': (create_obfs,),
 }
 
+def pack_units(pack_data, buf, unit_len, out=None):
+    # frames buf with pack_data in pieces of at most unit_len bytes, after
+    # the frames already in out, and joins all of them once
+    if out is None:
+        out = []
+    for i in range(0, len(buf), unit_len):
+        out.append(pack_data(buf[i:i + unit_len]))
+    return b''.join(out)
+
+class frame_buffer(object):
+    # received data waiting to be cut into frames
+    #
+    # feed() returns all the unread data, the caller walks its frames with
+    # an offset and gives the offset of the first byte it did not use to
+    # consume(). the unread tail is copied once for every read instead of
+    # the rest of the buffer for every frame, and a read that ends on a
+    # frame boundary leaves nothing, so the next one is used as it is
+    def __init__(self):
+        self.data = b''
+
+    def __len__(self):
+        return len(self.data)
+
+    def feed(self, buf):
+        if self.data:
+            self.data += buf
+        else:
+            self.data = buf
+        return self.data
+
+    def consume(self, length):
+        if length:
+            self.data = self.data[length:]
+
+    def clear(self):
+        self.data = b''
+
 class plain(object):
     def __init__(self, method):
         self.method = method
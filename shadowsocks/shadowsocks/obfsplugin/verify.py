@@ -91,7 +91,7 @@ class verify_base(plain.plain):
 class verify_simple(verify_base):
     def __init__(self, method):
         super(verify_simple, self).__init__(method)
-        self.recv_buf = b''
+        self.recv_buf = plain.frame_buffer()
         self.unit_len = 8100
         self.decrypt_packet_num = 0
         self.raw_trans = False
@@ -107,77 +107,75 @@ class verify_simple(verify_base):
         return data
 
     def client_pre_encrypt(self, buf):
-        ret = b''
-        while len(buf) > self.unit_len:
-            ret += self.pack_data(buf[:self.unit_len])
-            buf = buf[self.unit_len:]
-        ret += self.pack_data(buf)
-        return ret
+        return plain.pack_units(self.pack_data, buf, self.unit_len)
 
     def client_post_decrypt(self, buf):
         if self.raw_trans:
             return buf
-        self.recv_buf += buf
-        out_buf = b''
-        while len(self.recv_buf) > 2:
-            length = struct.unpack('>H', self.recv_buf[:2])[0]
+        buf = self.recv_buf.feed(buf)
+        pos = 0
+        out_buf = []
+        while len(buf) - pos > 2:
+            length = struct.unpack_from('>H', buf, pos)[0]
             if length >= 8192 or length < 7:
                 self.raw_trans = True
-                self.recv_buf = b''
+                self.recv_buf.clear()
                 raise Exception('client_post_decrypt data error')
-            if length > len(self.recv_buf):
+            if length > len(buf) - pos:
                 break
+            frame = buf[pos:pos + length]
+            pos += length
 
-            if (binascii.crc32(self.recv_buf[:length]) & 0xffffffff) != 0xffffffff:
+            if (binascii.crc32(frame[:length]) & 0xffffffff) != 0xffffffff:
                 self.raw_trans = True
-                self.recv_buf = b''
+                self.recv_buf.clear()
                 raise Exception('client_post_decrypt data uncorrect CRC32')
 
-            pos = common.ord(self.recv_buf[2]) + 2
-            out_buf += self.recv_buf[pos:length - 4]
-            self.recv_buf = self.recv_buf[length:]
+            start = common.ord(frame[2]) + 2
+            out_buf.append(frame[start:length - 4])
 
+        self.recv_buf.consume(pos)
+        out_buf = b''.join(out_buf)
         if out_buf:
             self.decrypt_packet_num += 1
         return out_buf
 
     def server_pre_encrypt(self, buf):
-        ret = b''
-        while len(buf) > self.unit_len:
-            ret += self.pack_data(buf[:self.unit_len])
-            buf = buf[self.unit_len:]
-        ret += self.pack_data(buf)
-        return ret
+        return plain.pack_units(self.pack_data, buf, self.unit_len)
 
     def server_post_decrypt(self, buf):
         if self.raw_trans:
             return buf
-        self.recv_buf += buf
-        out_buf = b''
-        while len(self.recv_buf) > 2:
-            length = struct.unpack('>H', self.recv_buf[:2])[0]
+        buf = self.recv_buf.feed(buf)
+        pos = 0
+        out_buf = []
+        while len(buf) - pos > 2:
+            length = struct.unpack_from('>H', buf, pos)[0]
             if length >= 8192 or length < 7:
                 self.raw_trans = True
-                self.recv_buf = b''
+                self.recv_buf.clear()
                 if self.decrypt_packet_num == 0:
                     return b'E'
                 else:
                     raise Exception('server_post_decrype data error')
-            if length > len(self.recv_buf):
+            if length > len(buf) - pos:
                 break
+            frame = buf[pos:pos + length]
+            pos += length
 
-            if (binascii.crc32(self.recv_buf[:length]) & 0xffffffff) != 0xffffffff:
+            if (binascii.crc32(frame[:length]) & 0xffffffff) != 0xffffffff:
                 self.raw_trans = True
-                self.recv_buf = b''
+                self.recv_buf.clear()
                 if self.decrypt_packet_num == 0:
                     return b'E'
                 else:
                     raise Exception('server_post_decrype data uncorrect CRC32')
 
-            pos = common.ord(self.recv_buf[2]) + 2
-            out_buf += self.recv_buf[pos:length - 4]
-            self.recv_buf = self.recv_buf[length:]
+            start = common.ord(frame[2]) + 2
+            out_buf.append(frame[start:length - 4])
 
+        self.recv_buf.consume(pos)
+        out_buf = b''.join(out_buf)
         if out_buf:
             self.decrypt_packet_num += 1
         return out_buf
@@ -185,7 +183,7 @@ class verify_simple(verify_base):
 class verify_deflate(verify_base):
     def __init__(self, method):
         super(verify_deflate, self).__init__(method)
-        self.recv_buf = b''
+        self.recv_buf = plain.frame_buffer()
         self.unit_len = 32700
         self.decrypt_packet_num = 0
         self.raw_trans = False
@@ -198,62 +196,60 @@ class verify_deflate(verify_base):
         return data
 
     def client_pre_encrypt(self, buf):
-        ret = b''
-        while len(buf) > self.unit_len:
-            ret += self.pack_data(buf[:self.unit_len])
-            buf = buf[self.unit_len:]
-        ret += self.pack_data(buf)
-        return ret
+        return plain.pack_units(self.pack_data, buf, self.unit_len)
 
     def client_post_decrypt(self, buf):
         if self.raw_trans:
             return buf
-        self.recv_buf += buf
-        out_buf = b''
-        while len(self.recv_buf) > 2:
-            length = struct.unpack('>H', self.recv_buf[:2])[0]
+        buf = self.recv_buf.feed(buf)
+        pos = 0
+        out_buf = []
+        while len(buf) - pos > 2:
+            length = struct.unpack_from('>H', buf, pos)[0]
             if length >= 32768 or length < 6:
                 self.raw_trans = True
-                self.recv_buf = b''
+                self.recv_buf.clear()
                 raise Exception('client_post_decrypt data error')
-            if length > len(self.recv_buf):
+            if length > len(buf) - pos:
                 break
+            frame = buf[pos:pos + length]
+            pos += length
 
-            out_buf += zlib.decompress(b'x\x9c' + self.recv_buf[2:length])
-            self.recv_buf = self.recv_buf[length:]
+            out_buf.append(zlib.decompress(b'x\x9c' + frame[2:length]))
 
+        self.recv_buf.consume(pos)
+        out_buf = b''.join(out_buf)
         if out_buf:
             self.decrypt_packet_num += 1
         return out_buf
 
     def server_pre_encrypt(self, buf):
-        ret = b''
-        while len(buf) > self.unit_len:
-            ret += self.pack_data(buf[:self.unit_len])
-            buf = buf[self.unit_len:]
-        ret += self.pack_data(buf)
-        return ret
+        return plain.pack_units(self.pack_data, buf, self.unit_len)
 
     def server_post_decrypt(self, buf):
         if self.raw_trans:
             return buf
-        self.recv_buf += buf
-        out_buf = b''
-        while len(self.recv_buf) > 2:
-            length = struct.unpack('>H', self.recv_buf[:2])[0]
+        buf = self.recv_buf.feed(buf)
+        pos = 0
+        out_buf = []
+        while len(buf) - pos > 2:
+            length = struct.unpack_from('>H', buf, pos)[0]
             if length >= 32768 or length < 6:
                 self.raw_trans = True
-                self.recv_buf = b''
+                self.recv_buf.clear()
                 if self.decrypt_packet_num == 0:
                     return None
                 else:
                     raise Exception('server_post_decrype data error')
-            if length > len(self.recv_buf):
+            if length > len(buf) - pos:
                 break
+            frame = buf[pos:pos + length]
+            pos += length
 
-            out_buf += zlib.decompress(b'\x78\x9c' + self.recv_buf[2:length])
-            self.recv_buf = self.recv_buf[length:]
+            out_buf.append(zlib.decompress(b'\x78\x9c' + frame[2:length]))
 
+        self.recv_buf.consume(pos)
+        out_buf = b''.join(out_buf)
         if out_buf:
             self.decrypt_packet_num += 1
         return out_buf
@@ -261,7 +257,7 @@ class verify_deflate(verify_base):
 class verify_sha1(verify_base):
     def __init__(self, method):
         super(verify_sha1, self).__init__(method)
-        self.recv_buf = b''
+        self.recv_buf = plain.frame_buffer()
         self.unit_len = 8100
         self.raw_trans = False
         self.pack_id = 0
@@ -283,17 +279,13 @@ class verify_sha1(verify_base):
         return data
 
     def client_pre_encrypt(self, buf):
-        ret = b''
+        ret = []
         if not self.has_sent_header:
             datalen = self.get_head_size(buf, 30)
-            ret += self.pack_auth_data(buf[:datalen])
+            ret.append(self.pack_auth_data(buf[:datalen]))
             buf = buf[datalen:]
             self.has_sent_header = True
-        while len(buf) > self.unit_len:
-            ret += self.pack_data(buf[:self.unit_len])
-            buf = buf[self.unit_len:]
-        ret += self.pack_data(buf)
-        return ret
+        return plain.pack_units(self.pack_data, buf, self.unit_len, ret)
 
     def client_post_decrypt(self, buf):
         return buf
@@ -304,43 +296,46 @@ class verify_sha1(verify_base):
     def server_post_decrypt(self, buf):
         if self.raw_trans:
             return buf
-        self.recv_buf += buf
-        out_buf = b''
+        buf = self.recv_buf.feed(buf)
+        pos = 0
+        out_buf = []
         if not self.has_recv_header:
-            if len(self.recv_buf) < 2:
+            if len(buf) < 2:
                 return b''
-            if (ord(self.recv_buf[0]) & 0x10) != 0x10:
+            if (ord(buf[0]) & 0x10) != 0x10:
                 if self.method == 'verify_sha1':
                     logging.error('Not One-time authentication header')
                     return b'E'
                 else:
                     self.raw_trans = True
-                    return self.recv_buf
-            head_size = self.get_head_size(self.recv_buf, 30)
-            if len(self.recv_buf) < head_size + 10:
+                    return buf
+            head_size = self.get_head_size(buf, 30)
+            if len(buf) < head_size + 10:
                 return b''
-            sha1data = hmac.new(self.server_info.recv_iv + self.server_info.key, self.recv_buf[:head_size], hashlib.sha1).digest()[:10]
-            if sha1data != self.recv_buf[head_size:head_size + 10]:
+            sha1data = hmac.new(self.server_info.recv_iv + self.server_info.key, buf[:head_size], hashlib.sha1).digest()[:10]
+            if sha1data != buf[head_size:head_size + 10]:
                 logging.error('server_post_decrype data uncorrect auth HMAC-SHA1')
                 return b'E'
-            out_buf = to_bytes(chr(ord(self.recv_buf[0]) & 0xEF)) + self.recv_buf[1:head_size]
-            self.recv_buf = self.recv_buf[head_size + 10:]
+            out_buf.append(to_bytes(chr(ord(buf[0]) & 0xEF)) + buf[1:head_size])
+            pos = head_size + 10
             self.has_recv_header = True
-        while len(self.recv_buf) > 2:
-            length = struct.unpack('>H', self.recv_buf[:2])[0] + 12
-            if length > len(self.recv_buf):
+        while len(buf) - pos > 2:
+            length = struct.unpack_from('>H', buf, pos)[0] + 12
+            if length > len(buf) - pos:
                 break
+            frame = buf[pos:pos + length]
+            pos += length
 
-            data = self.recv_buf[12:length]
+            data = frame[12:length]
             sha1data = hmac.new(self.server_info.recv_iv + struct.pack('>I', self.recv_id), data, hashlib.sha1).digest()[:10]
-            if sha1data != self.recv_buf[2:12]:
+            if sha1data != frame[2:12]:
                 raise Exception('server_post_decrype data uncorrect chunk HMAC-SHA1')
 
             self.recv_id = (self.recv_id + 1) & 0xFFFFFFFF
-            out_buf += data
-            self.recv_buf = self.recv_buf[length:]
+            out_buf.append(data)
 
-        return out_buf
+        self.recv_buf.consume(pos)
+        return b''.join(out_buf)
 
     def client_udp_pre_encrypt(self, buf):
         ret = self.pack_auth_data(buf)
@@ -0,0 +1,638 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# loopback load test of TCPRelay and UDPRelay, Linux/Unix only
+#
+# client -> local relay -> server relay -> echo target, every part in its
+# own process. the relays report the CPU time they used when they exit.
+#
+# usage: python relay_bench.py [-m METHOD] [-O PROTOCOL] [-o OBFS]
+#                              [--workers N] [-t SECONDS] [-c CONNECTIONS]
+#                              [-n BYTES] [--udp --pps PPS] [-j FILE]
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+import sys
+import json
+import time
+import errno
+import getopt
+import signal
+import socket
+import struct
+import logging
+import resource
+
+if __name__ == '__main__':
+    import inspect
+    file_path = os.path.dirname(os.path.realpath(inspect.getfile(inspect.currentframe())))
+    sys.path.insert(0, os.path.join(file_path, '../'))
+
+from shadowsocks import eventloop, tcprelay, udprelay, asyncdns, common, \
+    encrypt, obfs
+
+BUF_SIZE = 65536
+
+SERVER_PORT = 18388
+LOCAL_PORT = 11080
+TARGET_PORT = 19000
+
+STAGE_CONNECTING = 0
+STAGE_GREETING = 1
+STAGE_REQUEST = 2
+STAGE_STREAM = 3
+STAGE_DONE = 4
+
+
+def make_config(options):
+    return {
+        'server': '127.0.0.1',
+        'server_port': options['server_port'],
+        'local_address': '127.0.0.1',
+        'local_port': options['local_port'],
+        'password': b'benchmark',
+        'method': options['method'],
+        'protocol': options['protocol'],
+        'protocol_param': '',
+        'obfs': options['obfs'],
+        'obfs_param': '',
+        'timeout': 60,
+        'udp_timeout': 60,
+        'udp_cache': 64,
+        'fast_open': False,
+        'verbose': 0,
+        'max_connect': 4096,
+        'reuse_port': False,
+    }
+
+
+def cpu_seconds(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def report_cpu(report_fd):
+    used = cpu_seconds(resource.RUSAGE_SELF) + \
+        cpu_seconds(resource.RUSAGE_CHILDREN)
+    os.write(report_fd, common.to_bytes('%f\n' % used))
+    os.close(report_fd)
+
+
+def run_relays(config, is_local, workers, report_fd):
+    # runs in the forked relay process, on SIGTERM it writes the CPU time
+    # used by this process and its workers to report_fd and exits
+    dns_resolver = asyncdns.DNSResolver()
+    relays = [tcprelay.TCPRelay(config, dns_resolver, is_local),
+              udprelay.UDPRelay(config, dns_resolver, is_local)]
+
+    def serve(report_fd):
+        def handler(signum, _):
+            # the loop would only notice stop() after its poll timeout
+            if report_fd is not None:
+                report_cpu(report_fd)
+            os._exit(0)
+        signal.signal(signal.SIGTERM, handler)
+        loop = eventloop.EventLoop()
+        dns_resolver.add_to_loop(loop)
+        for relay in relays:
+            relay.add_to_loop(loop)
+        loop.run()
+
+    if workers <= 1:
+        serve(report_fd)
+        return
+    children = []
+    for i in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            os.close(report_fd)
+            serve(None)
+            os._exit(0)
+        children.append(pid)
+
+    def handler(signum, _):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+    signal.signal(signal.SIGTERM, handler)
+    for pid in children:
+        while True:
+            try:
+                os.waitpid(pid, 0)
+                break
+            except OSError as e:
+                if eventloop.errno_from_exception(e) != errno.EINTR:
+                    break
+    report_cpu(report_fd)
+
+
+class EchoTarget(object):
+    # echoes TCP connections and UDP datagrams back to the sender
+
+    def __init__(self, port):
+        self._tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._tcp.bind(('127.0.0.1', port))
+        self._tcp.listen(1024)
+        self._tcp.setblocking(False)
+        self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._udp.bind(('127.0.0.1', port))
+        self._udp.setblocking(False)
+        self._pending = {}
+        self._loop = None
+
+    def add_to_loop(self, loop):
+        self._loop = loop
+        loop.add(self._tcp, eventloop.POLL_IN, self)
+        loop.add(self._udp, eventloop.POLL_IN, self)
+
+    def _close(self, sock):
+        self._loop.remove(sock)
+        del self._pending[sock]
+        sock.close()
+
+    def handle_event(self, sock, fd, event):
+        if sock == self._tcp:
+            try:
+                conn, addr = self._tcp.accept()
+            except (OSError, IOError):
+                return
+            conn.setblocking(False)
+            conn.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+            self._pending[conn] = b''
+            self._loop.add(conn, eventloop.POLL_IN, self)
+        elif sock == self._udp:
+            while True:
+                try:
+                    data, addr = self._udp.recvfrom(BUF_SIZE)
+                    self._udp.sendto(data, addr)
+                except (OSError, IOError):
+                    return
+        elif sock in self._pending:
+            data = self._pending[sock]
+            if event & eventloop.POLL_IN and not data:
+                try:
+                    data = sock.recv(BUF_SIZE)
+                except (OSError, IOError) as e:
+                    if eventloop.errno_from_exception(e) in \
+                            (errno.EAGAIN, errno.EWOULDBLOCK):
+                        return
+                    data = b''
+                if not data:
+                    self._close(sock)
+                    return
+            try:
+                sent = sock.send(data)
+            except (OSError, IOError) as e:
+                if eventloop.errno_from_exception(e) not in \
+                        (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self._close(sock)
+                    return
+                sent = 0
+            data = data[sent:]
+            self._pending[sock] = data
+            # stop reading until the echo is written
+            if data:
+                self._loop.modify(sock, eventloop.POLL_OUT)
+            else:
+                self._loop.modify(sock, eventloop.POLL_IN)
+
+
+def run_target(port):
+    signal.signal(signal.SIGTERM, lambda signum, _: os._exit(0))
+    loop = eventloop.EventLoop()
+    EchoTarget(port).add_to_loop(loop)
+    loop.run()
+
+
+class TCPClient(object):
+    # one connection through the SOCKS5 port of the local relay, it sends
+    # total bytes and waits until all of them came back
+
+    def __init__(self, bench, loop, payload, total):
+        self._bench = bench
+        self._loop = loop
+        self._payload = payload
+        self._to_send = total
+        self._to_recv = total
+        self._send_buf = b''
+        self._stage = STAGE_CONNECTING
+        self._start = time.time()
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setblocking(False)
+        self._sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        try:
+            self._sock.connect(('127.0.0.1', bench.options['local_port']))
+        except (OSError, IOError) as e:
+            if eventloop.errno_from_exception(e) != errno.EINPROGRESS:
+                raise
+        loop.add(self._sock, eventloop.POLL_OUT | eventloop.POLL_ERR, self)
+
+    def _recv_exactly(self, size):
+        data = self._sock.recv(size)
+        if len(data) != size:
+            raise Exception('unexpected SOCKS5 reply')
+        return data
+
+    def _fill_send_buf(self):
+        while len(self._send_buf) < BUF_SIZE and self._to_send > 0:
+            chunk = self._payload[:self._to_send]
+            self._to_send -= len(chunk)
+            self._send_buf += chunk
+
+    def _send(self):
+        try:
+            sent = self._sock.send(self._send_buf)
+        except (OSError, IOError) as e:
+            if eventloop.errno_from_exception(e) in \
+                    (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        self._send_buf = self._send_buf[sent:]
+        self._fill_send_buf()
+        if self._send_buf:
+            self._loop.modify(self._sock, eventloop.POLL_IN |
+                              eventloop.POLL_OUT | eventloop.POLL_ERR)
+        else:
+            self._loop.modify(self._sock,
+                              eventloop.POLL_IN | eventloop.POLL_ERR)
+
+    def handle_event(self, sock, fd, event):
+        try:
+            self._handle_event(event)
+        except (OSError, IOError, Exception) as e:
+            logging.error('benchmark connection failed: %s' % e)
+            self._bench.errors += 1
+            self.close()
+
+    def _handle_event(self, event):
+        if event & eventloop.POLL_ERR:
+            raise Exception(eventloop.get_sock_error(self._sock))
+        if self._stage == STAGE_CONNECTING:
+            self._sock.send(b'\x05\x01\x00')
+            self._stage = STAGE_GREETING
+            self._loop.modify(self._sock,
+                              eventloop.POLL_IN | eventloop.POLL_ERR)
+        elif self._stage == STAGE_GREETING:
+            self._recv_exactly(2)
+            self._sock.send(b'\x05\x01\x00\x01' +
+                            socket.inet_aton('127.0.0.1') +
+                            struct.pack('>H', self._bench.options['target_port']))
+            self._stage = STAGE_REQUEST
+        elif self._stage == STAGE_REQUEST:
+            self._recv_exactly(10)
+            self._stage = STAGE_STREAM
+            self._fill_send_buf()
+            self._send()
+        elif self._stage == STAGE_STREAM:
+            if event & eventloop.POLL_IN:
+                data = self._sock.recv(BUF_SIZE)
+                if not data:
+                    raise Exception('connection closed by the relay')
+                if self._bench.setup_pending(self):
+                    # the first echoed bytes finish the setup
+                    self._bench.setup_done(self, time.time() - self._start)
+                self._to_recv -= len(data)
+                self._bench.bytes += len(data)
+                if self._to_recv <= 0:
+                    self.close()
+                    self._bench.connection_done()
+                    return
+            if event & eventloop.POLL_OUT and self._send_buf:
+                self._send()
+
+    def close(self):
+        if self._stage != STAGE_DONE:
+            self._stage = STAGE_DONE
+            self._loop.remove(self._sock)
+            self._sock.close()
+
+
+class TCPBench(object):
+    def __init__(self, options, loop):
+        self.options = options
+        self.bytes = 0
+        self.errors = 0
+        self.connections = 0
+        self.setup_latencies = []
+        self._loop = loop
+        self._payload = os.urandom(options['chunk_size'])
+        self._setup = set()
+        self._end = None
+
+    def start(self):
+        self._end = time.time() + self.options['seconds']
+        for i in range(self.options['connections']):
+            self._new_client()
+
+    def _new_client(self):
+        client = TCPClient(self, self._loop, self._payload,
+                           self.options['bytes_per_connection'])
+        self._setup.add(client)
+
+    def setup_pending(self, client):
+        return client in self._setup
+
+    def setup_done(self, client, latency):
+        self._setup.discard(client)
+        self.setup_latencies.append(latency)
+
+    def connection_done(self):
+        self.connections += 1
+        if time.time() < self._end:
+            self._new_client()
+
+    def finished(self):
+        return time.time() >= self._end
+
+
+class UDPBench(object):
+    # sends datagrams at a fixed rate through the SOCKS5 UDP port of the
+    # local relay and matches the echoes by sequence number
+
+    def __init__(self, options, loop):
+        self.options = options
+        self.bytes = 0
+        self.errors = 0
+        self.sent = 0
+        self.received = 0
+        self.rtts = []
+        self._loop = loop
+        self._header = b'\x00\x00\x00\x01' + socket.inet_aton('127.0.0.1') + \
+            struct.pack('>H', options['target_port'])
+        self._padding = os.urandom(max(0, options['chunk_size'] - 12))
+        self._socks = []
+        self._send_times = {}
+        self._start = None
+        self._end = None
+
+    def start(self):
+        for i in range(self.options['connections']):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+            self._loop.add(sock, eventloop.POLL_IN, self)
+            self._socks.append(sock)
+        self._start = time.time()
+        self._end = self._start + self.options['seconds']
+        self._send_due()
+
+    def _send_due(self):
+        # catch up with the rate that was asked for
+        now = time.time()
+        due = int((min(now, self._end) - self._start) * self.options['pps'])
+        addr = ('127.0.0.1', self.options['local_port'])
+        while self.sent < due:
+            seq = self.sent
+            sock = self._socks[seq % len(self._socks)]
+            data = self._header + struct.pack('>Q', seq) + self._padding
+            try:
+                sock.sendto(data, addr)
+            except (OSError, IOError):
+                self.errors += 1
+            self._send_times[seq] = time.time()
+            self.sent += 1
+        if now < self._end:
+            self._loop.call_later(max(0.001, 1.0 / self.options['pps']),
+                                  self._send_due)
+
+    def handle_event(self, sock, fd, event):
+        while True:
+            try:
+                data = sock.recv(BUF_SIZE)
+            except (OSError, IOError):
+                return
+            if len(data) < len(self._header) + 8:
+                continue
+            seq = struct.unpack('>Q', data[len(self._header):
+                                           len(self._header) + 8])[0]
+            sent_time = self._send_times.pop(seq, None)
+            if sent_time is not None:
+                self.rtts.append(time.time() - sent_time)
+                self.received += 1
+                self.bytes += len(data)
+
+    def finished(self):
+        # wait a moment for the last echoes
+        return time.time() >= self._end + 0.5
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * p / 100.0))
+    return values[index]
+
+
+def start_process(target, *args):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            target(*args)
+        except Exception:
+            import traceback
+            traceback.print_exc()
+        os._exit(0)
+    return pid
+
+
+def start_relay(config, is_local, workers):
+    r, w = os.pipe()
+    pid = start_process(lambda: (os.close(r),
+                                 run_relays(config, is_local, workers, w)))
+    os.close(w)
+    return pid, r
+
+
+def stop_relay(pid, report_fd):
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+    report = os.read(report_fd, 64)
+    os.close(report_fd)
+    return float(report or 0)
+
+
+def run(options):
+    config = make_config(options)
+    target_pid = start_process(run_target, options['target_port'])
+    server_pid, server_fd = start_relay(config, False, options['workers'])
+    local_pid, local_fd = start_relay(config, True, 1)
+    # give the relays time to bind
+    time.sleep(0.5)
+
+    loop = eventloop.EventLoop()
+    if options['udp']:
+        bench = UDPBench(options, loop)
+    else:
+        bench = TCPBench(options, loop)
+    start = time.time()
+    bench.start()
+
+    def check_finished():
+        if bench.finished():
+            loop.stop()
+        else:
+            loop.call_later(0.1, check_finished)
+    check_finished()
+    loop.run()
+    elapsed = time.time() - start
+
+    server_cpu = stop_relay(server_pid, server_fd)
+    local_cpu = stop_relay(local_pid, local_fd)
+    os.kill(target_pid, signal.SIGTERM)
+    os.waitpid(target_pid, 0)
+
+    gigabytes = bench.bytes * 2 / 1e9
+    result = {
+        'benchmark': 'relay',
+        'mode': options['udp'] and 'udp' or 'tcp',
+        'method': options['method'],
+        'protocol': options['protocol'],
+        'obfs': options['obfs'],
+        'workers': options['workers'],
+        'connections': options['connections'],
+        'seconds': round(elapsed, 3),
+        'bytes': bench.bytes,
+        'mb_per_s': round(bench.bytes / elapsed / 1e6, 3),
+        'errors': bench.errors,
+        'server_cpu_seconds': round(server_cpu, 3),
+        'local_cpu_seconds': round(local_cpu, 3),
+        # data crosses the server relay once each way
+        'server_cpu_seconds_per_gb': gigabytes and
+        round(server_cpu / gigabytes, 3) or None,
+    }
+    if options['udp']:
+        result['pps_target'] = options['pps']
+        result['sent'] = bench.sent
+        result['received'] = bench.received
+        result['loss'] = bench.sent and \
+            round(1 - bench.received / bench.sent, 4) or 0
+        latencies = bench.rtts
+        name = 'rtt_ms'
+    else:
+        result['completed'] = bench.connections
+        latencies = bench.setup_latencies
+        name = 'setup_ms'
+    for p in (50, 90, 99):
+        value = percentile(latencies, p)
+        result['%s_p%d' % (name, p)] = value is not None and \
+            round(value * 1000, 3) or None
+    return result
+
+
+def print_help():
+    print('''usage: relay_bench.py [OPTION]...
+Load test the TCP or UDP relay on the loopback interface.
+
+  -h, --help             show this help message and exit
+  -m METHOD              encryption method, default: aes-256-cfb
+  -O PROTOCOL            protocol plugin, default: origin
+  -o OBFS                obfs plugin, default: plain
+  --workers WORKERS      server relay workers, default: 1
+  -t SECONDS             duration, default: 10
+  -c CONNECTIONS         concurrent TCP connections or UDP sockets,
+                         default: 16
+  -n BYTES               bytes sent on every TCP connection, default: 1048576
+  -s SIZE                size of every write or datagram, default: 16384
+                         for TCP and 512 for UDP
+  --udp                  send datagrams instead of TCP streams
+  --pps PPS              datagrams per second in UDP mode, default: 10000
+  -j FILE                append the result as a JSON line to FILE
+''')
+
+
+def main():
+    logging.basicConfig(level=logging.ERROR,
+                        format='%(asctime)s %(levelname)-8s %(message)s')
+    if not hasattr(os, 'fork'):
+        print('relay_bench.py needs fork, it is only available on Unix/Linux')
+        sys.exit(1)
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'hm:O:o:t:c:n:s:j:',
+                                      ['help', 'workers=', 'udp', 'pps='])
+    except getopt.GetoptError as e:
+        print(e, file=sys.stderr)
+        print_help()
+        sys.exit(2)
+    options = {
+        'method': 'aes-256-cfb',
+        'protocol': 'origin',
+        'obfs': 'plain',
+        'workers': 1,
+        'seconds': 10.0,
+        'connections': 16,
+        'bytes_per_connection': 1024 * 1024,
+        'chunk_size': None,
+        'udp': False,
+        'pps': 10000,
+        'server_port': SERVER_PORT,
+        'local_port': LOCAL_PORT,
+        'target_port': TARGET_PORT,
+    }
+    output = None
+    for key, value in optlist:
+        if key in ('-h', '--help'):
+            print_help()
+            sys.exit(0)
+        elif key == '-m':
+            options['method'] = value
+        elif key == '-O':
+            options['protocol'] = value
+        elif key == '-o':
+            options['obfs'] = value
+        elif key == '--workers':
+            options['workers'] = int(value)
+        elif key == '-t':
+            options['seconds'] = float(value)
+        elif key == '-c':
+            options['connections'] = int(value)
+        elif key == '-n':
+            options['bytes_per_connection'] = int(value)
+        elif key == '-s':
+            options['chunk_size'] = int(value)
+        elif key == '--udp':
+            options['udp'] = True
+        elif key == '--pps':
+            options['pps'] = int(value)
+        elif key == '-j':
+            output = value
+    if options['method'] not in encrypt.method_supported:
+        print('method %s not supported' % options['method'], file=sys.stderr)
+        sys.exit(2)
+    for key in ('protocol', 'obfs'):
+        if options[key] not in obfs.method_supported:
+            print('%s %s not supported' % (key, options[key]),
+                  file=sys.stderr)
+            sys.exit(2)
+    if options['chunk_size'] is None:
+        options['chunk_size'] = options['udp'] and 512 or 16384
+
+    result = run(options)
+    for key in sorted(result.keys()):
+        print('%-28s %s' % (key, result[key]))
+    if output:
+        with open(output, 'a') as f:
+            f.write(json.dumps(result, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
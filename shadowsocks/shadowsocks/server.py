@@ -20,6 +20,7 @@ from __future__ import absolute_import, division, print_function, \
 
 import sys
 import os
+import mmap
 import logging
 import signal
 
@@ -29,7 +30,7 @@ if __name__ == '__main__':
     sys.path.insert(0, os.path.join(file_path, '../'))
 
 from shadowsocks import shell, daemon, eventloop, tcprelay, udprelay, \
-    asyncdns, manager
+    asyncdns, manager, common, shared_stat, shared_dns
 
 
 def main():
@@ -60,7 +61,17 @@ def main():
 
     tcp_servers = []
     udp_servers = []
-    dns_resolver = asyncdns.DNSResolver()
+    # workers share the hostnames any of them resolved
+    shared_dns_cache = None
+    if int(config['workers']) > 1 and os.name == 'posix':
+        try:
+            shared_dns_cache = shared_dns.SharedDNSCache(
+                int(config['workers']))
+        except (OSError, IOError, mmap.error) as e:
+            shell.print_exception(e)
+    # loaded before fork, every worker starts with the cached hostnames
+    dns_resolver = asyncdns.DNSResolver(config.get('dns_cache_file', None),
+                                        shared_dns_cache)
     if int(config['workers']) > 1:
         stat_counter_dict = None
     else:
@@ -68,38 +79,88 @@ def main():
     port_password = config['port_password']
     config_password = config.get('password', 'm')
     del config['port_password']
-    for port, password_obfs in port_password.items():
-        method = config["method"]
-        protocol = config.get("protocol", 'origin')
-        protocol_param = config.get("protocol_param", '')
-        obfs = config.get("obfs", 'plain')
-        obfs_param = config.get("obfs_param", '')
-        bind = config.get("out_bind", '')
-        bindv6 = config.get("out_bindv6", '')
-        if type(password_obfs) == list:
-            password = password_obfs[0]
-            obfs = password_obfs[1]
-            if len(password_obfs) > 2:
-                protocol = password_obfs[2]
-        elif type(password_obfs) == dict:
-            password = password_obfs.get('password', config_password)
-            method = password_obfs.get('method', method)
-            protocol = password_obfs.get('protocol', protocol)
-            protocol_param = password_obfs.get('protocol_param', protocol_param)
-            obfs = password_obfs.get('obfs', obfs)
-            obfs_param = password_obfs.get('obfs_param', obfs_param)
-            bind = password_obfs.get('bind', bind)
-            bindv6 = password_obfs.get('bindv6', bindv6)
-        else:
-            password = password_obfs
-        a_config = config.copy()
-        ipv6_ok = False
-        logging.info("server start with protocol[%s] password [%s] method [%s] obfs [%s] obfs_param [%s]" %
-                (protocol, password, a_config['method'], obfs, obfs_param))
-        if 'server_ipv6' in a_config:
+
+    # with reuse_port every worker creates and binds its own sockets after
+    # fork, instead of all workers sharing the sockets created here
+    reuse_port = int(config['workers']) > 1 and os.name == 'posix' and \
+        config.get('reuse_port', False)
+    if reuse_port and common.SO_REUSEPORT is None:
+        logging.warn('SO_REUSEPORT is not available, workers will share '
+                     'sockets')
+        reuse_port = False
+    config['reuse_port'] = reuse_port
+
+    # stat_counter_dict only lives in one process, the shared table sums the
+    # per port counters of all workers and can be exported to stat_file
+    stat_table = None
+    if (int(config['workers']) > 1 and os.name == 'posix') or \
+            config.get('stat_file', None):
+        try:
+            stat_table = shared_stat.SharedStat(
+                port_password.keys(), max(int(config['workers']), 1),
+                config.get('stat_file', None))
+        except (OSError, IOError, mmap.error) as e:
+            shell.print_exception(e)
+
+    def create_servers():
+        for port, password_obfs in port_password.items():
+            method = config["method"]
+            protocol = config.get("protocol", 'origin')
+            protocol_param = config.get("protocol_param", '')
+            obfs = config.get("obfs", 'plain')
+            obfs_param = config.get("obfs_param", '')
+            bind = config.get("out_bind", '')
+            bindv6 = config.get("out_bindv6", '')
+            water = {}
+            if type(password_obfs) == list:
+                password = password_obfs[0]
+                obfs = password_obfs[1]
+                if len(password_obfs) > 2:
+                    protocol = password_obfs[2]
+            elif type(password_obfs) == dict:
+                password = password_obfs.get('password', config_password)
+                method = password_obfs.get('method', method)
+                protocol = password_obfs.get('protocol', protocol)
+                protocol_param = password_obfs.get('protocol_param', protocol_param)
+                obfs = password_obfs.get('obfs', obfs)
+                obfs_param = password_obfs.get('obfs_param', obfs_param)
+                bind = password_obfs.get('bind', bind)
+                bindv6 = password_obfs.get('bindv6', bindv6)
+                for key in tcprelay.WATER_MARK_KEYS:
+                    if key in password_obfs:
+                        water[key] = password_obfs[key]
+            else:
+                password = password_obfs
+            a_config = config.copy()
+            ipv6_ok = False
+            logging.info("server start with protocol[%s] password [%s] method [%s] obfs [%s] obfs_param [%s]" %
+                    (protocol, password, a_config['method'], obfs, obfs_param))
+            if 'server_ipv6' in a_config:
+                try:
+                    if len(a_config['server_ipv6']) > 2 and a_config['server_ipv6'][0] == "[" and a_config['server_ipv6'][-1] == "]":
+                        a_config['server_ipv6'] = a_config['server_ipv6'][1:-1]
+                    a_config['server_port'] = int(port)
+                    a_config['password'] = password
+                    a_config['method'] = method
+                    a_config['protocol'] = protocol
+                    a_config['protocol_param'] = protocol_param
+                    a_config['obfs'] = obfs
+                    a_config['obfs_param'] = obfs_param
+                    a_config['out_bind'] = bind
+                    a_config['out_bindv6'] = bindv6
+                    a_config.update(water)
+                    a_config['server'] = a_config['server_ipv6']
+                    logging.info("starting server at [%s]:%d" %
+                                 (a_config['server'], int(port)))
+                    tcp_servers.append(tcprelay.TCPRelay(a_config, dns_resolver, False, stat_counter=stat_counter_dict, stat_table=stat_table))
+                    udp_servers.append(udprelay.UDPRelay(a_config, dns_resolver, False, stat_counter=stat_counter_dict, stat_table=stat_table))
+                    if a_config['server_ipv6'] == b"::":
+                        ipv6_ok = True
+                except Exception as e:
+                    shell.print_exception(e)
+
             try:
-                if len(a_config['server_ipv6']) > 2 and a_config['server_ipv6'][0] == "[" and a_config['server_ipv6'][-1] == "]":
-                    a_config['server_ipv6'] = a_config['server_ipv6'][1:-1]
+                a_config = config.copy()
                 a_config['server_port'] = int(port)
                 a_config['password'] = password
                 a_config['method'] = method
@@ -109,40 +170,24 @@ def main():
                 a_config['obfs_param'] = obfs_param
                 a_config['out_bind'] = bind
                 a_config['out_bindv6'] = bindv6
-                a_config['server'] = a_config['server_ipv6']
-                logging.info("starting server at [%s]:%d" %
+                a_config.update(water)
+                logging.info("starting server at %s:%d" %
                              (a_config['server'], int(port)))
-                tcp_servers.append(tcprelay.TCPRelay(a_config, dns_resolver, False, stat_counter=stat_counter_dict))
-                udp_servers.append(udprelay.UDPRelay(a_config, dns_resolver, False, stat_counter=stat_counter_dict))
-                if a_config['server_ipv6'] == b"::":
-                    ipv6_ok = True
+                tcp_servers.append(tcprelay.TCPRelay(a_config, dns_resolver, False, stat_counter=stat_counter_dict, stat_table=stat_table))
+                udp_servers.append(udprelay.UDPRelay(a_config, dns_resolver, False, stat_counter=stat_counter_dict, stat_table=stat_table))
             except Exception as e:
-                shell.print_exception(e)
+                if not ipv6_ok:
+                    shell.print_exception(e)
 
-        try:
-            a_config = config.copy()
-            a_config['server_port'] = int(port)
-            a_config['password'] = password
-            a_config['method'] = method
-            a_config['protocol'] = protocol
-            a_config['protocol_param'] = protocol_param
-            a_config['obfs'] = obfs
-            a_config['obfs_param'] = obfs_param
-            a_config['out_bind'] = bind
-            a_config['out_bindv6'] = bindv6
-            logging.info("starting server at %s:%d" %
-                         (a_config['server'], int(port)))
-            tcp_servers.append(tcprelay.TCPRelay(a_config, dns_resolver, False, stat_counter=stat_counter_dict))
-            udp_servers.append(udprelay.UDPRelay(a_config, dns_resolver, False, stat_counter=stat_counter_dict))
-        except Exception as e:
-            if not ipv6_ok:
-                shell.print_exception(e)
+    if not reuse_port:
+        create_servers()
 
     def run_server():
         def child_handler(signum, _):
             logging.warn('received SIGQUIT, doing graceful shutting down..')
             list(map(lambda s: s.close(next_tick=True),
                      tcp_servers + udp_servers))
+            dns_resolver.close(next_tick=True)
         signal.signal(getattr(signal, 'SIGQUIT', signal.SIGTERM),
                       child_handler)
 
@@ -170,6 +215,12 @@ def main():
                 if r == 0:
                     logging.info('worker started')
                     is_child = True
+                    if stat_table:
+                        stat_table.set_worker(i)
+                    if shared_dns_cache:
+                        shared_dns_cache.set_worker(i)
+                    if reuse_port:
+                        create_servers()
                     run_server()
                     break
                 else:
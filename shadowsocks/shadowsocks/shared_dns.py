@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+import mmap
+import time
+import socket
+import struct
+import binascii
+
+if __name__ == '__main__':
+    import sys
+    import inspect
+    file_path = os.path.dirname(os.path.realpath(inspect.getfile(inspect.currentframe())))
+    sys.path.insert(0, os.path.join(file_path, '../'))
+
+from shadowsocks import common
+
+# resolved hostnames, shared by all workers through a mmap
+#
+# like shared_stat, every worker only writes its own region, so no lock is
+# needed. a region is a hash table of SLOTS slots with linear probing, a
+# reader looks the hostname up in the regions of all workers.
+#
+# every slot starts with a sequence number that is odd while the slot is
+# being written, a reader that sees it odd or changed skips the slot.
+#
+# layout, little endian:
+#   header: magic(8s) workers(I) slots(I)
+#   slots:  [worker][slot] seq(I) expire(I) hash(I) hostname_len(B)
+#           count(B) pad(2) hostname(256s) [family(B) ip(16s)] * MAX_ADDRS
+
+SHARED_DNS_MAGIC = b'SSRDNS1\x00'
+
+SLOTS = 1024
+MAX_ADDRS = 4
+# slots looked at for a hostname, starting at its hash
+PROBES = 8
+
+HEADER_FORMAT = '<8sII'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+SLOT_HEAD_FORMAT = '<IIIBB2x'
+SLOT_HEAD_SIZE = struct.calcsize(SLOT_HEAD_FORMAT)
+HOSTNAME_SIZE = 256
+ADDR_SIZE = 17
+SLOT_SIZE = (SLOT_HEAD_SIZE + HOSTNAME_SIZE + MAX_ADDRS * ADDR_SIZE + 7) & ~7
+
+
+def _hash(hostname):
+    # the same in every process, unlike hash() with randomization
+    return binascii.crc32(hostname) & 0xffffffff
+
+
+class SharedDNSCache(object):
+    def __init__(self, workers=1, slots=SLOTS):
+        self._workers = workers
+        self._slots = slots
+        size = HEADER_SIZE + workers * slots * SLOT_SIZE
+        # anonymous maps are shared with the children after fork
+        self._buf = mmap.mmap(-1, size)
+        struct.pack_into(HEADER_FORMAT, self._buf, 0, SHARED_DNS_MAGIC,
+                         workers, slots)
+        self._worker = 0
+
+    def set_worker(self, worker):
+        # called in the worker after fork, before it resolves anything
+        if worker < 0 or worker >= self._workers:
+            raise ValueError('worker %d out of range' % worker)
+        self._worker = worker
+
+    def _slot_offset(self, worker, slot):
+        return HEADER_SIZE + (worker * self._slots + slot) * SLOT_SIZE
+
+    def _read_slot(self, offset, hostname, hostname_hash, now):
+        # returns (addrs, expire) if the slot holds hostname
+        buf = self._buf
+        seq, expire, slot_hash, hostname_len, count = \
+            struct.unpack_from(SLOT_HEAD_FORMAT, buf, offset)
+        if seq & 1 or slot_hash != hostname_hash or expire <= now or \
+                hostname_len != len(hostname):
+            return None
+        pos = offset + SLOT_HEAD_SIZE
+        if buf[pos:pos + hostname_len] != hostname:
+            return None
+        pos += HOSTNAME_SIZE
+        addrs = []
+        for i in range(min(count, MAX_ADDRS)):
+            if common.ord(buf[pos]) == 6:
+                addrs.append((socket.AF_INET6, socket.inet_ntop(
+                    socket.AF_INET6, buf[pos + 1:pos + 17])))
+            else:
+                addrs.append((socket.AF_INET, socket.inet_ntop(
+                    socket.AF_INET, buf[pos + 1:pos + 5])))
+            pos += ADDR_SIZE
+        if struct.unpack_from('<I', buf, offset)[0] != seq:
+            # written while it was read
+            return None
+        return addrs, expire
+
+    def get(self, hostname):
+        # returns (addrs, expire) any worker stored for hostname, or None
+        if len(hostname) >= HOSTNAME_SIZE:
+            return None
+        hostname_hash = _hash(hostname)
+        now = time.time()
+        result = None
+        for worker in range(self._workers):
+            for i in range(PROBES):
+                slot = (hostname_hash + i) % self._slots
+                entry = self._read_slot(self._slot_offset(worker, slot),
+                                        hostname, hostname_hash, now)
+                if entry and (result is None or entry[1] > result[1]):
+                    result = entry
+        return result
+
+    def put(self, hostname, addrs, expire):
+        # stores the entry in the region of this worker, in the slot that
+        # has the hostname already, an empty or expired one, or the one
+        # that expires first
+        if len(hostname) >= HOSTNAME_SIZE:
+            return
+        buf = self._buf
+        hostname_hash = _hash(hostname)
+        now = time.time()
+        target = None
+        target_expire = None
+        for i in range(PROBES):
+            offset = self._slot_offset(self._worker,
+                                       (hostname_hash + i) % self._slots)
+            seq, slot_expire, slot_hash, hostname_len, count = \
+                struct.unpack_from(SLOT_HEAD_FORMAT, buf, offset)
+            pos = offset + SLOT_HEAD_SIZE
+            if slot_hash == hostname_hash and \
+                    hostname_len == len(hostname) and \
+                    buf[pos:pos + hostname_len] == hostname:
+                target = offset
+                break
+            if slot_expire <= now:
+                slot_expire = 0
+            if target is None or slot_expire < target_expire:
+                target = offset
+                target_expire = slot_expire
+        seq = struct.unpack_from('<I', buf, target)[0]
+        struct.pack_into('<I', buf, target, (seq + 1) & 0xffffffff)
+        addrs = addrs[:MAX_ADDRS]
+        pos = target + SLOT_HEAD_SIZE
+        buf[pos:pos + len(hostname)] = hostname
+        pos += HOSTNAME_SIZE
+        for af, ip in addrs:
+            if af == socket.AF_INET6:
+                packed = b'\x06' + socket.inet_pton(af, common.to_str(ip))
+            else:
+                packed = b'\x04' + socket.inet_pton(af, common.to_str(ip))
+            buf[pos:pos + len(packed)] = packed
+            pos += ADDR_SIZE
+        struct.pack_into(SLOT_HEAD_FORMAT, buf, target, (seq + 1) & 0xffffffff,
+                         int(expire), hostname_hash, len(hostname),
+                         len(addrs))
+        # the slot can be read again once the whole entry is written
+        struct.pack_into('<I', buf, target, (seq + 2) & 0xffffffff)
+
+    def close(self):
+        if self._buf:
+            self._buf.close()
+            self._buf = None
+
+
+def test():
+    cache = SharedDNSCache(2, slots=16)
+    now = time.time()
+    cache.put(b'example.com', [(socket.AF_INET6, '2001:db8::1'),
+                               (socket.AF_INET, '127.0.0.2')], now + 60)
+    assert cache.get(b'example.com')[0] == \
+        [(socket.AF_INET6, '2001:db8::1'), (socket.AF_INET, '127.0.0.2')]
+    assert cache.get(b'example.org') is None
+
+    pid = os.fork()
+    if pid == 0:
+        cache.set_worker(1)
+        cache.put(b'example.org', [(socket.AF_INET, '127.0.0.3')], now + 60)
+        cache.put(b'nx.example.com', [], now + 30)
+        cache.put(b'old.example.com', [(socket.AF_INET, '127.0.0.4')],
+                  now - 1)
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+    # a lookup in another worker is seen by all of them
+    assert cache.get(b'example.org')[0] == [(socket.AF_INET, '127.0.0.3')]
+    assert cache.get(b'nx.example.com')[0] == []
+    assert cache.get(b'old.example.com') is None
+
+    # the table is full, the entry that expires first is replaced
+    for i in range(32):
+        cache.put(('host%d.example.com' % i).encode(), [(socket.AF_INET, '127.0.0.5')],
+                  now + 100 + i)
+    assert cache.get(b'host31.example.com')[1] == int(now + 131)
+    cache.close()
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2015 clowwindy
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+import mmap
+import struct
+
+if __name__ == '__main__':
+    import sys
+    import inspect
+    file_path = os.path.dirname(os.path.realpath(inspect.getfile(inspect.currentframe())))
+    sys.path.insert(0, os.path.join(file_path, '../'))
+
+# per port counters, shared by all workers through a mmap
+#
+# the table has one row per (worker, port) and every worker only writes its
+# own rows, so no lock is needed. readers sum the rows of all workers.
+#
+# layout, little endian:
+#   header: magic(8s) workers(I) ports(I)
+#   ports:  port(I) * ports, padded to 8 bytes
+#   rows:   [worker][port] STAT_FIELDS * int64
+
+STAT_MAGIC = b'SSRSTAT1'
+
+STAT_UPLOAD = 0
+STAT_DOWNLOAD = 1
+STAT_ACTIVE = 2
+STAT_ACCEPTED = 3
+STAT_ERRORS = 4
+STAT_FIELDS = 5
+
+STAT_NAMES = ('upload', 'download', 'active', 'accepted', 'errors')
+
+HEADER_FORMAT = '<8sII'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+ROW_SIZE = STAT_FIELDS * 8
+
+
+def _ports_size(port_count):
+    return (port_count * 4 + 7) & ~7
+
+
+def _table_size(workers, port_count):
+    return HEADER_SIZE + _ports_size(port_count) + \
+        workers * port_count * ROW_SIZE
+
+
+def _read_table(buf):
+    magic, workers, port_count = struct.unpack_from(HEADER_FORMAT, buf, 0)
+    if magic != STAT_MAGIC:
+        raise Exception('not a stat table')
+    ports = struct.unpack_from('<%dI' % port_count, buf, HEADER_SIZE)
+    rows_offset = HEADER_SIZE + _ports_size(port_count)
+    result = {}
+    for index, port in enumerate(ports):
+        values = [0] * STAT_FIELDS
+        for worker in range(workers):
+            offset = rows_offset + (worker * port_count + index) * ROW_SIZE
+            row = struct.unpack_from('<%dq' % STAT_FIELDS, buf, offset)
+            for field in range(STAT_FIELDS):
+                values[field] += row[field]
+        result[port] = dict(zip(STAT_NAMES, values))
+    return result
+
+
+def read_stat_file(path):
+    # read the table a server exported with the stat_file option
+    with open(path, 'rb') as f:
+        buf = f.read()
+    return _read_table(buf)
+
+
+class PortStat(object):
+    # the counters of one port in the row of the current worker
+
+    def __init__(self, buf, offset):
+        self._buf = buf
+        self._offset = offset
+        self._values = [0] * STAT_FIELDS
+
+    def _rebase(self, offset):
+        # counts inherited through fork stay in the row of the parent
+        self._offset = offset
+        self._values = [0] * STAT_FIELDS
+
+    def _publish(self, field):
+        struct.pack_into('<q', self._buf, self._offset + field * 8,
+                         self._values[field])
+
+    def add(self, field, val):
+        # this worker is the only writer of the row, so it keeps the
+        # values and only stores them
+        self._values[field] += val
+        self._publish(field)
+
+    def get(self, field):
+        return self._values[field]
+
+
+class SharedStat(object):
+    def __init__(self, ports, workers=1, path=None):
+        ports = sorted(set(int(port) for port in ports))
+        self._workers = workers
+        self._port_index = dict((port, i) for i, port in enumerate(ports))
+        self._rows_offset = HEADER_SIZE + _ports_size(len(ports))
+        size = _table_size(workers, len(ports))
+        self._file = None
+        if path:
+            # a file backed table can be read by other processes
+            self._file = open(path, 'w+b')
+            self._file.write(b'\x00' * size)
+            self._file.flush()
+            self._buf = mmap.mmap(self._file.fileno(), size)
+        else:
+            # anonymous maps are shared with the children after fork
+            self._buf = mmap.mmap(-1, size)
+        struct.pack_into(HEADER_FORMAT, self._buf, 0, STAT_MAGIC, workers,
+                         len(ports))
+        struct.pack_into('<%dI' % len(ports), self._buf, HEADER_SIZE, *ports)
+        self._worker = 0
+        self._port_stats = {}
+
+    def _row_offset(self, port):
+        return self._rows_offset + (self._worker * len(self._port_index) +
+                                    self._port_index[port]) * ROW_SIZE
+
+    def port_stat(self, port):
+        # returns None for ports that are not in the table, e.g. the ones
+        # added later by the manager
+        port = int(port)
+        if port not in self._port_index:
+            return None
+        if port not in self._port_stats:
+            self._port_stats[port] = PortStat(self._buf,
+                                              self._row_offset(port))
+        return self._port_stats[port]
+
+    def set_worker(self, worker):
+        # called in the worker after fork, before it relays any data
+        if worker < 0 or worker >= self._workers:
+            raise ValueError('worker %d out of range' % worker)
+        self._worker = worker
+        for port, port_stat in self._port_stats.items():
+            port_stat._rebase(self._row_offset(port))
+
+    def read(self):
+        return _read_table(self._buf)
+
+    def close(self):
+        if self._buf:
+            self._buf.close()
+            self._buf = None
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+def test():
+    import tempfile
+
+    stat = SharedStat([8388, '8389'], 2)
+    port_stat = stat.port_stat(8388)
+    assert stat.port_stat(9000) is None
+    port_stat.add(STAT_ACCEPTED, 1)
+    port_stat.add(STAT_ACTIVE, 1)
+    port_stat.add(STAT_UPLOAD, 100)
+
+    pid = os.fork()
+    if pid == 0:
+        stat.set_worker(1)
+        port_stat.add(STAT_DOWNLOAD, 200)
+        port_stat.add(STAT_ACTIVE, -1)
+        os._exit(0)
+    os.waitpid(pid, 0)
+
+    result = stat.read()
+    assert result[8388]['upload'] == 100
+    assert result[8388]['download'] == 200
+    assert result[8388]['accepted'] == 1
+    assert result[8388]['active'] == 0
+    assert result[8389]['upload'] == 0
+    stat.close()
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        stat = SharedStat([443], 1, path)
+        stat.port_stat(443).add(STAT_ERRORS, 3)
+        assert read_stat_file(path)[443]['errors'] == 3
+        stat.close()
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    test()
@@ -142,7 +142,8 @@ def get_config(is_local):
     else:
         shortopts = 'hd:s:p:k:m:P:o:G:g:c:t:vq'
         longopts = ['help', 'fast-open', 'pid-file=', 'log-file=', 'workers=',
-                    'forbidden-ip=', 'user=', 'manager-address=', 'version']
+                    'reuse-port', 'forbidden-ip=', 'user=', 'manager-address=',
+                    'version']
     try:
         config_path = find_config()
         optlist, args = getopt.getopt(sys.argv[1:], shortopts, longopts)
@@ -194,6 +195,8 @@ def get_config(is_local):
                 config['fast_open'] = True
             elif key == '--workers':
                 config['workers'] = int(value)
+            elif key == '--reuse-port':
+                config['reuse_port'] = True
             elif key == '--manager-address':
                 config['manager_address'] = value
             elif key == '--user':
@@ -240,6 +243,9 @@ def get_config(is_local):
     config['udp_cache'] = int(config.get('udp_cache', 64))
     config['fast_open'] = config.get('fast_open', False)
     config['workers'] = config.get('workers', 1)
+    config['stat_file'] = config.get('stat_file', None)
+    config['dns_cache_file'] = config.get('dns_cache_file', None)
+    config['reuse_port'] = config.get('reuse_port', False)
     config['pid-file'] = config.get('pid-file', '/var/run/shadowsocks.pid')
     config['log-file'] = config.get('log-file', '/var/log/shadowsocks.log')
     config['verbose'] = config.get('verbose', False)
@@ -346,6 +352,8 @@ Proxy options:
   -t TIMEOUT             timeout in seconds, default: 300
   --fast-open            use TCP_FASTOPEN, requires Linux 3.7+
   --workers WORKERS      number of workers, available on Unix/Linux
+  --reuse-port           every worker binds its own SO_REUSEPORT sockets,
+                         requires Linux 3.9+
   --forbidden-ip IPLIST  comma seperated IP list forbidden to connect
   --manager-address ADDR optional server manager UDP address, see wiki
 
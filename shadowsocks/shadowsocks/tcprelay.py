@@ -18,6 +18,7 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
+import os
 import time
 import socket
 import errno
@@ -27,12 +28,10 @@ import binascii
 import traceback
 import random
 
-from shadowsocks import encrypt, obfs, eventloop, shell, common
+from shadowsocks import encrypt, obfs, eventloop, shell, common, shared_stat, \
+    asyncdns
 from shadowsocks.common import pre_parse_header, parse_header
 
-# we clear at most TIMEOUTS_CLEAN_SIZE timeouts each time
-TIMEOUTS_CLEAN_SIZE = 512
-
 MSG_FASTOPEN = 0x20000000
 
 # SOCKS command definition
@@ -89,7 +88,18 @@ WAIT_STATUS_WRITING = 2
 WAIT_STATUS_READWRITING = WAIT_STATUS_READING | WAIT_STATUS_WRITING
 
 BUF_SIZE = 32 * 1024
+# stop reading from one side while this much waits to be sent to the other
+# and start again when the queue is down to the low water mark
+WRITE_HIGH_WATER = 64 * 1024
+WRITE_LOW_WATER = 16 * 1024
+# the config keys, they can also be set for each port in port_password
+WATER_MARK_KEYS = ('write_high_water', 'write_low_water',
+                   'up_high_water', 'up_low_water',
+                   'down_high_water', 'down_low_water')
 UDP_MAX_BUF_SIZE = 65536
+# rfc8305, the next address is tried if the connection attempts in flight
+# did not succeed within this time
+CONNECTION_ATTEMPT_DELAY = 0.25
 
 class TCPRelayHandler(object):
     def __init__(self, server, fd_to_handlers, loop, local_sock, config,
@@ -143,14 +153,28 @@ class TCPRelayHandler(object):
         self._protocol.set_server_info(server_info)
 
         self._redir_list = config.get('redirect', ["0.0.0.0:0"])
-        self._bind = config.get('out_bind', '')
-        self._bindv6 = config.get('out_bindv6', '')
+        self._bind = server.out_bind
+        self._bindv6 = server.out_bindv6
         self._ignore_bind_list = config.get('ignore_bind', [])
 
         self._fastopen_connected = False
-        self._data_to_write_to_local = []
-        self._data_to_write_to_remote = []
+        self._fastopen_addr = None
+        self._connect_addrs = []  # (address family, ip) not tried yet
+        self._connect_port = None
+        self._connect_socks = []  # connection attempts in flight
+        self._connect_timer = None
+        self._connect_error = None
+        self._data_to_write_to_local = common.WriteQueue()
+        self._data_to_write_to_remote = common.WriteQueue()
+        high_water = config.get('write_high_water', WRITE_HIGH_WATER)
+        low_water = config.get('write_low_water', WRITE_LOW_WATER)
+        # (high, low) for the data sent to the remote and to the local side
+        self._up_water = (config.get('up_high_water', high_water),
+                          config.get('up_low_water', low_water))
+        self._down_water = (config.get('down_high_water', high_water),
+                            config.get('down_low_water', low_water))
         self._udp_data_send_buffer = b''
+        self._udp_resolve_queue = None
         self._upstream_status = WAIT_STATUS_READING
         self._downstream_status = WAIT_STATUS_INIT
         self._client_address = local_sock.getpeername()[:2]
@@ -219,15 +243,19 @@ class TCPRelayHandler(object):
                     event |= eventloop.POLL_IN
                 self._loop.modify(self._local_sock, event)
             if self._remote_sock:
-                event = eventloop.POLL_ERR
-                if self._downstream_status & WAIT_STATUS_READING:
-                    event |= eventloop.POLL_IN
-                if self._upstream_status & WAIT_STATUS_WRITING:
-                    event |= eventloop.POLL_OUT
+                event = self._remote_event()
                 self._loop.modify(self._remote_sock, event)
                 if self._remote_sock_v6:
                     self._loop.modify(self._remote_sock_v6, event)
 
+    def _remote_event(self):
+        event = eventloop.POLL_ERR
+        if self._downstream_status & WAIT_STATUS_READING:
+            event |= eventloop.POLL_IN
+        if self._upstream_status & WAIT_STATUS_WRITING:
+            event |= eventloop.POLL_OUT
+        return event
+
     def _write_to_sock(self, data, sock):
         # write data to sock
         # if only some of the data are written, put remaining in the buffer
@@ -237,6 +265,9 @@ class TCPRelayHandler(object):
         #logging.debug("_write_to_sock %s %s %s" % (self._remote_sock, sock, self._remote_udp))
         uncomplete = False
         if self._remote_udp and sock == self._remote_sock:
+            if self._udp_resolve_queue is None:
+                self._udp_resolve_queue = asyncdns.ResolveQueue(
+                    self._dns_resolver, self._on_udp_dns_resolved)
             try:
                 self._udp_data_send_buffer += data
                 #logging.info('UDP over TCP sendto %d %s' % (len(data), binascii.hexlify(data)))
@@ -263,16 +294,11 @@ class TCPRelayHandler(object):
                     if header_result is None:
                         continue
                     connecttype, dest_addr, dest_port, header_length = header_result
-                    addrs = socket.getaddrinfo(dest_addr, dest_port, 0,
-                            socket.SOCK_DGRAM, socket.SOL_UDP)
                     #logging.info('UDP over TCP sendto %s:%d %d bytes from %s:%d' % (dest_addr, dest_port, len(data), self._client_address[0], self._client_address[1]))
-                    if addrs:
-                        af, socktype, proto, canonname, server_addr = addrs[0]
-                        data = data[header_length:]
-                        if af == socket.AF_INET6:
-                            self._remote_sock_v6.sendto(data, (server_addr[0], dest_port))
-                        else:
-                            sock.sendto(data, (server_addr[0], dest_port))
+                    # sent when dest_addr is resolved, right away if it is
+                    # an IP or in the cache of the resolver
+                    self._udp_resolve_queue.add(dest_addr,
+                                                (dest_port, data[header_length:]))
 
             except Exception as e:
                 #trace = traceback.format_exc()
@@ -288,19 +314,23 @@ class TCPRelayHandler(object):
                     return False
             return True
         else:
+            if sock == self._local_sock:
+                queue = self._data_to_write_to_local
+            elif sock == self._remote_sock:
+                queue = self._data_to_write_to_remote
+            else:
+                logging.error('write_all_to_sock:unknown socket from %s:%d' % (self._client_address[0], self._client_address[1]))
+                return False
             try:
                 if self._encrypt_correct:
                     if sock == self._remote_sock:
-                        self._server.server_transfer_ul += len(data)
+                        self._server.add_transfer_ul(len(data))
                         self._update_activity(len(data))
-                if data:
-                    l = len(data)
-                    s = sock.send(data)
-                    if s < l:
-                        data = data[s:]
-                        uncomplete = True
-                else:
+                if not data and not queue:
                     return
+                queue.append(data)
+                queue.send(sock)
+                uncomplete = bool(queue)
             except (OSError, IOError) as e:
                 error_no = eventloop.errno_from_exception(e)
                 if error_no in (errno.EAGAIN, errno.EINPROGRESS,
@@ -318,29 +348,58 @@ class TCPRelayHandler(object):
                 self.destroy()
                 return False
         if uncomplete:
+            # keep reading the other side until the queue is too long
             if sock == self._local_sock:
-                self._data_to_write_to_local.append(data)
-                self._update_stream(STREAM_DOWN, WAIT_STATUS_WRITING)
-            elif sock == self._remote_sock:
-                self._data_to_write_to_remote.append(data)
-                self._update_stream(STREAM_UP, WAIT_STATUS_WRITING)
+                self._update_stream(STREAM_DOWN, self._write_wait_status(
+                    queue, self._downstream_status, self._down_water))
             else:
-                logging.error('write_all_to_sock:unknown socket from %s:%d' % (self._client_address[0], self._client_address[1]))
+                self._update_stream(STREAM_UP, self._write_wait_status(
+                    queue, self._upstream_status, self._up_water))
         else:
             if sock == self._local_sock:
                 self._update_stream(STREAM_DOWN, WAIT_STATUS_READING)
-            elif sock == self._remote_sock:
-                self._update_stream(STREAM_UP, WAIT_STATUS_READING)
             else:
-                logging.error('write_all_to_sock:unknown socket from %s:%d' % (self._client_address[0], self._client_address[1]))
+                self._update_stream(STREAM_UP, WAIT_STATUS_READING)
         return True
 
+    def _write_wait_status(self, queue, status, water):
+        high_water, low_water = water
+        if status & WAIT_STATUS_READING:
+            if len(queue) >= high_water:
+                return WAIT_STATUS_WRITING
+        elif len(queue) > low_water:
+            return WAIT_STATUS_WRITING
+        return WAIT_STATUS_READWRITING
+
+    def _on_udp_dns_resolved(self, hostname, addr, items, error):
+        if self._stage == STAGE_DESTROYED:
+            return
+        if not addr:
+            logging.debug('UDP over TCP can not resolve %s: %s' %
+                          (common.to_str(hostname), error))
+            return
+        af, ip = addr
+        if af == socket.AF_INET6:
+            sock = self._remote_sock_v6
+        else:
+            sock = self._remote_sock
+        for port, data in items:
+            try:
+                sock.sendto(data, (ip, port))
+            except (OSError, IOError) as e:
+                # a full buffer drops the datagram like any UDP sender
+                if eventloop.errno_from_exception(e) not in \
+                        (errno.EAGAIN, errno.EWOULDBLOCK):
+                    shell.print_exception(e)
+                    logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
+                    self.destroy()
+                    return
+
     def _get_redirect_host(self, client_address, ogn_data):
         host_list = self._redir_list or ["0.0.0.0:0"]
         hash_code = binascii.crc32(ogn_data)
-        addrs = socket.getaddrinfo(client_address[0], client_address[1], 0, socket.SOCK_STREAM, socket.SOL_TCP)
-        af, socktype, proto, canonname, sa = addrs[0]
-        address_bytes = common.inet_pton(af, sa[0])
+        af = asyncdns.ip_family(client_address[0])
+        address_bytes = common.inet_pton(af, client_address[0])
         if len(address_bytes) == 16:
             addr = struct.unpack('>Q', address_bytes[8:])[0]
         if len(address_bytes) == 4:
@@ -378,6 +437,9 @@ class TCPRelayHandler(object):
                 data = self._obfs.client_encode(data)
         if data:
             self._data_to_write_to_remote.append(data)
+            if len(self._data_to_write_to_remote) >= self._up_water[0]:
+                # pause reading until the remote is connected
+                self._update_stream(STREAM_UP, WAIT_STATUS_WRITING)
         if self._is_local and not self._fastopen_connected and \
                 self._config['fast_open']:
             # for sslocal and fastopen, we basically wait for data and use
@@ -385,18 +447,13 @@ class TCPRelayHandler(object):
             try:
                 # only connect once
                 self._fastopen_connected = True
+                af, ip = self._fastopen_addr
                 remote_sock = \
-                    self._create_remote_socket(self._chosen_server[0],
-                                               self._chosen_server[1])
+                    self._create_remote_socket(ip, self._chosen_server[1], af)
                 self._loop.add(remote_sock, eventloop.POLL_ERR, self._server)
-                data = b''.join(self._data_to_write_to_remote)
-                l = len(data)
-                s = remote_sock.sendto(data, MSG_FASTOPEN, self._chosen_server)
-                if s < l:
-                    data = data[s:]
-                    self._data_to_write_to_remote = [data]
-                else:
-                    self._data_to_write_to_remote = []
+                # what is not sent stays queued for _on_remote_write
+                self._data_to_write_to_remote.sendto(
+                    remote_sock, MSG_FASTOPEN, (ip, self._chosen_server[1]))
                 self._update_stream(STREAM_UP, WAIT_STATUS_READWRITING)
             except (OSError, IOError) as e:
                 if eventloop.errno_from_exception(e) == errno.EINPROGRESS:
@@ -502,52 +559,128 @@ class TCPRelayHandler(object):
                 traceback.print_exc()
             self.destroy()
 
-    def _create_remote_socket(self, ip, port):
+    def _create_remote_socket(self, ip, port, af):
+        # ip is already resolved and af is its address family, so no
+        # getaddrinfo is needed here
         if self._remote_udp:
-            addrs_v6 = socket.getaddrinfo("::", 0, 0, socket.SOCK_DGRAM, socket.SOL_UDP)
-            addrs = socket.getaddrinfo("0.0.0.0", 0, 0, socket.SOCK_DGRAM, socket.SOL_UDP)
+            remote_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                        socket.SOL_UDP)
         else:
-            addrs = socket.getaddrinfo(ip, port, 0, socket.SOCK_STREAM, socket.SOL_TCP)
-        if len(addrs) == 0:
-            raise Exception("getaddrinfo failed for %s:%d" % (ip, port))
-        af, socktype, proto, canonname, sa = addrs[0]
-        if not self._remote_udp and self._forbidden_iplist:
-            if common.to_str(sa[0]) in self._forbidden_iplist:
-                raise Exception('IP %s is in forbidden list, reject' %
-                                common.to_str(sa[0]))
-        remote_sock = socket.socket(af, socktype, proto)
+            remote_sock = self._create_tcp_socket(ip, af)
         self._remote_sock = remote_sock
         self._fd_to_handlers[remote_sock.fileno()] = self
 
         if self._remote_udp:
-            af, socktype, proto, canonname, sa = addrs_v6[0]
-            remote_sock_v6 = socket.socket(af, socktype, proto)
+            remote_sock_v6 = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM,
+                                           socket.SOL_UDP)
             self._remote_sock_v6 = remote_sock_v6
             self._fd_to_handlers[remote_sock_v6.fileno()] = self
 
-        remote_sock.setblocking(False)
         if self._remote_udp:
+            remote_sock.setblocking(False)
             remote_sock_v6.setblocking(False)
-        else:
-            remote_sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        return remote_sock
+
+    def _create_tcp_socket(self, ip, af):
+        if self._forbidden_iplist:
+            if common.to_str(ip) in self._forbidden_iplist:
+                raise Exception('IP %s is in forbidden list, reject' %
+                                common.to_str(ip))
+        sock = socket.socket(af, socket.SOCK_STREAM, socket.SOL_TCP)
+        try:
+            sock.setblocking(False)
+            sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
             if not self._is_local:
-                bind_addr = ''
+                # out_bind and out_bindv6 were resolved by TCPRelay
                 if self._bind and af == socket.AF_INET:
-                    bind_addr = self._bind
+                    bind_af, bind_addr = self._bind
                 elif self._bindv6 and af == socket.AF_INET6:
-                    bind_addr = self._bindv6
+                    bind_af, bind_addr = self._bindv6
                 else:
-                    bind_addr = self._accept_address[0]
+                    bind_addr = self._accept_address[0].replace("::ffff:", "")
+                    bind_af = asyncdns.ip_family(bind_addr)
 
-                bind_addr = bind_addr.replace("::ffff:", "")
                 if bind_addr in self._ignore_bind_list:
                     bind_addr = None
-                if bind_addr:
-                    local_addrs = socket.getaddrinfo(bind_addr, port, 0, socket.SOCK_STREAM, socket.SOL_TCP)
-                    if local_addrs[0][0] == af:
-                        logging.debug("bind %s" % (bind_addr,))
-                        remote_sock.bind((bind_addr, 0))
-        return remote_sock
+                if bind_addr and bind_af == af:
+                    logging.debug("bind %s" % (bind_addr,))
+                    sock.bind((bind_addr, 0))
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def _start_connect_attempt(self):
+        # happy eyeballs, rfc8305: the addresses are tried in the order of
+        # the resolver, which interleaves the families, and one more attempt
+        # is started every CONNECTION_ATTEMPT_DELAY until one is connected
+        self._connect_timer = None
+        while self._connect_addrs:
+            af, ip = self._connect_addrs.pop(0)
+            sock = None
+            try:
+                sock = self._create_tcp_socket(ip, af)
+                try:
+                    sock.connect((ip, self._connect_port))
+                except (OSError, IOError) as e:
+                    if eventloop.errno_from_exception(e) not in \
+                            (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                        raise
+            except Exception as e:
+                # e.g. no route to this family, go on with the next address
+                if sock:
+                    sock.close()
+                logging.debug('connect to %s:%d: %s' %
+                              (common.to_str(ip), self._connect_port, e))
+                self._connect_error = e
+                continue
+            self._connect_socks.append(sock)
+            self._fd_to_handlers[sock.fileno()] = self
+            self._loop.add(sock, eventloop.POLL_ERR | eventloop.POLL_OUT,
+                           self._server)
+            if self._connect_addrs:
+                self._connect_timer = self._loop.call_later(
+                    CONNECTION_ATTEMPT_DELAY, self._start_connect_attempt)
+            return True
+        return False
+
+    def _close_connect_attempt(self, sock):
+        self._connect_socks.remove(sock)
+        self._loop.remove(sock)
+        del self._fd_to_handlers[sock.fileno()]
+        sock.close()
+
+    def _stop_connect_attempts(self):
+        if self._connect_timer:
+            self._loop.cancel(self._connect_timer)
+            self._connect_timer = None
+        self._connect_addrs = []
+        for sock in list(self._connect_socks):
+            self._close_connect_attempt(sock)
+
+    def _on_connect_attempt(self, sock, event):
+        error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error or event & eventloop.POLL_ERR:
+            self._connect_error = os.strerror(error or errno.ECONNREFUSED)
+            self._close_connect_attempt(sock)
+            if self._connect_socks:
+                return
+            # the last attempt in flight failed, do not wait for the timer
+            if self._connect_timer:
+                self._loop.cancel(self._connect_timer)
+            if self._start_connect_attempt():
+                return
+            self._server.add_error()
+            logging.error(self._connect_error)
+            logging.error("when connect to %s:%d from %s:%d" % (self._remote_address[0], self._remote_address[1], self._client_address[0], self._client_address[1]))
+            self.destroy()
+            return
+        # the first connected socket wins, the others are closed
+        self._connect_socks.remove(sock)
+        self._stop_connect_attempts()
+        self._remote_sock = sock
+        self._loop.modify(sock, self._remote_event())
+        self._on_remote_write()
 
     def _handle_dns_resolved(self, result, error):
         if error:
@@ -569,6 +702,7 @@ class TCPRelayHandler(object):
                     if self._is_local and self._config['fast_open']:
                         # for fastopen:
                         # wait for more data to arrive and send them in one SYN
+                        self._fastopen_addr = (result[2], ip)
                         self._stage = STAGE_CONNECTING
                         # we don't have to wait for remote since it's not
                         # created
@@ -576,9 +710,9 @@ class TCPRelayHandler(object):
                         # TODO when there is already data in this packet
                     else:
                         # else do connect
-                        remote_sock = self._create_remote_socket(remote_addr,
-                                                                 remote_port)
                         if self._remote_udp:
+                            remote_sock = self._create_remote_socket(
+                                remote_addr, remote_port, result[2])
                             self._loop.add(remote_sock,
                                            eventloop.POLL_IN,
                                            self._server)
@@ -587,25 +721,24 @@ class TCPRelayHandler(object):
                                         eventloop.POLL_IN,
                                         self._server)
                         else:
-                            try:
-                                remote_sock.connect((remote_addr, remote_port))
-                            except (OSError, IOError) as e:
-                                if eventloop.errno_from_exception(e) in (errno.EINPROGRESS,
-                                        errno.EWOULDBLOCK):
-                                    pass # always goto here
-                                else:
-                                    raise e
-                            self._loop.add(remote_sock,
-                                       eventloop.POLL_ERR | eventloop.POLL_OUT,
-                                       self._server)
+                            self._connect_addrs = list(result[3])
+                            self._connect_port = remote_port
+                            if not self._start_connect_attempt():
+                                raise Exception('can not connect to %s:%d, %s'
+                                                % (common.to_str(remote_addr),
+                                                   remote_port,
+                                                   self._connect_error))
                         self._stage = STAGE_CONNECTING
-                        self._update_stream(STREAM_UP, WAIT_STATUS_READWRITING)
-                        self._update_stream(STREAM_DOWN, WAIT_STATUS_READING)
                         if self._remote_udp:
-                            while self._data_to_write_to_remote:
-                                data = self._data_to_write_to_remote[0]
-                                del self._data_to_write_to_remote[0]
+                            data = self._data_to_write_to_remote.pop_all()
+                            if data:
                                 self._write_to_sock(data, self._remote_sock)
+                        # stays paused while the data read during the dns
+                        # lookup is over the high water mark
+                        self._update_stream(STREAM_UP, self._write_wait_status(
+                            self._data_to_write_to_remote,
+                            self._upstream_status, self._up_water))
+                        self._update_stream(STREAM_DOWN, WAIT_STATUS_READING)
                     return
                 except Exception as e:
                     shell.print_exception(e)
@@ -622,12 +755,18 @@ class TCPRelayHandler(object):
         is_local = self._is_local
         data = None
         try:
-            data = self._local_sock.recv(BUF_SIZE)
+            data = self._server.recv_from_sock(self._local_sock)
         except (OSError, IOError) as e:
             if eventloop.errno_from_exception(e) in \
                     (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK):
                 return
         if not data:
+            if self._data_to_write_to_remote and \
+                    (self._remote_sock or self._connect_socks):
+                # send what is queued first, reading resumes when the queue
+                # is empty and sees the end of the stream again
+                self._update_stream(STREAM_UP, WAIT_STATUS_WRITING)
+                return
             self.destroy()
             return
         ogn_data = data
@@ -648,7 +787,14 @@ class TCPRelayHandler(object):
                         if not self._protocol.obfs.server_info.recv_iv:
                             iv_len = len(self._protocol.obfs.server_info.iv)
                             self._protocol.obfs.server_info.recv_iv = obfs_decode[0][:iv_len]
-                        data = self._encryptor.decrypt(obfs_decode[0])
+                        try:
+                            data = self._encryptor.decrypt(obfs_decode[0])
+                        except Exception as e:
+                            # AEAD ciphers raise on a bad tag
+                            shell.print_exception(e)
+                            logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
+                            self.destroy()
+                            return
                     else:
                         data = obfs_decode[0]
                     try:
@@ -703,12 +849,16 @@ class TCPRelayHandler(object):
                     data = struct.pack('>H', size) + data
                 #logging.info('UDP over TCP recvfrom %s:%d %d bytes to %s:%d' % (addr[0], addr[1], len(data), self._client_address[0], self._client_address[1]))
             else:
-                data = self._remote_sock.recv(BUF_SIZE)
+                data = self._server.recv_from_sock(self._remote_sock)
         except (OSError, IOError) as e:
             if eventloop.errno_from_exception(e) in \
                     (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK, 10035): #errno.WSAEWOULDBLOCK
                 return
         if not data:
+            if self._data_to_write_to_local:
+                # same as in _on_local_read
+                self._update_stream(STREAM_DOWN, WAIT_STATUS_WRITING)
+                return
             self.destroy()
             return
         if self._encryptor is not None:
@@ -726,8 +876,8 @@ class TCPRelayHandler(object):
                 if not self._protocol.obfs.server_info.recv_iv:
                     iv_len = len(self._protocol.obfs.server_info.iv)
                     self._protocol.obfs.server_info.recv_iv = obfs_decode[0][:iv_len]
-                data = self._encryptor.decrypt(obfs_decode[0])
                 try:
+                    data = self._encryptor.decrypt(obfs_decode[0])
                     data = self._protocol.client_post_decrypt(data)
                 except Exception as e:
                     shell.print_exception(e)
@@ -740,7 +890,7 @@ class TCPRelayHandler(object):
                     data = self._encryptor.encrypt(data)
                     data = self._obfs.server_encode(data)
             self._update_activity(len(data))
-            self._server.server_transfer_dl += len(data)
+            self._server.add_transfer_dl(len(data))
         else:
             return
         try:
@@ -755,9 +905,7 @@ class TCPRelayHandler(object):
     def _on_local_write(self):
         # handle local writable event
         if self._data_to_write_to_local:
-            data = b''.join(self._data_to_write_to_local)
-            self._data_to_write_to_local = []
-            self._write_to_sock(data, self._local_sock)
+            self._write_to_sock(b'', self._local_sock)
         else:
             self._update_stream(STREAM_DOWN, WAIT_STATUS_READING)
 
@@ -765,15 +913,14 @@ class TCPRelayHandler(object):
         # handle remote writable event
         self._stage = STAGE_STREAM
         if self._data_to_write_to_remote:
-            data = b''.join(self._data_to_write_to_remote)
-            self._data_to_write_to_remote = []
-            self._write_to_sock(data, self._remote_sock)
+            self._write_to_sock(b'', self._remote_sock)
         else:
             self._update_stream(STREAM_UP, WAIT_STATUS_READING)
 
     def _on_local_error(self):
         logging.debug('got local error')
         if self._local_sock:
+            self._server.add_error()
             logging.error(eventloop.get_sock_error(self._local_sock))
             logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
         self.destroy()
@@ -781,6 +928,7 @@ class TCPRelayHandler(object):
     def _on_remote_error(self):
         logging.debug('got remote error')
         if self._remote_sock:
+            self._server.add_error()
             logging.error(eventloop.get_sock_error(self._remote_sock))
             if self._remote_address:
                 logging.error("when connect to %s:%d from %s:%d" % (self._remote_address[0], self._remote_address[1], self._client_address[0], self._client_address[1]))
@@ -805,6 +953,8 @@ class TCPRelayHandler(object):
                     return
             if event & eventloop.POLL_OUT:
                 self._on_remote_write()
+        elif sock in self._connect_socks:
+            self._on_connect_attempt(sock, event)
         elif sock == self._local_sock:
             if event & eventloop.POLL_ERR:
                 self._on_local_error()
@@ -853,6 +1003,7 @@ class TCPRelayHandler(object):
             del self._fd_to_handlers[self._remote_sock.fileno()]
             self._remote_sock.close()
             self._remote_sock = None
+        self._stop_connect_attempts()
         if self._remote_sock_v6:
             logging.debug('destroying remote')
             try:
@@ -876,12 +1027,30 @@ class TCPRelayHandler(object):
             self._protocol = None
         self._encryptor = None
         self._dns_resolver.remove_callback(self._handle_dns_resolved)
+        if self._udp_resolve_queue is not None:
+            self._udp_resolve_queue.close()
         self._server.remove_handler(self)
         self._server.add_connection(-1)
         self._server.stat_add(self._client_address[0], -1)
 
+def resolve_bind_addr(addr):
+    # out_bind is resolved once when the relay starts, returns
+    # (address family, ip) or None
+    if not addr:
+        return None
+    try:
+        addrs = socket.getaddrinfo(addr, 0, 0, socket.SOCK_STREAM,
+                                   socket.SOL_TCP)
+    except (OSError, IOError) as e:
+        shell.print_exception(e)
+        logging.error('can not resolve bind address %s' % (addr,))
+        return None
+    af, socktype, proto, canonname, sa = addrs[0]
+    return af, sa[0]
+
+
 class TCPRelay(object):
-    def __init__(self, config, dns_resolver, is_local, stat_callback=None, stat_counter=None):
+    def __init__(self, config, dns_resolver, is_local, stat_callback=None, stat_counter=None, stat_table=None):
         self._config = config
         self._is_local = is_local
         self._dns_resolver = dns_resolver
@@ -898,10 +1067,7 @@ class TCPRelay(object):
             common.connect_log = logging.info
 
         self._timeout = config['timeout']
-        self._timeouts = []  # a list for all the handlers
-        # we trim the timeouts once a while
-        self._timeout_offset = 0   # last checked position for timeout
-        self._handler_to_timeouts = {}  # key: handler value: index in timeouts
+        self._handler_to_timer = {}  # key: handler value: eventloop timer
 
         if is_local:
             listen_addr = config['local_address']
@@ -910,6 +1076,8 @@ class TCPRelay(object):
             listen_addr = config['server']
             listen_port = config['server_port']
         self._listen_port = listen_port
+        self.out_bind = resolve_bind_addr(config.get('out_bind', ''))
+        self.out_bindv6 = resolve_bind_addr(config.get('out_bindv6', ''))
 
         addrs = socket.getaddrinfo(listen_addr, listen_port, 0,
                                    socket.SOCK_STREAM, socket.SOL_TCP)
@@ -919,6 +1087,10 @@ class TCPRelay(object):
         af, socktype, proto, canonname, sa = addrs[0]
         server_socket = socket.socket(af, socktype, proto)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if config.get('reuse_port', False):
+            # every worker binds its own socket and the kernel balances
+            # connections between them
+            common.set_reuse_port(server_socket)
         server_socket.bind(sa)
         server_socket.setblocking(False)
         if config['fast_open']:
@@ -929,8 +1101,15 @@ class TCPRelay(object):
                 self._config['fast_open'] = False
         server_socket.listen(config.get('max_connect', 1024))
         self._server_socket = server_socket
+        # all handlers of this relay run in the same event loop and consume
+        # what they read before returning, so they can share one buffer
+        self._recv_buf = bytearray(BUF_SIZE)
+        self._recv_view = memoryview(self._recv_buf)
         self._stat_counter = stat_counter
         self._stat_callback = stat_callback
+        self._port_stat = None
+        if stat_table is not None:
+            self._port_stat = stat_table.port_stat(listen_port)
 
     def add_to_loop(self, loop):
         if self._eventloop:
@@ -943,16 +1122,39 @@ class TCPRelay(object):
         self._eventloop.add_periodic(self.handle_periodic)
 
     def remove_handler(self, handler):
-        index = self._handler_to_timeouts.get(hash(handler), -1)
-        if index >= 0:
-            # delete is O(n), so we just set it to None
-            self._timeouts[index] = None
-            del self._handler_to_timeouts[hash(handler)]
+        timer = self._handler_to_timer.pop(hash(handler), None)
+        if timer:
+            self._eventloop.cancel(timer)
+
+    def recv_from_sock(self, sock):
+        # recv_into avoids allocating a BUF_SIZE bytes object on every read
+        # the data is copied out because obfs and protocol plugins keep
+        # references to what they are given
+        length = sock.recv_into(self._recv_buf)
+        return self._recv_view[:length].tobytes()
 
     def add_connection(self, val):
         self.server_connections += val
+        if self._port_stat:
+            self._port_stat.add(shared_stat.STAT_ACTIVE, val)
+            if val > 0:
+                self._port_stat.add(shared_stat.STAT_ACCEPTED, val)
         logging.debug('server port %5d connections = %d' % (self._listen_port, self.server_connections,))
 
+    def add_transfer_ul(self, data_len):
+        self.server_transfer_ul += data_len
+        if self._port_stat:
+            self._port_stat.add(shared_stat.STAT_UPLOAD, data_len)
+
+    def add_transfer_dl(self, data_len):
+        self.server_transfer_dl += data_len
+        if self._port_stat:
+            self._port_stat.add(shared_stat.STAT_DOWNLOAD, data_len)
+
+    def add_error(self):
+        if self._port_stat:
+            self._port_stat.add(shared_stat.STAT_ERRORS, 1)
+
     def update_stat(self, port, stat_dict, val):
         newval = stat_dict.get(0, 0) + val
         stat_dict[0] = newval
@@ -997,52 +1199,27 @@ class TCPRelay(object):
             self._stat_callback(self._listen_port, data_len)
 
         # set handler to active
-        now = int(time.time())
-        if now - handler.last_activity < eventloop.TIMEOUT_PRECISION:
-            # thus we can lower timeout modification frequency
+        # the timer is not moved on every activity, it checks last_activity
+        # when it fires and reschedules itself for the remaining time
+        handler.last_activity = time.time()
+        if hash(handler) not in self._handler_to_timer:
+            self._handler_to_timer[hash(handler)] = \
+                self._eventloop.call_later(self._timeout,
+                                           self._handle_timeout, handler)
+
+    def _handle_timeout(self, handler):
+        del self._handler_to_timer[hash(handler)]
+        idle = time.time() - handler.last_activity
+        if idle < self._timeout:
+            self._handler_to_timer[hash(handler)] = \
+                self._eventloop.call_later(self._timeout - idle,
+                                           self._handle_timeout, handler)
             return
-        handler.last_activity = now
-        index = self._handler_to_timeouts.get(hash(handler), -1)
-        if index >= 0:
-            # delete is O(n), so we just set it to None
-            self._timeouts[index] = None
-        length = len(self._timeouts)
-        self._timeouts.append(handler)
-        self._handler_to_timeouts[hash(handler)] = length
-
-    def _sweep_timeout(self):
-        # tornado's timeout memory management is more flexible than we need
-        # we just need a sorted last_activity queue and it's faster than heapq
-        # in fact we can do O(1) insertion/remove so we invent our own
-        if self._timeouts:
-            logging.log(shell.VERBOSE_LEVEL, 'sweeping timeouts')
-            now = time.time()
-            length = len(self._timeouts)
-            pos = self._timeout_offset
-            while pos < length:
-                handler = self._timeouts[pos]
-                if handler:
-                    if now - handler.last_activity < self._timeout:
-                        break
-                    else:
-                        if handler.remote_address:
-                            logging.debug('timed out: %s:%d' %
-                                         handler.remote_address)
-                        else:
-                            logging.debug('timed out')
-                        handler.destroy()
-                        self._timeouts[pos] = None  # free memory
-                        pos += 1
-                else:
-                    pos += 1
-            if pos > TIMEOUTS_CLEAN_SIZE and pos > length >> 1:
-                # clean up the timeout queue when it gets larger than half
-                # of the queue
-                self._timeouts = self._timeouts[pos:]
-                for key in self._handler_to_timeouts:
-                    self._handler_to_timeouts[key] -= pos
-                pos = 0
-            self._timeout_offset = pos
+        if handler.remote_address:
+            logging.debug('timed out: %s:%d' % handler.remote_address)
+        else:
+            logging.debug('timed out')
+        handler.destroy()
 
     def handle_event(self, sock, fd, event):
         # handle events and dispatch to handlers
@@ -1067,6 +1244,7 @@ class TCPRelay(object):
                                 errno.EWOULDBLOCK):
                     return
                 else:
+                    self.add_error()
                     shell.print_exception(e)
                     if self._config['verbose']:
                         traceback.print_exc()
@@ -1087,7 +1265,6 @@ class TCPRelay(object):
                 logging.info('closed TCP port %d', self._listen_port)
             for handler in list(self._fd_to_handlers.values()):
                 handler.destroy()
-        self._sweep_timeout()
 
     def close(self, next_tick=False):
         logging.debug('TCP close')
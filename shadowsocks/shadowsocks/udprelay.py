@@ -71,12 +71,10 @@ import random
 import binascii
 import traceback
 
-from shadowsocks import encrypt, obfs, eventloop, lru_cache, common, shell
+from shadowsocks import encrypt, obfs, eventloop, lru_cache, common, shell, \
+    shared_stat, asyncdns
 from shadowsocks.common import pre_parse_header, parse_header, pack_addr
 
-# we clear at most TIMEOUTS_CLEAN_SIZE timeouts each time
-TIMEOUTS_CLEAN_SIZE = 512
-
 # for each handler, we have 2 stream directions:
 #    upstream:    from client to server direction
 #                 read local and write to remote
@@ -93,6 +91,10 @@ WAIT_STATUS_WRITING = 2
 WAIT_STATUS_READWRITING = WAIT_STATUS_READING | WAIT_STATUS_WRITING
 
 BUF_SIZE = 65536
+# datagrams read from one socket for each poll event
+UDP_BATCH_SIZE = 64
+# datagrams waiting for a hostname are dropped after this many seconds
+DNS_RESOLVE_TIMEOUT = 10
 DOUBLE_SEND_BEG_IDS = 16
 POST_MTU_MIN = 500
 POST_MTU_MAX = 1400
@@ -427,16 +429,12 @@ class TCPRelayHandler(object):
                 logging.error('write_all_to_sock:unknown socket')
         return True
 
-    def _create_remote_socket(self, ip, port):
-        addrs = socket.getaddrinfo(ip, port, 0, socket.SOCK_STREAM, socket.SOL_TCP)
-        if len(addrs) == 0:
-            raise Exception("getaddrinfo failed for %s:%d" % (ip, port))
-        af, socktype, proto, canonname, sa = addrs[0]
+    def _create_remote_socket(self, ip, port, af):
         if self._forbidden_iplist:
-            if common.to_str(sa[0]) in self._forbidden_iplist:
+            if common.to_str(ip) in self._forbidden_iplist:
                 raise Exception('IP %s is in forbidden list, reject' %
-                                common.to_str(sa[0]))
-        remote_sock = socket.socket(af, socktype, proto)
+                                common.to_str(ip))
+        remote_sock = socket.socket(af, socket.SOCK_STREAM, socket.SOL_TCP)
         self._remote_sock = remote_sock
 
         self._fd_to_handlers[remote_sock.fileno()] = self
@@ -461,7 +459,8 @@ class TCPRelayHandler(object):
                     logging.info("connect to %s : %d" % (remote_addr, remote_port))
 
                     remote_sock = self._create_remote_socket(remote_addr,
-                                                             remote_port)
+                                                             remote_port,
+                                                             result[2])
                     try:
                         remote_sock.connect((remote_addr, remote_port))
                     except (OSError, IOError) as e:
@@ -509,7 +508,7 @@ class TCPRelayHandler(object):
             return
         if not data:
             return
-        self._server.server_transfer_ul += len(data)
+        self._server.add_transfer_ul(len(data))
         #TODO ============================================================
         if self._stage == STAGE_STREAM:
             self._write_to_sock(data, self._remote_sock)
@@ -529,7 +528,7 @@ class TCPRelayHandler(object):
             self.destroy()
             return
         try:
-            self._server.server_transfer_dl += len(data)
+            self._server.add_transfer_dl(len(data))
             recv_data = data
             beg_pos = 0
             max_len = len(recv_data)
@@ -863,7 +862,7 @@ def client_key(source_addr, server_af):
 
 
 class UDPRelay(object):
-    def __init__(self, config, dns_resolver, is_local, stat_callback=None, stat_counter=None):
+    def __init__(self, config, dns_resolver, is_local, stat_callback=None, stat_counter=None, stat_table=None):
         self._config = config
         if config.get('connect_verbose_info', 0) > 0:
             common.connect_log = logging.info
@@ -888,7 +887,8 @@ class UDPRelay(object):
         self._cache_dns_client = lru_cache.LRUCache(timeout=10,
                                          close_callback=self._close_client)
         self._client_fd_to_server_addr = {}
-        self._dns_cache = lru_cache.LRUCache(timeout=300)
+        self._resolve_queue = asyncdns.ResolveQueue(dns_resolver,
+                                                    self._on_dns_resolved)
         self._eventloop = None
         self._closed = False
         self.server_transfer_ul = 0
@@ -907,16 +907,14 @@ class UDPRelay(object):
         server_info.head_len = 30
         server_info.tcp_mss = 1440
         self._protocol.set_server_info(server_info)
+        self._encryptor = encrypt.UDPEncryptor(server_info.key, self._method)
 
         self._sockets = set()
         self._fd_to_handlers = {}
         self._reqid_to_hd = {}
         self._data_to_write_to_server_socket = []
 
-        self._timeouts = []  # a list for all the handlers
-        # we trim the timeouts once a while
-        self._timeout_offset = 0   # last checked position for timeout
-        self._handler_to_timeouts = {}  # key: handler value: index in timeouts
+        self._handler_to_timer = {}  # key: handler value: eventloop timer
 
         if 'forbidden_ip' in config:
             self._forbidden_iplist = config['forbidden_ip']
@@ -930,10 +928,25 @@ class UDPRelay(object):
                             (self._listen_addr, self._listen_port))
         af, socktype, proto, canonname, sa = addrs[0]
         server_socket = socket.socket(af, socktype, proto)
+        if config.get('reuse_port', False):
+            common.set_reuse_port(server_socket)
         server_socket.bind((self._listen_addr, self._listen_port))
         server_socket.setblocking(False)
         self._server_socket = server_socket
         self._stat_callback = stat_callback
+        self._port_stat = None
+        if stat_table is not None:
+            self._port_stat = stat_table.port_stat(self._listen_port)
+
+    def add_transfer_ul(self, data_len):
+        self.server_transfer_ul += data_len
+        if self._port_stat:
+            self._port_stat.add(shared_stat.STAT_UPLOAD, data_len)
+
+    def add_transfer_dl(self, data_len):
+        self.server_transfer_dl += data_len
+        if self._port_stat:
+            self._port_stat.add(shared_stat.STAT_DOWNLOAD, data_len)
 
     def _get_a_server(self):
         server = self._config['server']
@@ -1001,9 +1014,7 @@ class UDPRelay(object):
         #raise Exception('can not parse header')
         logging.warn("Protocol ERROR, UDP ogn data %s from %s:%d" % (binascii.hexlify(ogn_data), client_address[0], client_address[1]))
 
-    def _handle_server(self):
-        server = self._server_socket
-        data, r_addr = server.recvfrom(BUF_SIZE)
+    def _handle_server(self, data, r_addr):
         ogn_data = data
         if not data:
             logging.debug('UDP handle_server: data is empty')
@@ -1018,7 +1029,7 @@ class UDPRelay(object):
                 data = data[3:]
         else:
             ref_iv = [0]
-            data = encrypt.encrypt_all_iv(self._protocol.obfs.server_info.key, self._method, 0, data, ref_iv)
+            data = self._encryptor.encrypt_all_iv(0, data, ref_iv)
             # decrypt data
             if not data:
                 logging.debug('UDP handle_server: data is empty after decrypt')
@@ -1054,18 +1065,31 @@ class UDPRelay(object):
         else:
             server_addr, server_port = dest_addr, dest_port
 
-        addrs = self._dns_cache.get(server_addr, None)
-        if addrs is None:
-            # TODO async getaddrinfo
-            addrs = socket.getaddrinfo(server_addr, server_port, 0,
-                                       socket.SOCK_DGRAM, socket.SOL_UDP)
-            if not addrs:
-                # drop
+        # sent at once when the resolver has the hostname in its cache,
+        # which follows the TTL of the answer, or else held until it is
+        # resolved
+        self._resolve_queue.add(server_addr, (data, r_addr, server_port,
+                                              header_length))
+
+    def _on_dns_resolved(self, hostname, addr, items, error):
+        if not addr:
+            logging.debug('UDP can not resolve %s: %s, drop %d packets' %
+                          (common.to_str(hostname), error, len(items)))
+            return
+        for data, r_addr, server_port, header_length in items:
+            if self._closed:
                 return
-            else:
-                self._dns_cache[server_addr] = addrs
+            try:
+                self._send_to_server(data, r_addr, hostname, server_port,
+                                     addr, header_length)
+            except Exception as e:
+                shell.print_exception(e)
 
-        af, socktype, proto, canonname, sa = addrs[0]
+    def _send_to_server(self, data, r_addr, server_addr, server_port, addr,
+                        header_length):
+        # addr is (address family, ip) of server_addr
+        af = addr[0]
+        sa = (addr[1], server_port)
         key = client_key(r_addr, af)
         client = self._cache.get(key, None)
         if not client:
@@ -1077,7 +1101,7 @@ class UDPRelay(object):
                                   common.to_str(sa[0]))
                     # drop
                     return
-            client = socket.socket(af, socktype, proto)
+            client = socket.socket(af, socket.SOCK_DGRAM, socket.SOL_UDP)
             client.setblocking(False)
             is_dns = False
             if len(data) > 20 and data[11:19] == b"\x00\x01\x00\x00\x00\x00\x00\x00":
@@ -1105,11 +1129,11 @@ class UDPRelay(object):
         self._cache_dns_client.clear(16)
 
         if self._is_local:
-            ref_iv = [encrypt.encrypt_new_iv(self._method)]
+            ref_iv = [self._encryptor.new_iv()]
             self._protocol.obfs.server_info.iv = ref_iv[0]
             data = self._protocol.client_udp_pre_encrypt(data)
             #logging.debug("%s" % (binascii.hexlify(data),))
-            data = encrypt.encrypt_all_iv(self._protocol.obfs.server_info.key, self._method, 1, data, ref_iv)
+            data = self._encryptor.encrypt_all_iv(1, data, ref_iv)
             if not data:
                 return
         else:
@@ -1118,8 +1142,8 @@ class UDPRelay(object):
             return
         try:
             #logging.info('UDP handle_server sendto %s:%d %d bytes' % (common.to_str(server_addr), server_port, len(data)))
-            client.sendto(data, (server_addr, server_port))
-            self.server_transfer_ul += len(data)
+            client.sendto(data, sa)
+            self.add_transfer_ul(len(data))
         except IOError as e:
             err = eventloop.errno_from_exception(e)
             if err in (errno.EINPROGRESS, errno.EAGAIN):
@@ -1131,7 +1155,7 @@ class UDPRelay(object):
         #(cmd, request_id, data)
         #logging.info("UDP data %d %d %s" % (data[0], data[1], binascii.hexlify(data[2])))
         try:
-            self.server_transfer_ul += len(data[2])
+            self.add_transfer_ul(len(data[2]))
             if data[0] == 0:
                 if len(data[2]) >= 4:
                     for i in range(64):
@@ -1146,7 +1170,7 @@ class UDPRelay(object):
                     # return req id
                     self._reqid_to_hd[req_id] = (data[2][0:4], None)
                     rsp_data = self._pack_rsp_data(CMD_RSP_CONNECT, req_id, RSP_STATE_CONNECTED)
-                    data_to_send = encrypt.encrypt_all(self._password, self._method, 1, rsp_data)
+                    data_to_send = self._encryptor.encrypt_all(1, rsp_data)
                     self.write_to_server_socket(data_to_send, r_addr)
             elif data[0] == CMD_CONNECT_REMOTE:
                 if len(data[2]) > 4 and data[1] in self._reqid_to_hd:
@@ -1164,7 +1188,7 @@ class UDPRelay(object):
                         else:
                             # disconnect
                             rsp_data = self._pack_rsp_data(CMD_DISCONNECT, data[1], RSP_STATE_EMPTY)
-                            data_to_send = encrypt.encrypt_all(self._password, self._method, 1, rsp_data)
+                            data_to_send = self._encryptor.encrypt_all(1, rsp_data)
                             self.write_to_server_socket(data_to_send, r_addr)
                     else:
                         self.update_activity(self._reqid_to_hd[data[1]])
@@ -1172,7 +1196,7 @@ class UDPRelay(object):
                 else:
                     # disconnect
                     rsp_data = self._pack_rsp_data(CMD_DISCONNECT, data[1], RSP_STATE_EMPTY)
-                    data_to_send = encrypt.encrypt_all(self._password, self._method, 1, rsp_data)
+                    data_to_send = self._encryptor.encrypt_all(1, rsp_data)
                     self.write_to_server_socket(data_to_send, r_addr)
             elif data[0] > CMD_CONNECT_REMOTE and data[0] <= CMD_DISCONNECT:
                 if data[1] in self._reqid_to_hd:
@@ -1184,7 +1208,7 @@ class UDPRelay(object):
                 else:
                     # disconnect
                     rsp_data = self._pack_rsp_data(CMD_DISCONNECT, data[1], RSP_STATE_EMPTY)
-                    data_to_send = encrypt.encrypt_all(self._password, self._method, 1, rsp_data)
+                    data_to_send = self._encryptor.encrypt_all(1, rsp_data)
                     self.write_to_server_socket(data_to_send, r_addr)
             return
         except Exception as e:
@@ -1192,8 +1216,7 @@ class UDPRelay(object):
             logging.error(trace)
             return
 
-    def _handle_client(self, sock):
-        data, r_addr = sock.recvfrom(BUF_SIZE)
+    def _handle_client(self, sock, data, r_addr):
         if not data:
             logging.debug('UDP handle_client: data is empty')
             return
@@ -1205,17 +1228,15 @@ class UDPRelay(object):
                 # drop
                 return
             data = pack_addr(r_addr[0]) + struct.pack('>H', r_addr[1]) + data
-            ref_iv = [encrypt.encrypt_new_iv(self._method)]
+            ref_iv = [self._encryptor.new_iv()]
             self._protocol.obfs.server_info.iv = ref_iv[0]
             data = self._protocol.server_udp_pre_encrypt(data)
-            response = encrypt.encrypt_all_iv(self._protocol.obfs.server_info.key, self._method, 1,
-                                           data, ref_iv)
+            response = self._encryptor.encrypt_all_iv(1, data, ref_iv)
             if not response:
                 return
         else:
             ref_iv = [0]
-            data = encrypt.encrypt_all_iv(self._protocol.obfs.server_info.key, self._method, 0,
-                                       data, ref_iv)
+            data = self._encryptor.encrypt_all_iv(0, data, ref_iv)
             if not data:
                 return
             self._protocol.obfs.server_info.recv_iv = ref_iv[0]
@@ -1229,7 +1250,7 @@ class UDPRelay(object):
             response = b'\x00\x00\x00' + data
         client_addr = self._client_fd_to_server_addr.get(sock.fileno())
         if client_addr:
-            self.server_transfer_dl += len(response)
+            self.add_transfer_dl(len(response))
             self.write_to_server_socket(response, client_addr[0])
             key = client_key(client_addr[0], client_addr[1])
             client = self._cache_dns_client.get(key, None)
@@ -1279,81 +1300,65 @@ class UDPRelay(object):
         loop.add_periodic(self.handle_periodic)
 
     def remove_handler(self, handler):
-        index = self._handler_to_timeouts.get(hash(handler), -1)
-        if index >= 0:
-            # delete is O(n), so we just set it to None
-            self._timeouts[index] = None
-            del self._handler_to_timeouts[hash(handler)]
+        timer = self._handler_to_timer.pop(hash(handler), None)
+        if timer:
+            self._eventloop.cancel(timer)
 
     def update_activity(self, handler):
         # set handler to active
-        now = int(time.time())
-        if now - handler.last_activity < eventloop.TIMEOUT_PRECISION:
-            # thus we can lower timeout modification frequency
+        handler.last_activity = time.time()
+        if hash(handler) not in self._handler_to_timer:
+            self._handler_to_timer[hash(handler)] = \
+                self._eventloop.call_later(self._timeout,
+                                           self._handle_timeout, handler)
+
+    def _handle_timeout(self, handler):
+        del self._handler_to_timer[hash(handler)]
+        idle = time.time() - handler.last_activity
+        if idle < self._timeout:
+            self._handler_to_timer[hash(handler)] = \
+                self._eventloop.call_later(self._timeout - idle,
+                                           self._handle_timeout, handler)
             return
-        handler.last_activity = now
-        index = self._handler_to_timeouts.get(hash(handler), -1)
-        if index >= 0:
-            # delete is O(n), so we just set it to None
-            self._timeouts[index] = None
-        length = len(self._timeouts)
-        self._timeouts.append(handler)
-        self._handler_to_timeouts[hash(handler)] = length
-
-    def _sweep_timeout(self):
-        # tornado's timeout memory management is more flexible than we need
-        # we just need a sorted last_activity queue and it's faster than heapq
-        # in fact we can do O(1) insertion/remove so we invent our own
-        if self._timeouts:
-            logging.log(shell.VERBOSE_LEVEL, 'sweeping timeouts')
-            now = time.time()
-            length = len(self._timeouts)
-            pos = self._timeout_offset
-            while pos < length:
-                handler = self._timeouts[pos]
-                if handler:
-                    if now - handler.last_activity < self._timeout:
-                        break
-                    else:
-                        if handler.remote_address:
-                            logging.debug('timed out: %s:%d' %
-                                         handler.remote_address)
-                        else:
-                            logging.debug('timed out')
-                        handler.destroy()
-                        handler.destroy_local()
-                        self._timeouts[pos] = None  # free memory
-                        pos += 1
-                else:
-                    pos += 1
-            if pos > TIMEOUTS_CLEAN_SIZE and pos > length >> 1:
-                # clean up the timeout queue when it gets larger than half
-                # of the queue
-                self._timeouts = self._timeouts[pos:]
-                for key in self._handler_to_timeouts:
-                    self._handler_to_timeouts[key] -= pos
-                pos = 0
-            self._timeout_offset = pos
-
-    def handle_event(self, sock, fd, event):
-        if sock == self._server_socket:
-            if event & eventloop.POLL_ERR:
-                logging.error('UDP server_socket err')
+        if handler.remote_address:
+            logging.debug('timed out: %s:%d' % handler.remote_address)
+        else:
+            logging.debug('timed out')
+        handler.destroy()
+        handler.destroy_local()
+
+    def _recv_batch(self, sock, fd, handle):
+        # read until the socket would block, at most UDP_BATCH_SIZE
+        # datagrams, so a busy socket costs one poll wakeup per batch
+        # instead of one per datagram
+        for i in range(UDP_BATCH_SIZE):
+            try:
+                data, r_addr = sock.recvfrom(BUF_SIZE)
+            except (OSError, IOError) as e:
+                if eventloop.errno_from_exception(e) not in \
+                        (errno.EAGAIN, errno.EWOULDBLOCK):
+                    shell.print_exception(e)
+                return
             try:
-                self._handle_server()
+                handle(data, r_addr)
             except Exception as e:
                 shell.print_exception(e)
                 if self._config['verbose']:
                     traceback.print_exc()
+            if sock != self._server_socket and fd not in self._sockets:
+                # the client socket was closed while handling the data
+                return
+
+    def handle_event(self, sock, fd, event):
+        if sock == self._server_socket:
+            if event & eventloop.POLL_ERR:
+                logging.error('UDP server_socket err')
+            self._recv_batch(sock, fd, self._handle_server)
         elif sock and (fd in self._sockets):
             if event & eventloop.POLL_ERR:
                 logging.error('UDP client_socket err')
-            try:
-                self._handle_client(sock)
-            except Exception as e:
-                shell.print_exception(e)
-                if self._config['verbose']:
-                    traceback.print_exc()
+            self._recv_batch(sock, fd, lambda data, r_addr:
+                             self._handle_client(sock, data, r_addr))
         else:
             if sock:
                 handler = self._fd_to_handlers.get(fd, None)
@@ -1366,7 +1371,7 @@ class UDPRelay(object):
         if self._closed:
             self._cache.clear(0)
             self._cache_dns_client.clear(0)
-            self._dns_cache.sweep()
+            self._resolve_queue.close()
             if self._eventloop:
                 self._eventloop.remove_periodic(self.handle_periodic)
                 self._eventloop.remove(self._server_socket)
@@ -1378,10 +1383,9 @@ class UDPRelay(object):
             before_sweep_size = len(self._sockets)
             self._cache.sweep()
             self._cache_dns_client.sweep()
-            self._dns_cache.sweep()
+            self._resolve_queue.sweep(DNS_RESOLVE_TIMEOUT)
             if before_sweep_size != len(self._sockets):
                 logging.debug('UDP port %5d sockets %d' % (self._listen_port, len(self._sockets)))
-            self._sweep_timeout()
 
     def close(self, next_tick=False):
         logging.debug('UDP close')
@@ -1393,3 +1397,4 @@ class UDPRelay(object):
             self._server_socket.close()
             self._cache.clear(0)
             self._cache_dns_client.clear(0)
+            self._resolve_queue.close()